@@ -79,6 +79,27 @@ async def lifespan(app: FastAPI):
     # Cleanup all sessions
     await session_manager.cleanup_all()
 
+    # Close the HTTP connection pool shared by all Momo search crawlers
+    try:
+        from backend.handlers.search.momo_crawler import close_shared_client
+        await close_shared_client()
+    except ImportError:
+        pass
+
+    # Close the Zhipu client shared by all Momo search sessions
+    try:
+        from backend.handlers.search.momo_llm_batch import close_client
+        await close_client()
+    except ImportError:
+        pass
+
+    # Close the connection pools shared by all OpenAI-compatible LLM handlers
+    try:
+        from backend.handlers.llm.openai_handler import close_shared_clients
+        await close_shared_clients()
+    except ImportError:
+        pass
+
 
 # Create FastAPI app
 app = FastAPI(
@@ -47,6 +47,7 @@ class Session:
     config: dict = field(default_factory=dict)
     is_processing: bool = False
     is_interrupted: bool = False  # 中断标志
+    llm_cancel_event: asyncio.Event = field(default_factory=asyncio.Event)  # 通知 LLM 立即停止生成并关闭流
     is_connected: bool = True  # WebSocket连接状态
     disconnected_at: Optional[datetime] = None  # 断开时间
     current_tasks: List[asyncio.Task] = field(default_factory=list)  # 当前运行的任务列表
@@ -415,6 +416,8 @@ class Session:
         logger.info(f"  - 搜索模式: {search_mode}")
         logger.info(f"  - 搜索质量: {search_quality}")
         
+        self.llm_cancel_event.clear()
+        
         try:
             # Add user message to history
             self.conversation_history.append({
@@ -707,15 +710,16 @@ class Session:
                         momo_search_quality=search_quality,
                         progress_callback=search_progress_callback,
                         search_results_callback=search_results_callback,
-                        ui_language=ui_language
+                        ui_language=ui_language,
+                        cancel_event=self.llm_cancel_event
                     )
                 else:
                     # 如果高级搜索不可用，回退到普通模式
                     if search_mode == "advanced":
                         logger.warning(f"⚠️ 高级搜索不可用，回退到普通模式")
-                    stream = self.llm_handler.stream_response(safe_text, self.conversation_history, ui_language=ui_language)
+                    stream = self.llm_handler.stream_response(safe_text, self.conversation_history, ui_language=ui_language, cancel_event=self.llm_cancel_event)
             else:
-                stream = self.llm_handler.stream_response(safe_text, self.conversation_history, ui_language=ui_language)
+                stream = self.llm_handler.stream_response(safe_text, self.conversation_history, ui_language=ui_language, cancel_event=self.llm_cancel_event)
             
             async for chunk in stream:
                 # 检查是否已被中断
@@ -1159,6 +1163,7 @@ class SessionManager:
                                         task.cancel()
                                 existing_session.current_tasks.clear()
                             existing_session.is_interrupted = True
+                            existing_session.llm_cancel_event.set()
                             existing_session.is_processing = False
                         except Exception as cancel_error:
                             logger.error(
@@ -1274,6 +1279,7 @@ class SessionManager:
             try:
                 # 设置中断标志
                 session.is_interrupted = True
+                session.llm_cancel_event.set()
                 
                 # 中断流式处理队列
                 if hasattr(session, 'sentence_queue'):
@@ -177,7 +177,8 @@ class GoogleGeminiHandler(BaseHandler):
         self, 
         text: str,
         conversation_history: List[Dict] = None,
-        ui_language: str = "zh"
+        ui_language: str = "zh",
+        cancel_event: Optional[asyncio.Event] = None
     ) -> AsyncGenerator[str, None]:
         """
         流式生成响应（与 OpenAIHandler 接口一致）
@@ -186,6 +187,7 @@ class GoogleGeminiHandler(BaseHandler):
             text: 当前用户输入文本
             conversation_history: 对话历史记录 [{"role": "user/assistant", "content": "..."}]
             ui_language: 界面语言 ("zh" 或 "en")
+            cancel_event: 被设置时停止生成
             
         Yields:
             str: 响应文本块
@@ -247,6 +249,10 @@ class GoogleGeminiHandler(BaseHandler):
                         chunk_count += 1
                         total_text += chunk.text
                         yield chunk.text
+                    
+                    if cancel_event and cancel_event.is_set():
+                        logger.info("🛑 Gemini 流式生成被取消")
+                        break
                         
                 except asyncio.TimeoutError:
                     logger.error(f"❌ Gemini chunk 获取超时（{CHUNK_TIMEOUT}秒），可能遇到大表格或网络问题")
@@ -312,10 +318,11 @@ class GoogleGeminiHandler(BaseHandler):
         
         # 从 kwargs 中获取 ui_language，默认为 "zh"
         ui_language = kwargs.get("ui_language", "zh")
+        cancel_event = kwargs.get("cancel_event")
         
         if not user_query:
             logger.warning("⚠️ 用户查询为空")
-            async for chunk in self.stream_response(text, conversation_history, ui_language=ui_language):
+            async for chunk in self.stream_response(text, conversation_history, ui_language=ui_language, cancel_event=cancel_event):
                 yield chunk
             return
         
@@ -329,7 +336,7 @@ class GoogleGeminiHandler(BaseHandler):
         
         if not momo_search_handler:
             logger.warning("⚠️ Momo 搜索处理器未提供，跳过搜索")
-            async for chunk in self.stream_response(text, conversation_history, ui_language=ui_language):
+            async for chunk in self.stream_response(text, conversation_history, ui_language=ui_language, cancel_event=cancel_event):
                 yield chunk
             return
         
@@ -356,11 +363,8 @@ class GoogleGeminiHandler(BaseHandler):
                 logger.info(f"✅ 搜索完成，获得 {len(search_results)} 个结果")
                 logger.info(f"📚 引用信息长度: {len(citations)}")
                 
-                # 使用思考链构建深度思考的 Prompt
-                from datetime import datetime
-                from backend.handlers.llm.thinking_chain import build_enhanced_search_prompt
-                
-                today = datetime.now().strftime("%Y-%m-%d")
+                # 使用思考链构建深度思考的 Prompt（日期由 thinking_chain 按天缓存）
+                from backend.handlers.llm.thinking_chain import build_enhanced_search_prompt, DEFAULT_CONTEXT_TOKENS
                 
                 # 根据搜索质量模式决定是否使用思考链
                 # quality（深度）模式：使用思考链，进行深度思考
@@ -372,10 +376,10 @@ class GoogleGeminiHandler(BaseHandler):
                     enhanced_text = build_enhanced_search_prompt(
                         user_query=user_query,
                         search_results=search_results,
-                        current_date=today,
                         use_thinking_chain=True,
                         thinking_results=thinking_results,
-                        ui_language=ui_language
+                        ui_language=ui_language,
+                        max_context_tokens=self.config.get("search_context_tokens", DEFAULT_CONTEXT_TOKENS)
                     )
                 else:
                     # 快速模式：使用简单 Prompt
@@ -383,9 +387,9 @@ class GoogleGeminiHandler(BaseHandler):
                     enhanced_text = build_enhanced_search_prompt(
                         user_query=user_query,
                         search_results=search_results,
-                        current_date=today,
                         use_thinking_chain=False,
-                        ui_language=ui_language
+                        ui_language=ui_language,
+                        max_context_tokens=self.config.get("search_context_tokens", DEFAULT_CONTEXT_TOKENS)
                     )
                 
                 logger.info(f"📝 搜索上下文已构建 (长度: {len(enhanced_text)}, 思考链: {use_thinking_chain})")
@@ -393,7 +397,7 @@ class GoogleGeminiHandler(BaseHandler):
                 logger.info(f"📤 准备发送增强消息 (总长度: {len(enhanced_text)})")
                 
                 # 使用增强后的消息进行生成
-                async for chunk in self.stream_response(enhanced_text, conversation_history):
+                async for chunk in self.stream_response(enhanced_text, conversation_history, cancel_event=cancel_event):
                     yield chunk
                 
                 # 在响应结束后添加引用信息
@@ -402,13 +406,13 @@ class GoogleGeminiHandler(BaseHandler):
                     yield f"\n\n**📚 参考来源：**\n{citations_text}"
             else:
                 logger.warning("⚠️ 搜索未返回结果，使用原始消息")
-                async for chunk in self.stream_response(text, conversation_history):
+                async for chunk in self.stream_response(text, conversation_history, cancel_event=cancel_event):
                     yield chunk
                     
         except Exception as e:
             logger.error(f"❌ 搜索失败: {e}", exc_info=True)
             logger.info("⚠️ 搜索失败，使用原始消息")
-            async for chunk in self.stream_response(text, conversation_history):
+            async for chunk in self.stream_response(text, conversation_history, cancel_event=cancel_event):
                 yield chunk
     
     def update_config(self, config: dict):
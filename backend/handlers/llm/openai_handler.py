@@ -1,13 +1,220 @@
 """
 OpenAI-compatible API Handler for language models
 """
-import json
-from typing import List, Dict, Optional, AsyncGenerator
+import asyncio
+import hashlib
+import time
+import traceback
+from collections import OrderedDict
+from typing import List, Dict, Optional, AsyncGenerator, Callable, Tuple
+import httpx
+import numpy as np
+import orjson
 from openai import AsyncOpenAI
 from loguru import logger
 
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+    logger.warning("⚠️ h2 未安装，LLM 客户端将回退到 HTTP/1.1 (pip install 'httpx[http2]')")
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+    logger.warning("⚠️ tiktoken 未安装，对话历史 token 预算将使用字符数估算")
+
 from backend.handlers.base import BaseHandler
 from backend.core.health_monitor import timer, llm_processing_time
+from backend.utils.text_utils import detect_language
+
+
+# 出错时返回给用户的兜底回复
+_ERR_RESPONSE = "抱歉，我遇到了一些技术问题，请稍后再试。"
+
+# 按用户语言追加到系统提示词末尾的强制语言指令
+LANGUAGE_INSTRUCTIONS = {
+    "en": "\n\n🔴 CRITICAL INSTRUCTION: The user's message is in ENGLISH. You MUST respond ENTIRELY in ENGLISH. DO NOT use Chinese characters in your response. This is mandatory.",
+    "zh": "\n\n🔴 重要指令：用户的消息是中文。你必须完全用中文回答。不要在回答中使用英文。这是强制要求。",
+}
+
+_API_MESSAGE_KEYS = {"role", "content"}
+
+
+def _normalize_prompt(text: str) -> str:
+    """规范化提示词的空白（统一换行符、去掉行尾空白），让相同内容始终得到相同字节"""
+    return "\n".join(line.rstrip() for line in text.replace("\r\n", "\n").split("\n")).strip()
+
+
+# 流式输出遇到这些句末字符时立即刷新缓冲区
+_FLUSH_PUNCTUATION = frozenset("。！？!?.；;…\n")
+
+
+def _to_api_message(msg: Dict) -> Dict:
+    """历史消息已经是 {role, content} 形状时直接复用，否则（如带 timestamp）复制出 API 需要的字段"""
+    if msg.keys() == _API_MESSAGE_KEYS:
+        return msg
+    return {"role": msg["role"], "content": msg["content"]}
+
+
+def _message_fingerprint(msg: Dict) -> tuple:
+    """消息标识（用于在被裁剪、滑动的历史中定位已摘要的边界）"""
+    return (msg["role"], msg["content"], msg.get("timestamp"))
+
+
+# 模块级客户端注册表：目标 (api_url, api_key) 和连接池配置都相同的 handler 共享同一个客户端及其连接池
+# key 为 (api_url, api_key, 连接池配置)，配置不同（如 http2=False）的 handler 各自使用独立的连接池
+_CLIENT_CACHE: Dict[tuple, Tuple[AsyncOpenAI, httpx.AsyncClient]] = {}
+
+
+class _MicroBatcher:
+    """
+    process() 微批处理器：在短时间窗口内收集并发请求后统一派发
+    
+    OpenAI 兼容的 chat 接口不支持单个请求携带多组 messages，因此批内完全相同的请求
+    合并为一次调用、结果分发给所有等待者，其余请求在共享连接池上并发发出。
+    """
+    
+    def __init__(self, client: AsyncOpenAI, max_wait: float = 0.01, max_batch: int = 8):
+        self.client = client
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self._closed = False
+    
+    @staticmethod
+    def _fail(futures, exc: BaseException):
+        """让尚未完成的等待者以异常结束（避免 submit() 永远挂起）"""
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+    
+    async def submit(self, request: Dict) -> str:
+        """提交一个 chat.completions 请求，返回响应文本"""
+        if self._closed:
+            raise RuntimeError("LLM 微批处理器已关闭")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((request, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                deadline = loop.time() + self.max_wait
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # 关闭时已收集但尚未派发的请求
+                self._fail((future for _, future in batch), RuntimeError("LLM 微批处理器已关闭"))
+                raise
+            
+            # 按请求内容分组：相同请求只发一次
+            groups: Dict[bytes, Tuple[Dict, List[asyncio.Future]]] = {}
+            for request, future in batch:
+                try:
+                    key = orjson.dumps(request, option=orjson.OPT_SORT_KEYS)
+                except Exception as e:
+                    # 例如 extra_body 中含有无法序列化的值：只让该请求失败，收集循环继续运行
+                    logger.error(f"❌ 微批请求无法序列化: {e}")
+                    self._fail((future,), e)
+                    continue
+                groups.setdefault(key, (request, []))[1].append(future)
+            
+            if len(groups) < len(batch):
+                logger.info(f"📦 微批合并: {len(batch)} 个请求 -> {len(groups)} 次调用")
+            
+            # 派发后立即收集下一批，不等待本批完成
+            for request, futures in groups.values():
+                task = asyncio.create_task(self._dispatch(request, futures))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+    
+    async def _dispatch(self, request: Dict, futures: List[asyncio.Future]):
+        try:
+            response = await self.client.chat.completions.create(**request)
+            text = response.choices[0].message.content
+            for future in futures:
+                if not future.done():
+                    future.set_result(text)
+        except asyncio.CancelledError:
+            self._fail(futures, RuntimeError("LLM 微批处理器已关闭"))
+            raise
+        except Exception as e:
+            self._fail(futures, e)
+    
+    async def aclose(self):
+        """停止收集循环并取消进行中的派发；所有未完成的等待者以异常结束"""
+        self._closed = True
+        tasks = list(self._inflight)
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        # 仍在队列中、尚未被收集的请求
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            self._fail((future,), RuntimeError("LLM 微批处理器已关闭"))
+
+
+# 每个共享客户端对应一个微批处理器
+_BATCHERS: Dict[tuple, _MicroBatcher] = {}
+
+
+def _get_or_create_client(
+    api_url: str,
+    api_key: str,
+    pool_settings: tuple,
+    http_client_factory: Callable[[], httpx.AsyncClient]
+) -> Tuple[AsyncOpenAI, httpx.AsyncClient]:
+    """
+    获取或创建共享的 OpenAI 客户端
+    
+    创建过程中没有 await，在单个事件循环内天然是原子的，因此不需要额外加锁。
+    """
+    key = (api_url, api_key, pool_settings)
+    entry = _CLIENT_CACHE.get(key)
+    if entry is None:
+        http_client = http_client_factory()
+        entry = (
+            AsyncOpenAI(api_key=api_key, base_url=api_url, http_client=http_client),
+            http_client
+        )
+        _CLIENT_CACHE[key] = entry
+        logger.info(f"🔗 创建共享 LLM 客户端: {api_url}")
+    return entry
+
+
+async def close_shared_clients():
+    """关闭所有共享 LLM 客户端的连接池（应用退出时调用；之后新建的 handler 会重新创建客户端）"""
+    entries = list(_CLIENT_CACHE.values())
+    batchers = list(_BATCHERS.values())
+    _CLIENT_CACHE.clear()
+    _BATCHERS.clear()
+    # 先停止微批处理器（其派发任务仍在使用连接池），再关闭连接池
+    await asyncio.gather(*(batcher.aclose() for batcher in batchers), return_exceptions=True)
+    await asyncio.gather(
+        *(http_client.aclose() for _, http_client in entries if not http_client.is_closed),
+        return_exceptions=True
+    )
+    if entries:
+        logger.info(f"🔌 已关闭 {len(entries)} 个共享 LLM 客户端")
 
 
 class OpenAIHandler(BaseHandler):
@@ -23,6 +230,23 @@ class OpenAIHandler(BaseHandler):
         self.api_key = api_key
         self.model = model
         self.client = None
+        self.http_client = None
+        self._client_key: Optional[tuple] = None
+        
+        # 超出历史窗口的早期对话摘要（可选，后台生成）：记录已摘要到的最后一条消息，
+        # 新增的窗口外消息累积够 summary_min_new_messages 条才增量更新一次
+        self._history_summary: str = ""
+        self._summary_boundary: Optional[tuple] = None
+        self._summary_task: Optional[asyncio.Task] = None
+        
+        # 非流式响应缓存（LRU + TTL），key -> (写入时间, 响应文本)
+        self._cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._cache_max_entries = self.config.get("cache_max_entries", 256)
+        self._cache_ttl = self.config.get("cache_ttl_seconds", 3600)
+        
+        # 语义缓存（可选）：[(归一化向量, 响应文本)]，末尾为最近使用
+        self._sem_cache: List[Tuple[np.ndarray, str]] = []
+        self._sem_embedder = None
         
         # Generation parameters
         self.temperature = self.config.get("temperature", 0.7)
@@ -30,29 +254,132 @@ class OpenAIHandler(BaseHandler):
         self.top_p = self.config.get("top_p", 0.9)
         self.presence_penalty = self.config.get("presence_penalty", 0)
         self.frequency_penalty = self.config.get("frequency_penalty", 0)
-        self.system_prompt = self.config.get(
+        self.system_prompt = _normalize_prompt(self.config.get(
             "system_prompt",
             "You are a friendly AI assistant. Please answer questions clearly and concisely. IMPORTANT: Always respond in the SAME LANGUAGE as the user's input. If the user writes in English, respond in English. If the user writes in Chinese, respond in Chinese. Match the user's language naturally.\n\n你是一个友好的AI助手。请用简洁清晰的语言回答问题。重要提示：必须使用与用户输入相同的语言回复。如果用户用英语提问，请用英语回答。如果用户用中文提问，请用中文回答。自然地匹配用户的语言。"
-        )
+        ))
+        self._max_history = self.config.get("max_history", 10)
+        self._build_system_messages()
+        
+        # 早期对话摘要默认关闭：每次更新都是一次额外的模型调用，且摘要变化会改变请求前缀
+        self._summary_enabled = self.config.get("history_summary", False)
+        self._summary_min_new = self.config.get("summary_min_new_messages", self._max_history)
+        
+        # 对话历史按 token 预算截取（编码器首次使用时加载），每条内容的 token 数按内容缓存
+        self._history_token_budget = self.config.get("history_token_budget", 1500)
+        self._encoder = None
+        self._token_len_cache: Dict[str, int] = {}
         
+    def _build_system_messages(self):
+        """
+        预构建系统提示词消息（不可变，每次请求直接复用，不再重建/修改）
+        
+        系统消息 + 历史构成的请求前缀需要逐字节稳定，才能命中服务商的前缀缓存（prompt caching）。
+        这里不注入任何随请求变化的内容（时间戳、请求ID等）；修改系统提示词会让已有的前缀缓存失效。
+        """
+        self._system_msg = {"role": "system", "content": self.system_prompt}
+        self._system_msgs = {
+            lang: {"role": "system", "content": self.system_prompt + instruction}
+            for lang, instruction in LANGUAGE_INSTRUCTIONS.items()
+        }
+    
+    def set_system_prompt(self, system_prompt: str):
+        """显式修改系统提示词（会使服务商侧已缓存的提示词前缀失效）"""
+        system_prompt = _normalize_prompt(system_prompt)
+        if system_prompt == self.system_prompt:
+            return
+        self.system_prompt = system_prompt
+        self._build_system_messages()
+        logger.info("📝 系统提示词已更新，服务商前缀缓存将重新建立")
+    
     async def _setup(self):
         """Setup OpenAI client"""
         try:
             # Initialize async OpenAI client
-            self.client = AsyncOpenAI(
-                api_key=self.api_key,
-                base_url=self.api_url
-            )
+            self.client = self._create_client()
             
-            # Test connection
-            await self._test_connection()
+            # 连接测试与连接池预热并发进行（预热让首批并发请求不再支付 TLS 握手延迟）
+            await asyncio.gather(self._test_connection(), self._warm_connections())
             
             logger.info(f"OpenAI client initialized with model '{self.model}'")
+            logger.info(f"  Base URL: {self.api_url}")
+            logger.info(f"  Temperature: {self.temperature}")
+            logger.info(f"  Max tokens: {self.max_tokens}")
             
         except Exception as e:
             logger.error(f"Failed to initialize OpenAI client: {e}")
             raise
     
+    def _new_http_client(self) -> httpx.AsyncClient:
+        """
+        创建 HTTP 客户端
+        
+        大 keep-alive 连接池 + 长 keepalive_expiry，让每次 process/stream_response 复用热连接，
+        避免重复 TCP+TLS 握手；HTTP/2 下多个并发流共享同一连接。
+        """
+        http2, max_connections, max_keepalive_connections, keepalive_expiry = self._pool_settings()
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry
+            ),
+            timeout=httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0)
+        )
+    
+    def _pool_settings(self) -> tuple:
+        """连接池配置 (http2, max_connections, max_keepalive_connections, keepalive_expiry)，也是共享客户端 key 的一部分"""
+        # 后端只支持 HTTP/1.1 时可通过 http2=False 关闭；此时每个流独占一个连接，默认放大连接池避免流之间互相阻塞
+        http2 = HTTP2_AVAILABLE and self.config.get("http2", True)
+        return (
+            http2,
+            self.config.get("max_connections", 200 if http2 else 500),
+            self.config.get("max_keepalive_connections", 100),
+            self.config.get("keepalive_expiry", 600.0)
+        )
+    
+    def _create_client(self) -> AsyncOpenAI:
+        """获取当前 (api_url, api_key, 连接池配置) 对应的共享 OpenAI 客户端"""
+        pool_settings = self._pool_settings()
+        self._client_key = (self.api_url, self.api_key, pool_settings)
+        client, self.http_client = _get_or_create_client(
+            self.api_url, self.api_key, pool_settings, self._new_http_client
+        )
+        return client
+    
+    async def _get_batcher(self) -> _MicroBatcher:
+        """获取当前共享客户端对应的微批处理器（跨 handler 实例合并并发请求）"""
+        key = self._client_key
+        batcher = _BATCHERS.get(key)
+        if batcher is None or batcher.client is not self.client:
+            stale = batcher
+            batcher = _MicroBatcher(
+                self.client,
+                max_wait=self.config.get("micro_batch_wait_ms", 10) / 1000,
+                max_batch=self.config.get("micro_batch_size", 8)
+            )
+            # 先登记新处理器（关闭旧处理器期间到达的请求不会再创建一个），
+            # 再停止旧处理器的收集循环，避免其任务永远阻塞在 queue.get()
+            _BATCHERS[key] = batcher
+            if stale is not None:
+                await stale.aclose()
+        return batcher
+    
+    async def _warm_connections(self):
+        """并发打开若干连接预热连接池（尽力而为，失败不影响初始化）"""
+        n = self.config.get("warm_connections", 4)
+        if n <= 0:
+            return
+        
+        # 任何 HTTP 响应（包括 404/405）都说明 TCP+TLS 连接已建立并进入连接池
+        results = await asyncio.gather(
+            *[self.http_client.head(self.api_url) for _ in range(n)],
+            return_exceptions=True
+        )
+        warmed = sum(1 for r in results if not isinstance(r, Exception))
+        logger.info(f"🔥 LLM 连接池预热: {warmed}/{n}")
+    
     async def _test_connection(self):
         """Test API connection"""
         try:
@@ -67,70 +394,393 @@ class OpenAIHandler(BaseHandler):
             logger.error(f"API connection test failed: {e}")
             raise
     
-    async def process(self, text: str, conversation_history: List[Dict] = None) -> str:
+    def _count_tokens(self, content: str) -> int:
+        """计算内容的 token 数（结果按内容缓存，历史消息每轮不会重复编码）"""
+        n = self._token_len_cache.get(content)
+        if n is not None:
+            return n
+        
+        if self._encoder is None and TIKTOKEN_AVAILABLE:
+            try:
+                self._encoder = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                # 非 OpenAI 模型名：回退到通用编码；加载失败（如离线无法下载 BPE）时不再每轮重试
+                try:
+                    self._encoder = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    logger.warning(f"⚠️ tiktoken 编码器加载失败，改用字符数估算: {e}")
+                    self._encoder = False
+            except Exception as e:
+                logger.warning(f"⚠️ tiktoken 编码器加载失败，改用字符数估算: {e}")
+                self._encoder = False
+        
+        if self._encoder:
+            # 用户输入可能包含 <|endoftext|> 等特殊 token 文本，按普通文本计数而不是抛出异常
+            n = len(self._encoder.encode(content, disallowed_special=()))
+        else:
+            n = int(len(content) * 0.6)  # 与流式日志中的估算方式一致
+        
+        if len(self._token_len_cache) >= 1024:
+            self._token_len_cache.clear()
+        self._token_len_cache[content] = n
+        return n
+    
+    def _recent_history(self, conversation_history: List[Dict]) -> List[Dict]:
+        """
+        从最新消息往前截取，直到达到 token 预算（同时不超过 max_history 条）
+        
+        最新一条（当前用户输入）总是保留，即使它本身就超出预算。
+        """
+        budget = self._history_token_budget
+        start = len(conversation_history)
+        lower = max(0, start - self._max_history)
+        used = 0
+        while start > lower:
+            used += self._count_tokens(conversation_history[start - 1]["content"])
+            if used > budget and start < len(conversation_history):
+                break
+            start -= 1
+        return conversation_history[start:]
+    
+    def _summary_messages(self, conversation_history: List[Dict], window: int) -> List[Dict]:
+        """
+        返回早期对话摘要消息（0 或 1 条），并在需要时后台触发摘要更新
+        
+        落在最近 window 条之外、且尚未摘要的消息累积到 summary_min_new_messages 条后，
+        才把这些新消息连同已有摘要交给模型压缩一次；摘要在两次更新之间保持不变，
+        请求前缀因此只在更新时变化。
+        """
+        if not self._summary_enabled:
+            return []
+        
+        end = len(conversation_history) - window  # 窗口外消息为 [:end]
+        if end > 0 and (self._summary_task is None or self._summary_task.done()):
+            start = 0
+            if self._summary_boundary is not None:
+                # 从后往前定位已摘要的最后一条；已被裁剪掉时窗口外的全部消息都是新的
+                for i in range(len(conversation_history) - 1, -1, -1):
+                    if _message_fingerprint(conversation_history[i]) == self._summary_boundary:
+                        start = i + 1
+                        break
+            pending = conversation_history[start:end]
+            if len(pending) >= self._summary_min_new:
+                self._summary_task = asyncio.create_task(self._summarize_history(pending))
+        
+        if self._history_summary:
+            return [{"role": "system", "content": "对话摘要：" + self._history_summary}]
+        return []
+    
+    async def _summarize_history(self, pending: List[Dict]):
+        """后台调用模型，把尚未摘要的早期消息合并进已有摘要"""
+        try:
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in pending)
+            if self._history_summary:
+                transcript = f"已有摘要：{self._history_summary}\n\n{transcript}"
+            
+            response = await self.client.chat.completions.create(
+                model=self.config.get("summary_model", self.model),
+                messages=[
+                    {"role": "system", "content": "请用简洁的语言概括以下对话的关键信息（人物、事实、用户偏好、未解决的问题），不超过150字。"},
+                    {"role": "user", "content": transcript}
+                ],
+                temperature=0.3,
+                max_tokens=200
+            )
+            summary = response.choices[0].message.content
+            if summary:
+                self._history_summary = summary.strip()
+                self._summary_boundary = _message_fingerprint(pending[-1])
+                logger.info(f"📝 早期对话摘要已更新 (+{len(pending)}条 -> {len(self._history_summary)}字)")
+        except Exception as e:
+            logger.warning(f"⚠️ 早期对话摘要生成失败: {e}")
+    
+    async def process(
+        self,
+        text: str,
+        conversation_history: List[Dict] = None,
+        use_cache: bool = True,
+        max_tokens: Optional[int] = None
+    ) -> str:
         """
         Generate response for given text
         
         Args:
             text: User input text
             conversation_history: Previous conversation messages
+            use_cache: Whether the response cache may be used (False bypasses it)
+            max_tokens: Explicit output token limit (skips the adaptive cap)
             
         Returns:
             Generated response text
         """
         with timer(llm_processing_time):
-            return await self._generate_response(text, conversation_history)
+            return await self._generate_response(text, conversation_history, use_cache, max_tokens)
+    
+    def _adaptive_max_tokens(self, text: str, max_tokens: Optional[int] = None) -> int:
+        """
+        根据用户输入长度自适应限制输出 token 数
+        
+        输出长度决定生成耗时（TPOT × token 数），简短的寒暄不需要完整的 max_tokens 预算。
+        默认关闭（adaptive_max_tokens=True 开启）：输入长度无法反映意图，“讲个故事”这类短输入
+        需要长回答，开启后会被截断在下限附近。显式传入 max_tokens 时直接使用。
+        """
+        if max_tokens is not None:
+            return max_tokens
+        if not text or not self.config.get("adaptive_max_tokens", False):
+            return self.max_tokens
+        floor = self.config.get("adaptive_max_tokens_floor", 256)
+        factor = self.config.get("adaptive_max_tokens_factor", 8)
+        return min(self.max_tokens, max(floor, factor * self._count_tokens(text)))
+    
+    def _cache_key(self, messages: List[Dict], max_tokens: int) -> str:
+        """响应缓存的 key：模型 + 消息 + 采样参数"""
+        return hashlib.blake2b(orjson.dumps({
+            "m": self.model,
+            "msgs": messages,
+            "t": self.temperature,
+            "tp": self.top_p,
+            "mt": max_tokens
+        }, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[str]:
+        """读取缓存（过期则删除）"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        stored_at, response_text = entry
+        if time.monotonic() - stored_at > self._cache_ttl:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return response_text
+    
+    def _cache_put(self, key: str, response_text: str):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        self._cache[key] = (time.monotonic(), response_text)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_max_entries:
+            self._cache.popitem(last=False)
+    
+    def _embed_text(self, text: str) -> np.ndarray:
+        """编码用户输入为归一化向量（复用 Momo 搜索的共享 embedding 模型）"""
+        if self._sem_embedder is None:
+            import torch
+            from backend.handlers.search.momo_search_handler import MomoSearchHandler
+            self._sem_embedder = MomoSearchHandler._get_shared_embedding_model(
+                self.config.get("semantic_cache_model", "BAAI/bge-small-zh-v1.5"),
+                device="cpu",
+                torch_dtype=torch.float32
+            )
+        return self._sem_embedder.encode(text, normalize_embeddings=True)
+    
+    def _sem_cache_lookup(self, q: np.ndarray) -> Optional[str]:
+        """语义缓存查找：一次矩阵乘法计算与所有缓存提示的余弦相似度"""
+        if not self._sem_cache:
+            return None
+        vecs = np.stack([v for v, _ in self._sem_cache])
+        scores = vecs @ q
+        best = int(np.argmax(scores))
+        if scores[best] < self.config.get("semantic_cache_threshold", 0.92):
+            return None
+        entry = self._sem_cache.pop(best)
+        self._sem_cache.append(entry)
+        logger.info(f"⚡ 命中语义缓存 (sim={scores[best]:.3f})")
+        return entry[1]
     
-    async def _generate_response(self, text: str, conversation_history: List[Dict] = None) -> str:
+    def _sem_cache_put(self, q: np.ndarray, response_text: str):
+        """写入语义缓存，超出容量时淘汰最久未使用的条目"""
+        self._sem_cache.append((q, response_text))
+        max_entries = self.config.get("max_semantic_entries", 128)
+        if len(self._sem_cache) > max_entries:
+            del self._sem_cache[:len(self._sem_cache) - max_entries]
+    
+    async def _generate_response(
+        self,
+        text: str,
+        conversation_history: List[Dict] = None,
+        use_cache: bool = True,
+        max_tokens: Optional[int] = None
+    ) -> str:
         """Generate response using the API"""
         try:
+            max_tokens = self._adaptive_max_tokens(text, max_tokens)
+            
             # Prepare messages
-            messages = [{"role": "system", "content": self.system_prompt}]
+            messages = [self._system_msg]
             
             # Add conversation history
             if conversation_history:
-                # Keep last N messages to avoid token limit
-                max_history = self.config.get("max_history", 10)
-                recent_history = conversation_history[-max_history:]
+                # Keep recent messages within the token budget
+                recent_history = self._recent_history(conversation_history)
+                messages.extend(self._summary_messages(conversation_history, len(recent_history)))
                 
                 # 注意：recent_history 已经包含当前用户输入（在 session_manager 中添加），直接全部添加即可
-                for msg in recent_history:
-                    messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"]
-                    })
+                messages.extend(map(_to_api_message, recent_history))
             else:
                 # 没有历史记录，直接添加新消息
                 messages.append({"role": "user", "content": text})
             
-            # Generate response
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                top_p=self.top_p,
-                presence_penalty=self.presence_penalty,
-                frequency_penalty=self.frequency_penalty
-            )
+            # 只有确定性采样（或显式允许）时才缓存，避免把随机结果固定下来
+            cache_key = None
+            if use_cache and (self.temperature == 0 or self.config.get("cache_nondeterministic", False)):
+                cache_key = self._cache_key(messages, max_tokens)
+                cached = self._cache_get(cache_key)
+                if cached is not None:
+                    logger.info(f"⚡ 命中响应缓存: {cached[:100]}...")
+                    return cached
+            
+            # 语义缓存只看用户输入（不含历史），适合问候语、常见问答等与上下文无关的场景
+            query_vec = None
+            if use_cache and text and self.config.get("semantic_cache", False):
+                query_vec = await asyncio.to_thread(self._embed_text, text)
+                cached = self._sem_cache_lookup(query_vec)
+                if cached is not None:
+                    return cached
             
-            # Extract response text
-            response_text = response.choices[0].message.content
+            # Generate response
+            request = {
+                "model": self.model,
+                "messages": messages,
+                "temperature": self.temperature,
+                "max_tokens": max_tokens,
+                "top_p": self.top_p,
+                "presence_penalty": self.presence_penalty,
+                "frequency_penalty": self.frequency_penalty
+            }
+            if self.config.get("micro_batch", False):
+                response_text = await (await self._get_batcher()).submit(request)
+            else:
+                response = await self.client.chat.completions.create(**request)
+                
+                # Extract response text
+                response_text = response.choices[0].message.content
             
             logger.info(f"Generated response: {response_text[:100]}...")
             
+            if cache_key and response_text:
+                self._cache_put(cache_key, response_text)
+            if query_vec is not None and response_text:
+                self._sem_cache_put(query_vec, response_text)
+            
             return response_text
             
         except Exception as e:
             logger.error(f"Failed to generate response: {e}")
-            return "抱歉，我遇到了一些技术问题，请稍后再试。"
+            return _ERR_RESPONSE
     
-    async def generate_response(self, text: str, conversation_history: List[Dict] = None) -> str:
+    async def generate_response(
+        self,
+        text: str,
+        conversation_history: List[Dict] = None,
+        use_cache: bool = True,
+        max_tokens: Optional[int] = None
+    ) -> str:
         """Public method to generate response"""
         if not self._initialized:
             await self.initialize()
         
-        return await self.process(text, conversation_history)
+        return await self.process(text, conversation_history, use_cache, max_tokens)
+    
+    def _build_messages(
+        self,
+        text: str,
+        conversation_history: Optional[List[Dict]],
+        ui_language: str = "zh",
+        log_tag: str = ""
+    ) -> Tuple[List[Dict], str]:
+        """
+        构建发送给 LLM 的消息列表（stream_response 与 stream_response_with_search 共用）
+        
+        Args:
+            text: 用户输入文本
+            conversation_history: 对话历史（最后一条通常是当前用户输入）
+            ui_language: 界面语言
+            log_tag: 日志标签，如 "(搜索模式)"
+        
+        Returns:
+            (消息列表, 检测到的用户语言)
+        """
+        # Prepare messages
+        messages = [self._system_msg]
+        
+        if conversation_history:
+            # Gemma 模型特殊处理：每5轮对话重置一次上下文
+            # 注意：必须先判断是否需要重置（基于完整历史），再应用 max_history 截断
+            if 'gemma' in self.model.lower():
+                # conversation_history 中最后一条是当前用户输入（已经在 session_manager 中添加）
+                # 所以要排除它来计算之前的对话轮数
+                history_without_current = conversation_history[:-1] if conversation_history and conversation_history[-1].get("role") == "user" else conversation_history
+                user_messages = [m for m in history_without_current if m["role"] == "user"] if history_without_current else []
+        
+                logger.info(f"📊 Gemma模型{log_tag}对话统计: 完整历史={len(conversation_history) if conversation_history else 0}条, 用户消息={len(user_messages)}条")
+        
+                # 判断是否需要重置（第5轮之后，即第6、11、16轮...）
+                if len(user_messages) >= 5 and len(user_messages) % 5 == 0:
+                    logger.info(f"🔄 Gemma模型{log_tag}检测到第 {len(user_messages)+1} 轮对话，执行上下文重置")
+        
+                    # 从 history_without_current 中取最后2条消息（上一轮对话）
+                    if history_without_current and len(history_without_current) >= 2:
+                        last_user_msg = history_without_current[-2]  # 上一轮的user消息
+                        last_assistant_msg = history_without_current[-1]  # 上一轮的assistant回复
+        
+                        # 验证格式正确
+                        if last_user_msg["role"] == "user" and last_assistant_msg["role"] == "assistant":
+                            # 合并上一轮对话和新消息作为新的第一轮
+                            merged_content = f"之前的对话：\n用户: {last_user_msg['content']}\n助手: {last_assistant_msg['content']}\n\n当前问题: {text}"
+                            messages.append({"role": "user", "content": merged_content})
+                            logger.info(f"✅ 重置上下文，只保留上一轮(user:{len(last_user_msg['content'])}字 + assistant:{len(last_assistant_msg['content'])}字) + 新消息({len(text) if text else 0}字)")
+                        else:
+                            # 格式不对，说明历史记录异常，按正常流程处理（但排除当前输入，因为后面会统一添加）
+                            logger.warning(f"⚠️ 上下文重置失败：历史记录格式不正确 (last_user_msg role={last_user_msg.get('role')}, last_assistant_msg role={last_assistant_msg.get('role')})")
+                            messages.extend(map(_to_api_message, history_without_current))
+                            # 添加当前用户输入
+                            messages.append({"role": "user", "content": text})
+                    else:
+                        # 历史记录不足，按正常流程处理
+                        logger.warning(f"⚠️ 上下文重置失败：历史记录不足 (len={len(history_without_current) if history_without_current else 0})")
+                        if history_without_current:
+                            messages.extend(map(_to_api_message, history_without_current))
+                        messages.append({"role": "user", "content": text})
+                else:
+                    # 不到5轮，正常添加历史（Gemma 模型限制为最多8条，即4轮对话）
+                    max_history = 8  # Gemma 模型最多保留 4 轮对话（8条消息）
+                    recent_history = conversation_history[-max_history:]
+        
+                    # ✅ 确保第一条消息是 user（保持对话配对完整性）
+                    while recent_history and recent_history[0].get("role") != "user":
+                        recent_history = recent_history[1:]
+                        logger.warning(f"⚠️ Gemma模型{log_tag}：跳过开头的非user消息，确保对话配对完整")
+        
+                    messages.extend(map(_to_api_message, recent_history))
+                    logger.info(f"📝 Gemma模型{log_tag}正常对话: 使用最近 {len(recent_history)} 条历史记录（最多4轮）")
+            else:
+                # 非 Gemma 模型，正常处理（应用 max_history 限制）
+                recent_history = self._recent_history(conversation_history)
+                messages.extend(self._summary_messages(conversation_history, len(recent_history)))
+                messages.extend(map(_to_api_message, recent_history))
+        else:
+            # 没有历史记录，直接添加新消息
+            messages.append({"role": "user", "content": text})
+        
+        # 调试日志：记录最终发送给 LLM 的消息列表
+        logger.info(f"📤 准备发送给 LLM 的消息数量{log_tag}: {len(messages)}")
+        for i, msg in enumerate(messages):
+            logger.opt(lazy=True).debug(
+                "  消息 {}: role={}, content={}...",
+                lambda i=i: i + 1,
+                lambda msg=msg: msg.get('role', 'unknown'),
+                lambda msg=msg: msg.get('content', '')[:50]
+            )
+        
+        # 检测用户输入的语言（中英文混合时使用界面语言）
+        detected_lang = detect_language(text, ui_language)
+        
+        # 根据检测到的语言，换成带强制语言指令的预构建系统消息
+        if messages and messages[0] is self._system_msg:
+            messages[0] = self._system_msgs["en" if detected_lang == "en" else "zh"]
+            logger.info(f"🌐 检测到用户语言: {detected_lang}, 已添加语言匹配指令")
+        
+        return messages, detected_lang
     
     async def stream_response_with_search(
         self, 
@@ -143,7 +793,8 @@ class OpenAIHandler(BaseHandler):
         momo_search_quality: str = "speed",  # "speed" 或 "quality"
         progress_callback = None,
         search_results_callback = None,
-        ui_language: str = "zh"  # 界面语言
+        ui_language: str = "zh",  # 界面语言
+        cancel_event: Optional[asyncio.Event] = None
     ) -> AsyncGenerator[str, None]:
         """
         Generate streaming response with optional web search
@@ -157,137 +808,14 @@ class OpenAIHandler(BaseHandler):
             momo_search_handler: MomoSearchHandler instance (高级搜索)
             momo_search_quality: Momo搜索质量 ("speed" 或 "quality")
             progress_callback: Callback for search progress (step, total, message)
+            cancel_event: 被设置时立即停止生成并关闭流（停止按钮 / 用户打断）
         """
         try:
-            # Prepare messages
-            messages = [{"role": "system", "content": self.system_prompt}]
-            
-            if conversation_history:
-                # Gemma 模型特殊处理：每5轮对话重置一次上下文
-                # 注意：必须先判断是否需要重置（基于完整历史），再应用 max_history 截断
-                if 'gemma' in self.model.lower():
-                    # conversation_history 中最后一条是当前用户输入（已经在 session_manager 中添加）
-                    # 所以要排除它来计算之前的对话轮数
-                    history_without_current = conversation_history[:-1] if conversation_history and conversation_history[-1].get("role") == "user" else conversation_history
-                    user_messages = [m for m in history_without_current if m["role"] == "user"] if history_without_current else []
-                    
-                    logger.info(f"📊 Gemma模型(搜索模式)对话统计: 完整历史={len(conversation_history) if conversation_history else 0}条, 用户消息={len(user_messages)}条")
-                    
-                    # 判断是否需要重置（第5轮之后，即第6、11、16轮...）
-                    if len(user_messages) >= 5 and len(user_messages) % 5 == 0:
-                        logger.info(f"🔄 Gemma模型(搜索模式)检测到第 {len(user_messages)+1} 轮对话，执行上下文重置")
-                        
-                        # 从 history_without_current 中取最后2条消息（上一轮对话）
-                        if history_without_current and len(history_without_current) >= 2:
-                            last_user_msg = history_without_current[-2]  # 上一轮的user消息
-                            last_assistant_msg = history_without_current[-1]  # 上一轮的assistant回复
-                            
-                            # 验证格式正确
-                            if last_user_msg["role"] == "user" and last_assistant_msg["role"] == "assistant":
-                                # 合并上一轮对话和新消息作为新的第一轮
-                                merged_content = f"之前的对话：\n用户: {last_user_msg['content']}\n助手: {last_assistant_msg['content']}\n\n当前问题: {text}"
-                                messages.append({"role": "user", "content": merged_content})
-                                logger.info(f"✅ 重置上下文，只保留上一轮(user:{len(last_user_msg['content'])}字 + assistant:{len(last_assistant_msg['content'])}字) + 新消息({len(text) if text else 0}字)")
-                            else:
-                                # 格式不对，说明历史记录异常，按正常流程处理（但排除当前输入，因为后面会统一添加）
-                                logger.warning(f"⚠️ 上下文重置失败：历史记录格式不正确 (last_user_msg role={last_user_msg.get('role')}, last_assistant_msg role={last_assistant_msg.get('role')})")
-                                for msg in history_without_current:
-                                    messages.append({
-                                        "role": msg["role"],
-                                        "content": msg["content"]
-                                    })
-                                # 添加当前用户输入
-                                messages.append({"role": "user", "content": text})
-                        else:
-                            # 历史记录不足，按正常流程处理
-                            logger.warning(f"⚠️ 上下文重置失败：历史记录不足 (len={len(history_without_current) if history_without_current else 0})")
-                            if history_without_current:
-                                for msg in history_without_current:
-                                    messages.append({
-                                        "role": msg["role"],
-                                        "content": msg["content"]
-                                    })
-                            messages.append({"role": "user", "content": text})
-                    else:
-                        # 不到5轮，正常添加历史（Gemma 模型限制为最多8条，即4轮对话）
-                        max_history = 8  # Gemma 模型最多保留 4 轮对话（8条消息）
-                        recent_history = conversation_history[-max_history:]
-                        
-                        # ✅ 确保第一条消息是 user（保持对话配对完整性）
-                        while recent_history and recent_history[0].get("role") != "user":
-                            recent_history = recent_history[1:]
-                            logger.warning(f"⚠️ Gemma模型(搜索模式)：跳过开头的非user消息，确保对话配对完整")
-                        
-                        for msg in recent_history:
-                            messages.append({
-                                "role": msg["role"],
-                                "content": msg["content"]
-                            })
-                        logger.info(f"📝 Gemma模型(搜索模式)正常对话: 使用最近 {len(recent_history)} 条历史记录（最多4轮）")
-                else:
-                    # 非 Gemma 模型，正常处理（应用 max_history 限制）
-                    max_history = self.config.get("max_history", 10)
-                    recent_history = conversation_history[-max_history:]
-                    for msg in recent_history:
-                        messages.append({
-                            "role": msg["role"],
-                            "content": msg["content"]
-                        })
-            else:
-                # 没有历史记录，直接添加新消息
-                messages.append({"role": "user", "content": text})
-            
-            # 调试日志：记录最终发送给 LLM 的消息列表（搜索前）
-            logger.info(f"📤 准备发送给 LLM 的消息数量（搜索前）: {len(messages)}")
-            for i, msg in enumerate(messages):
-                role = msg.get('role', 'unknown')
-                content_preview = msg.get('content', '')[:50]
-                logger.debug(f"  消息 {i+1}: role={role}, content={content_preview}...")
-            
-            # 检测用户输入的语言并添加强制语言匹配指令
-            def detect_language(text: str, ui_language: str = "zh") -> str:
-                """简单检测文本主要语言
-                
-                Args:
-                    text: 用户输入文本
-                    ui_language: 界面语言 ("zh" 或 "en")
-                
-                Returns:
-                    "zh" 或 "en"
-                """
-                # 统计中文字符数量
-                chinese_chars = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
-                # 统计英文字母数量
-                english_chars = sum(1 for char in text if char.isalpha() and ord(char) < 128)
-                
-                # ✅ 修复：如果同时包含中文和英文，使用界面语言
-                if chinese_chars > 0 and english_chars > 0:
-                    logger.info(f"🌐 检测到中英文混合输入，使用界面语言: {ui_language}")
-                    return ui_language
-                
-                # 如果只有中文或只有英文，按原有逻辑判断
-                if chinese_chars > english_chars:
-                    return "zh"
-                elif english_chars > 0:
-                    return "en"
-                else:
-                    return ui_language  # 默认使用界面语言
-            
-            detected_lang = detect_language(text, ui_language)
-            
-            # 根据检测到的语言，在系统提示词中添加强制语言指令
-            if detected_lang == "en":
-                language_instruction = "\n\n🔴 CRITICAL INSTRUCTION: The user's message is in ENGLISH. You MUST respond ENTIRELY in ENGLISH. DO NOT use Chinese characters in your response. This is mandatory."
-            else:
-                language_instruction = "\n\n🔴 重要指令：用户的消息是中文。你必须完全用中文回答。不要在回答中使用英文。这是强制要求。"
-            
-            # 将语言指令添加到第一条系统消息中
-            if messages and messages[0].get("role") == "system":
-                messages[0]["content"] += language_instruction
-                logger.info(f"🌐 检测到用户语言: {detected_lang}, 已添加语言匹配指令")
+            messages, detected_lang = self._build_messages(text, conversation_history, ui_language, "(搜索模式)")
             
             # 如果启用搜索
             citations_text = ""  # 用于存储引用信息
+            search_context_msg = None  # 搜索上下文消息，最终放在当前用户消息之前
             
             if use_search:
                 # 高级搜索模式 (Momo Search)
@@ -320,7 +848,7 @@ class OpenAIHandler(BaseHandler):
                         logger.info(f"{'*'*80}\n")
                         
                         # 使用思考链构建深度思考的 Prompt
-                        from backend.handlers.llm.thinking_chain import build_enhanced_search_prompt
+                        from backend.handlers.llm.thinking_chain import build_enhanced_search_prompt, DEFAULT_CONTEXT_TOKENS
                         
                         # 根据搜索质量模式决定是否使用思考链
                         # quality（深度）模式：使用思考链，进行深度思考
@@ -332,24 +860,26 @@ class OpenAIHandler(BaseHandler):
                             thinking_prompt = build_enhanced_search_prompt(
                                 user_query=text,
                                 search_results=relevant_docs,
-                                current_date=cur_date,
                                 use_thinking_chain=True,
                                 thinking_results=thinking_results,
-                                ui_language=ui_language
+                                ui_language=ui_language,
+                                max_context_tokens=self.config.get("search_context_tokens", DEFAULT_CONTEXT_TOKENS)
                             )
                             context = thinking_prompt
                         else:
                             # 快速模式：使用简单 Prompt
                             logger.info(f"⚡ [快速模式] 使用简单模式生成回答 (质量: {momo_search_quality})")
                             context = f"# 以下内容是基于用户发送的消息的搜索结果（今天是{cur_date}）:\n\n"
-                        
-                        for i, doc in enumerate(relevant_docs, 1):
-                            context += f"[网页 {i} 开始]\n"
-                            context += f"标题: {doc.title}\n"
-                            context += f"链接: {doc.url}\n"
-                            content_text = doc.content if doc.content else doc.snippet
-                            context += f"内容: {content_text}\n"
-                            context += f"[网页 {i} 结束]\n\n"
+                            
+                            # 思考链 Prompt 已经按 token 预算内嵌了参考资料（编号一致），
+                            # 只有快速模式需要在这里附上网页内容，避免同一份资料发送两遍
+                            for i, doc in enumerate(relevant_docs, 1):
+                                context += f"[网页 {i} 开始]\n"
+                                context += f"标题: {doc.title}\n"
+                                context += f"链接: {doc.url}\n"
+                                content_text = doc.content if doc.content else doc.snippet
+                                context += f"内容: {content_text}\n"
+                                context += f"[网页 {i} 结束]\n\n"
                         
                         # 根据检测到的语言添加强制语言指令
                         if detected_lang == "en":
@@ -373,11 +903,7 @@ class OpenAIHandler(BaseHandler):
                         # 保存引用信息，稍后添加到响应中
                         citations_text = citations
                         
-                        # 将搜索结果插入到用户消息之前
-                        messages.insert(-1, {
-                            'role': 'system',
-                            'content': context
-                        })
+                        search_context_msg = {'role': 'system', 'content': context}
                         
                         logger.info(f"📝 搜索上下文已构建 (长度: {len(context)}, 思考链: {use_thinking_chain})")
                         
@@ -424,11 +950,7 @@ class OpenAIHandler(BaseHandler):
                         
                         context += "\n请基于以上搜索结果回答用户的问题。"
                         
-                        # 将搜索结果插入到用户消息之前
-                        messages.insert(-1, {
-                            'role': 'system',
-                            'content': context
-                        })
+                        search_context_msg = {'role': 'system', 'content': context}
                         
                         # 详细记录
                         logger.info(f"📝 简单搜索上下文已注入")
@@ -436,22 +958,39 @@ class OpenAIHandler(BaseHandler):
                     else:
                         logger.warning(f"⚠️ 搜索未返回任何结果，将不使用搜索上下文")
             
-            # 继续正常的流式响应
-            async for chunk in self._stream_response_internal(messages):
+            # 将搜索上下文放到当前用户消息之前（只在尾部 pop/append，不整体移动列表）
+            if search_context_msg:
+                user_msg = messages.pop()
+                messages.append(search_context_msg)
+                messages.append(user_msg)
+            
+            # 继续正常的流式响应（流中途超时放弃时最后一段是错误提示）
+            stream_failed = False
+            async for chunk in self._stream_response_internal(messages, cancel_event):
+                stream_failed = chunk is _ERR_RESPONSE
                 yield chunk
             
-            # 如果有引用信息，在响应结束后添加
-            if citations_text:
+            if cancel_event and cancel_event.is_set():
+                return
+            
+            # 如果有引用信息，在响应正常结束后添加（不挂在错误提示下面）
+            if citations_text and not stream_failed:
                 yield f"\n\n**📚 参考来源：**\n{citations_text}"
                 
         except Exception as e:
             logger.error(f"Failed to stream response with search: {e}")
-            import traceback
             logger.error(traceback.format_exc())
-            yield "抱歉，我遇到了一些技术问题，请稍后再试。"
+            yield _ERR_RESPONSE
     
-    async def _stream_response_internal(self, messages: List[Dict]) -> AsyncGenerator[str, None]:
+    async def _stream_response_internal(
+        self,
+        messages: List[Dict],
+        cancel_event: Optional[asyncio.Event] = None,
+        max_tokens: Optional[int] = None
+    ) -> AsyncGenerator[str, None]:
         """Internal method for streaming response"""
+        if max_tokens is None:
+            max_tokens = self.max_tokens
         
         # 计算输入的 token 数量（简单估算：中文按2字符/token，英文按4字符/token）
         total_chars = sum(len(msg.get('content', '')) for msg in messages)
@@ -459,53 +998,110 @@ class OpenAIHandler(BaseHandler):
         
         logger.info(f"{'='*60}")
         logger.info(f"Starting LLM stream request")
-        logger.info(f"  Model: {self.model}")
-        logger.info(f"  Base URL: {self.api_url}")
         logger.info(f"  Messages count: {len(messages)}")
         logger.info(f"  Total characters: {total_chars}")
         logger.info(f"  Estimated input tokens: ~{estimated_tokens}")
-        logger.info(f"  Temperature: {self.temperature}")
-        logger.info(f"  Max tokens: {self.max_tokens}")
+        logger.info(f"  Max tokens: {max_tokens}")
         
-        # 记录每条消息的详细信息
+        # 每条消息的详细信息只在 DEBUG 级别生效时才格式化（lazy）
         for i, msg in enumerate(messages):
-            role = msg.get('role', 'unknown')
-            content = msg.get('content', '')
-            content_preview = content[:100] + ('...' if len(content) > 100 else '')
-            logger.info(f"  Message {i+1} [{role}]: {len(content)} chars - {content_preview}")
+            logger.opt(lazy=True).debug(
+                "  Message {} [{}]: {} chars - {}",
+                lambda i=i: i + 1,
+                lambda msg=msg: msg.get('role', 'unknown'),
+                lambda msg=msg: len(msg.get('content', '')),
+                lambda msg=msg: msg.get('content', '')[:100]
+            )
         
         logger.info(f"{'='*60}")
         
         # 如果输入过长，记录完整的 messages（用于调试）
         if total_chars > 500:
-            logger.warning(f"⚠️  Large input detected ({total_chars} chars), logging full messages for debugging:")
-            import json
+            logger.warning(f"⚠️  Large input detected ({total_chars} chars), full messages are logged at DEBUG level")
             for i, msg in enumerate(messages):
-                logger.debug(f"Message {i+1} full content:\n{json.dumps(msg, ensure_ascii=False, indent=2)}")
+                logger.opt(lazy=True).debug(
+                    "Message {} full content:\n{}",
+                    lambda i=i: i + 1,
+                    lambda msg=msg: orjson.dumps(msg, option=orjson.OPT_INDENT_2).decode("utf-8")
+                )
         
         try:
             stream = await self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                stream=True,
-                timeout=30.0  # 添加超时防止挂起
+                max_tokens=max_tokens,
+                stream=True
             )
             logger.info(f"✅ Stream object created successfully: {type(stream)}")
         except Exception as e:
             logger.error(f"❌ Failed to create stream: {e}")
-            import traceback
             logger.error(traceback.format_exc())
             raise
 
         chunk_count = 0
         content_chunks = 0
         total_content_length = 0
+        last_finish_reason = None
         logger.info("🔄 Entering async for loop to receive chunks...")
         
+        # 逐 chunk 空闲超时：服务端在流中途卡住时尽快放弃，而不是等满整个请求超时；
+        # 首个内容片段前的等待包含整个 prompt 的预填充（质量模式上下文很长），单独使用更宽松的超时
+        idle_timeout = self.config.get("chunk_idle_timeout", 10.0)
+        first_chunk_timeout = self.config.get("first_chunk_timeout", 30.0)
+        
+        # 小片段合并后再输出：按时间窗口 / 字符数 / 句末标点刷新，减少下游（TTS、websocket）的逐 token 协程跳转
+        flush_interval = self.config.get("stream_flush_ms", 30) / 1000
+        flush_chars = self.config.get("stream_flush_chars", 32)
+        
+        loop = asyncio.get_running_loop()
+        buf: List[str] = []
+        buf_len = 0
+        flush_deadline = 0.0
+        last_chunk_at = loop.time()
+        # 用独立 Task 读取下一个 chunk：刷新计时到期时不取消正在进行的读取
+        next_chunk = asyncio.ensure_future(stream.__anext__())
+        # 取消信号与读取一起等待，用户打断时无需等到下一个 chunk 到达
+        cancel_waiter = asyncio.ensure_future(cancel_event.wait()) if cancel_event else None
+        
         try:
-            async for chunk in stream:
+            while True:
+                now = loop.time()
+                current_timeout = idle_timeout if content_chunks else first_chunk_timeout
+                wait_timeout = last_chunk_at + current_timeout - now
+                if buf:
+                    wait_timeout = min(wait_timeout, flush_deadline - now)
+                waiters = {next_chunk, cancel_waiter} if cancel_waiter else {next_chunk}
+                done, _ = await asyncio.wait(
+                    waiters, timeout=max(wait_timeout, 0), return_when=asyncio.FIRST_COMPLETED
+                )
+                
+                if cancel_event and cancel_event.is_set():
+                    logger.info(f"🛑 Stream cancelled by caller after {chunk_count} chunks, closing connection")
+                    break
+                
+                if not done:
+                    if buf and loop.time() >= flush_deadline:
+                        yield "".join(buf)
+                        buf.clear()
+                        buf_len = 0
+                        continue
+                    logger.error(f"❌ Stream idle for {current_timeout}s after {chunk_count} chunks, aborting")
+                    next_chunk.cancel()
+                    await stream.close()
+                    if buf:
+                        yield "".join(buf)
+                        buf.clear()
+                    yield _ERR_RESPONSE
+                    break
+                
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                last_chunk_at = loop.time()
+                next_chunk = asyncio.ensure_future(stream.__anext__())
+                
                 chunk_count += 1
                 
                 # 记录第一个 chunk 的完整内容以便调试
@@ -515,13 +1111,14 @@ class OpenAIHandler(BaseHandler):
                     logger.info(f"   Has choices: {hasattr(chunk, 'choices')}")
                     if hasattr(chunk, 'choices'):
                         logger.info(f"   Choices count: {len(chunk.choices) if chunk.choices else 0}")
-                    logger.info(f"   Raw chunk: {chunk}")
+                    logger.opt(lazy=True).debug("   Raw chunk: {}", lambda: repr(chunk))
                 
                 if chunk.choices and len(chunk.choices) > 0:
                     choice = chunk.choices[0]
                     
                     # 检查是否有 finish_reason
                     if hasattr(choice, 'finish_reason') and choice.finish_reason:
+                        last_finish_reason = choice.finish_reason
                         logger.info(f"🏁 Stream finished with reason: {choice.finish_reason}")
                     
                     delta = choice.delta
@@ -533,19 +1130,40 @@ class OpenAIHandler(BaseHandler):
                         if content_chunks == 1:
                             logger.info(f"✨ First content chunk received (chunk #{chunk_count})")
                             logger.info(f"   Content preview: {delta.content[:50]}")
-                        elif content_chunks % 10 == 0:  # 每10个内容chunk记录一次
-                            logger.info(f"📝 Received {content_chunks} content chunks, total {total_content_length} chars")
+                            # 首个内容片段立即输出，不影响首字延迟
+                            yield delta.content
+                            continue
+                        
+                        if not buf:
+                            flush_deadline = last_chunk_at + flush_interval
+                        buf.append(delta.content)
+                        buf_len += content_length
                         
-                        yield delta.content
+                        if buf_len >= flush_chars or delta.content[-1] in _FLUSH_PUNCTUATION:
+                            yield "".join(buf)
+                            buf.clear()
+                            buf_len = 0
+                        
+                        if cancel_event and cancel_event.is_set():
+                            break
                 else:
                     if chunk_count <= 3:  # 只记录前3个空 chunk
                         logger.warning(f"⚠️  Chunk #{chunk_count} has no choices or empty content")
-                        logger.warning(f"   Chunk structure: {chunk}")
+                        logger.opt(lazy=True).debug("   Chunk structure: {}", lambda: repr(chunk))
+            
+            if buf and not (cancel_event and cancel_event.is_set()):
+                yield "".join(buf)
         except Exception as e:
             logger.error(f"Error during stream iteration: {e}")
-            import traceback
             logger.error(traceback.format_exc())
             raise
+        finally:
+            # 消费方提前停止或被取消（如被打断）时，取消预读任务并关闭 HTTP 响应，把连接还给连接池
+            if not next_chunk.done():
+                next_chunk.cancel()
+            if cancel_waiter:
+                cancel_waiter.cancel()
+            await stream.close()
         
         logger.info(f"{'='*60}")
         logger.info(f"LLM stream completed")
@@ -557,7 +1175,11 @@ class OpenAIHandler(BaseHandler):
         if content_chunks == 0:
             logger.error(f"❌ Stream returned 0 content chunks!")
             logger.error(f"   Total chunks received: {chunk_count}")
+            logger.error(f"   Last finish_reason: {last_finish_reason}")
             logger.error(f"   API endpoint: {self.client.base_url}")
+            # 不再额外发起非流式重试：零内容多由鉴权/模型/内容过滤导致，重试同样会失败且使延迟和费用翻倍
+            if chunk_count > 0 and last_finish_reason is None:
+                logger.error(f"   Server is alive but ended the stream without content or finish_reason")
             logger.error(f"   This suggests:")
             logger.error(f"   1. LLM API returned empty response")
             logger.error(f"   2. API may have rate limits or errors")
@@ -568,145 +1190,27 @@ class OpenAIHandler(BaseHandler):
         
         logger.info(f"{'='*60}")
     
-    async def stream_response(self, text: str, conversation_history: List[Dict] = None, ui_language: str = "zh") -> AsyncGenerator[str, None]:
+    async def stream_response(
+        self,
+        text: str,
+        conversation_history: List[Dict] = None,
+        ui_language: str = "zh",
+        cancel_event: Optional[asyncio.Event] = None,
+        max_tokens: Optional[int] = None
+    ) -> AsyncGenerator[str, None]:
         """Generate streaming response (without search)"""
         try:
-            # Prepare messages
-            messages = [{"role": "system", "content": self.system_prompt}]
+            messages, detected_lang = self._build_messages(text, conversation_history, ui_language)
             
-            if conversation_history:
-                # Gemma 模型特殊处理：每5轮对话重置一次上下文
-                # 注意：必须先判断是否需要重置（基于完整历史），再应用 max_history 截断
-                if 'gemma' in self.model.lower():
-                    # conversation_history 中最后一条是当前用户输入（已经在 session_manager 中添加）
-                    # 所以要排除它来计算之前的对话轮数
-                    history_without_current = conversation_history[:-1] if conversation_history and conversation_history[-1].get("role") == "user" else conversation_history
-                    user_messages = [m for m in history_without_current if m["role"] == "user"] if history_without_current else []
-                    
-                    logger.info(f"📊 Gemma模型对话统计: 完整历史={len(conversation_history) if conversation_history else 0}条, 用户消息={len(user_messages)}条")
-                    
-                    # 判断是否需要重置（第5轮之后，即第6、11、16轮...）
-                    if len(user_messages) >= 5 and len(user_messages) % 5 == 0:
-                        logger.info(f"🔄 Gemma模型检测到第 {len(user_messages)+1} 轮对话，执行上下文重置")
-                        
-                        # 从 history_without_current 中取最后2条消息（上一轮对话）
-                        if history_without_current and len(history_without_current) >= 2:
-                            last_user_msg = history_without_current[-2]  # 上一轮的user消息
-                            last_assistant_msg = history_without_current[-1]  # 上一轮的assistant回复
-                            
-                            # 验证格式正确
-                            if last_user_msg["role"] == "user" and last_assistant_msg["role"] == "assistant":
-                                # 合并上一轮对话和新消息作为新的第一轮
-                                merged_content = f"之前的对话：\n用户: {last_user_msg['content']}\n助手: {last_assistant_msg['content']}\n\n当前问题: {text}"
-                                messages.append({"role": "user", "content": merged_content})
-                                logger.info(f"✅ 重置上下文，只保留上一轮(user:{len(last_user_msg['content'])}字 + assistant:{len(last_assistant_msg['content'])}字) + 新消息({len(text) if text else 0}字)")
-                            else:
-                                # 格式不对，说明历史记录异常，按正常流程处理（但排除当前输入，因为后面会统一添加）
-                                logger.warning(f"⚠️ 上下文重置失败：历史记录格式不正确 (last_user_msg role={last_user_msg.get('role')}, last_assistant_msg role={last_assistant_msg.get('role')})")
-                                for msg in history_without_current:
-                                    messages.append({
-                                        "role": msg["role"],
-                                        "content": msg["content"]
-                                    })
-                                # 添加当前用户输入
-                                messages.append({"role": "user", "content": text})
-                        else:
-                            # 历史记录不足，按正常流程处理
-                            logger.warning(f"⚠️ 上下文重置失败：历史记录不足 (len={len(history_without_current) if history_without_current else 0})")
-                            if history_without_current:
-                                for msg in history_without_current:
-                                    messages.append({
-                                        "role": msg["role"],
-                                        "content": msg["content"]
-                                    })
-                            messages.append({"role": "user", "content": text})
-                    else:
-                        # 不到5轮，正常添加历史（Gemma 模型限制为最多8条，即4轮对话）
-                        max_history = 8  # Gemma 模型最多保留 4 轮对话（8条消息）
-                        recent_history = conversation_history[-max_history:]
-                        
-                        # ✅ 确保第一条消息是 user（保持对话配对完整性）
-                        while recent_history and recent_history[0].get("role") != "user":
-                            recent_history = recent_history[1:]
-                            logger.warning(f"⚠️ Gemma模型：跳过开头的非user消息，确保对话配对完整")
-                        
-                        for msg in recent_history:
-                            messages.append({
-                                "role": msg["role"],
-                                "content": msg["content"]
-                            })
-                        logger.info(f"📝 Gemma模型正常对话: 使用最近 {len(recent_history)} 条历史记录（最多4轮）")
-                else:
-                    # 非 Gemma 模型，正常处理（应用 max_history 限制）
-                    max_history = self.config.get("max_history", 10)
-                    recent_history = conversation_history[-max_history:]
-                    for msg in recent_history:
-                        messages.append({
-                            "role": msg["role"],
-                            "content": msg["content"]
-                        })
-            else:
-                # 没有历史记录，直接添加新消息
-                messages.append({"role": "user", "content": text})
-            
-            # 调试日志：记录最终发送给 LLM 的消息列表
-            logger.info(f"📤 准备发送给 LLM 的消息数量: {len(messages)}")
-            for i, msg in enumerate(messages):
-                role = msg.get('role', 'unknown')
-                content_preview = msg.get('content', '')[:50]
-                logger.debug(f"  消息 {i+1}: role={role}, content={content_preview}...")
-            
-            # 检测用户输入的语言并添加强制语言匹配指令
-            def detect_language(text: str, ui_language: str = "zh") -> str:
-                """简单检测文本主要语言
-                
-                Args:
-                    text: 用户输入文本
-                    ui_language: 界面语言 ("zh" 或 "en")
-                
-                Returns:
-                    "zh" 或 "en"
-                """
-                # 统计中文字符数量
-                chinese_chars = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
-                # 统计英文字母数量
-                english_chars = sum(1 for char in text if char.isalpha() and ord(char) < 128)
-                
-                # ✅ 修复：如果同时包含中文和英文，使用界面语言
-                if chinese_chars > 0 and english_chars > 0:
-                    logger.info(f"🌐 检测到中英文混合输入，使用界面语言: {ui_language}")
-                    return ui_language
-                
-                # 如果只有中文或只有英文，按原有逻辑判断
-                if chinese_chars > english_chars:
-                    return "zh"
-                elif english_chars > 0:
-                    return "en"
-                else:
-                    return ui_language  # 默认使用界面语言
-            
-            detected_lang = detect_language(text, ui_language)
-            
-            # 根据检测到的语言，在系统提示词中添加强制语言指令
-            if detected_lang == "en":
-                language_instruction = "\n\n🔴 CRITICAL INSTRUCTION: The user's message is in ENGLISH. You MUST respond ENTIRELY in ENGLISH. DO NOT use Chinese characters in your response. This is mandatory."
-            else:
-                language_instruction = "\n\n🔴 重要指令：用户的消息是中文。你必须完全用中文回答。不要在回答中使用英文。这是强制要求。"
-            
-            # 将语言指令添加到第一条系统消息中
-            if messages and messages[0].get("role") == "system":
-                messages[0]["content"] += language_instruction
-                logger.info(f"🌐 检测到用户语言: {detected_lang}, 已添加语言匹配指令")
-            
-            # Stream response
-            async for chunk in self._stream_response_internal(messages):
+            # Stream response（搜索模式需要基于资料的完整回答，不做自适应限制）
+            max_tokens = self._adaptive_max_tokens(text, max_tokens)
+            async for chunk in self._stream_response_internal(messages, cancel_event, max_tokens):
                 yield chunk
                     
         except Exception as e:
             logger.error(f"Failed to stream response: {e}")
-            import traceback
             logger.error(traceback.format_exc())
-            yield "抱歉，我遇到了一些技术问题，请稍后再试。"
+            yield _ERR_RESPONSE
     
     def update_config(self, config: Dict):
         """Update configuration"""
@@ -716,16 +1220,29 @@ class OpenAIHandler(BaseHandler):
         self.temperature = self.config.get("temperature", self.temperature)
         self.max_tokens = self.config.get("max_tokens", self.max_tokens)
         self.top_p = self.config.get("top_p", self.top_p)
-        self.system_prompt = self.config.get("system_prompt", self.system_prompt)
+        self._max_history = self.config.get("max_history", self._max_history)
+        self._history_token_budget = self.config.get("history_token_budget", self._history_token_budget)
+        if "system_prompt" in config:
+            self.set_system_prompt(config["system_prompt"])
         
         # Update API settings if provided
-        if "api_url" in config:
-            self.api_url = config["api_url"]
-            self.client = AsyncOpenAI(api_key=self.api_key, base_url=self.api_url)
-        
-        if "api_key" in config:
-            self.api_key = config["api_key"]
-            self.client = AsyncOpenAI(api_key=self.api_key, base_url=self.api_url)
+        # 只有 (api_url, api_key) 或连接池配置真正变化时才切换到对应的共享客户端
+        api_url = config.get("api_url", self.api_url)
+        api_key = config.get("api_key", self.api_key)
+        if (api_url, api_key, self._pool_settings()) != self._client_key:
+            self.api_url = api_url
+            self.api_key = api_key
+            # 尚未初始化时由 _setup 按新配置创建
+            if self.client is not None:
+                self.client = self._create_client()
         
         if "model" in config:
             self.model = config["model"]
+    
+    async def cleanup(self):
+        """Release client references (the shared connection pool stays open for other handlers)"""
+        if self._summary_task and not self._summary_task.done():
+            self._summary_task.cancel()
+        self.http_client = None
+        self.client = None
+        await super().cleanup()
@@ -2,94 +2,77 @@
 深度思考链（Thinking Chain）- 使用 LangChain 实现多步骤推理和深度分析
 解决"回答缺乏深度思考，只是搜索结果拼接"的问题
 """
-from typing import List, Dict, Optional, Any
+import heapq
+import os
+import re
+from collections import OrderedDict
+from datetime import date
+from difflib import SequenceMatcher
+from functools import lru_cache
+from typing import List, Dict, Optional, Any, Tuple, Iterator
 from loguru import logger
 
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
 from backend.handlers.search.momo_utils import SearchDocument
+from backend.utils.text_utils import detect_language
 
+# 搜索上下文的默认 token 预算（可通过 build_enhanced_search_prompt 的 max_context_tokens 调整）
+DEFAULT_CONTEXT_TOKENS = 8000
 
-class ThinkingChain:
-    """
-    思考链：通过多步骤推理生成深度思考的回答
-    
-    流程：
-    1. 理解问题：分析用户意图和需求
-    2. 分析资料：批判性分析搜索结果的可靠性和相关性
-    3. 深度思考：进行推理、对比、总结
-    4. 生成回答：综合思考结果生成高质量回答
-    5. 自我审查：检查回答的逻辑性和完整性
-    """
-    
-    def __init__(self):
-        self.enabled = True
-    
-    def build_thinking_prompt(
-        self,
-        user_query: str,
-        search_results: List[SearchDocument],
-        current_date: str,
-        ui_language: str = "zh"
-    ) -> str:
-        """
-        构建要求深度思考的 Prompt
-        
-        Args:
-            user_query: 用户查询
-            search_results: 搜索结果
-            current_date: 当前日期
-            
-        Returns:
-            完整的思考链 Prompt
-        """
-        # 检测用户查询的语言
-        def detect_language(text: str, ui_language: str = "zh") -> str:
-            """检测文本语言，如果中英文混合则使用界面语言"""
-            chinese_chars = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
-            english_chars = sum(1 for char in text if char.isalpha() and ord(char) < 128)
-            
-            # ✅ 修复：如果同时包含中文和英文，使用界面语言
-            if chinese_chars > 0 and english_chars > 0:
-                return ui_language
-            
-            # 如果只有中文或只有英文，按原有逻辑判断
-            return "en" if english_chars > chinese_chars and english_chars > 0 else "zh"
-        
-        detected_lang = detect_language(user_query, ui_language)
-        
-        # 根据检测到的语言添加强制指令
-        if detected_lang == "en":
-            lang_instruction = """
-🔴🔴🔴 CRITICAL MANDATORY INSTRUCTION 🔴🔴🔴
-The user's question is in ENGLISH. You MUST write your ENTIRE response in ENGLISH.
-- All thinking steps: ENGLISH
-- Final answer: ENGLISH
-- Do NOT use any Chinese characters in your response.
-This is a MANDATORY requirement that overrides all other instructions.
-"""
-        else:
-            lang_instruction = """
-🔴🔴🔴 重要强制指令 🔴🔴🔴
-用户的问题是中文。你必须用中文撰写整个回答。
-- 所有思考步骤：中文
-- 最终答案：中文
-- 不要在回答中使用任何英文字符。
-这是强制要求，优先级高于所有其他指令。
-"""
-        
-        # 构建搜索结果上下文
-        search_context = self._build_search_context(search_results)
-        
-        # 构建思考链 Prompt
-        thinking_prompt = f"""{lang_instruction}
+# 精简思考链开关（LIGHTAVATAR_CONCISE_COT=1 时默认使用精简方法论，便于 A/B 对比）
+CONCISE_COT = os.getenv("LIGHTAVATAR_CONCISE_COT", "0") == "1"
 
-# 角色定位
-你是一位具有深度思考能力的AI助手。你的任务不是简单地总结搜索结果，而是要进行深度的分析、推理和思考，为用户提供有价值的见解。
+# 已构建 Prompt 的 LRU 缓存（相同问题 + 相同结果集 + 同一天直接复用）
+_PROMPT_CACHE: "OrderedDict[tuple, str]" = OrderedDict()
+_PROMPT_CACHE_MAX_ENTRIES = 512
 
-# 当前日期
-今天是 {current_date}
+# 已渲染搜索上下文的 LRU 缓存（思考/精简/综合模式对同一结果集共用，去重和装填只做一次）
+_CONTEXT_CACHE: "OrderedDict[tuple, str]" = OrderedDict()
+_CONTEXT_CACHE_MAX_ENTRIES = 128
 
-# 搜索结果
-{search_context}
+# 内容相似度超过该阈值的文档视为重复（转载/聚合站点）
+_DEDUPE_THRESHOLD = 0.8
+
+# 思考步骤提取：一次扫描匹配所有 "## " 小节，捕获整节内容和步骤标签
+_STEP_RE = re.compile(
+    r"^##\s*([^\n]*?(第[一二三四五]步|理解问题|批判性分析|深度思考|综合推理|生成高质量回答).*?)(?=^##\s|\Z)",
+    re.M | re.S
+)
+
+_STEP_KEYS = {
+    "第一步": "understanding", "理解问题": "understanding",
+    "第二步": "analysis", "批判性分析": "analysis",
+    "第三步": "thinking", "深度思考": "thinking",
+    "第四步": "synthesis", "综合推理": "synthesis",
+    "第五步": "final_response", "生成高质量回答": "final_response"
+}
+
+# 只需要域名时，正则匹配比 urlparse 完整解析更快
+_DOMAIN_RE = re.compile(r"https?://([^/?#]+)", re.I)
+
+# 文本 → token 数缓存
+_TOKEN_LEN_CACHE: Dict[str, int] = {}
+_TOKEN_LEN_CACHE_MAX_ENTRIES = 4096
+
+# 按相关性分数保留的最大文档数
+_THINKING_TOP_K = 20
+_SIMPLE_TOP_K = 15
+
+# 截断时优先停在这些句末符号之后
+_SENTENCE_ENDS = "。！？!?.\n"
+
+
+# ==================== 静态 Prompt 前缀 ====================
+# 静态部分（角色 + 方法论 + 格式要求）放在最前面，动态内容（语言、日期、搜索结果、问题）放在最后，
+# 这样每轮请求的长前缀逐字节一致，可以命中服务商的 prompt 前缀缓存
+
+THINKING_STATIC_PREFIX = """# 角色定位
+你是一位具有深度思考能力的AI助手。你的任务不是简单地总结搜索结果，而是要进行深度的分析、推理和思考，为用户提供有价值的见解。
 
 # 思考流程（请严格按照以下步骤进行思考）
 
@@ -147,6 +130,97 @@ This is a MANDATORY requirement that overrides all other instructions.
 - 如果问题需要解释，请提供深入的解释和背景
 - 始终记住：你是在分享**经过思考的见解**，而不是在**转述搜索结果**
 - **重要：回答语言必须与用户问题语言完全一致**
+"""
+
+# 精简版方法论：保留五步骨架，只保留影响正确性的格式规则（引用格式、语言匹配）
+THINKING_CONCISE_PREFIX = """# 角色定位
+你是一位具有深度思考能力的AI助手，基于搜索结果进行分析和推理，而不是简单罗列。
+
+# 思考流程
+1.理解 2.分析 3.推理 4.综合 5.回答
+
+# 回答要求
+- **引用资料**：在适当位置使用 [citation:X] 格式引用来源
+- **语言匹配**：**必须使用与用户问题相同的语言回答**。如果用户用英语提问，必须用英语回答；如果用户用中文提问，必须用中文回答。这一点至关重要！
+"""
+
+SYNTHESIS_STATIC_PREFIX = """# 角色定位
+你是一位具有深度思考能力的AI助手。你的任务是基于前面的思考和分析，综合信息并生成高质量的回答。
+
+# 任务：综合信息，生成高质量回答
+
+请基于下方的搜索结果和思考过程，生成回答。要求：
+
+1. **综合前面的思考**：整合问题理解、资料分析和深度思考的结果
+2. **提供有价值的洞察**：不仅仅是事实陈述，要提供经过思考的见解
+3. **逻辑清晰**：结构合理，条理分明
+4. **引用资料**：在适当位置使用 [citation:X] 格式引用来源
+5. **语言自然**：回答应该流畅、专业，像专家在分享见解
+
+**回答格式要求：**
+- 如果问题需要对比分析，请提供清晰的对比框架
+- 如果问题需要建议，请提供有依据的建议
+- 如果问题需要解释，请提供深入的解释和背景
+- 始终记住：你是在分享**经过深度思考的见解**，而不是在**转述搜索结果**
+"""
+
+REFLECTION_STATIC_PREFIX = """# 自我审查任务
+请对下方的回答进行自我审查，确保质量。
+
+## 审查要点
+1. **逻辑性**：回答的逻辑是否清晰？推理是否合理？
+2. **完整性**：是否充分回答了用户的问题？
+3. **深度**：是否有足够的深度思考，还是只是表面信息的拼接？
+4. **准确性**：引用是否正确？信息是否准确？
+5. **价值**：是否提供了有价值的见解，而不仅仅是事实陈述？
+
+## 改进建议
+如果发现任何问题，请提供改进后的回答。如果回答已经很好，请说明为什么。
+"""
+
+# 语言强制指令（按检测到的语言选择）
+THINKING_LANG_INSTRUCTIONS = {
+    "en": """
+🔴🔴🔴 CRITICAL MANDATORY INSTRUCTION 🔴🔴🔴
+The user's question is in ENGLISH. You MUST write your ENTIRE response in ENGLISH.
+- All thinking steps: ENGLISH
+- Final answer: ENGLISH
+- Do NOT use any Chinese characters in your response.
+This is a MANDATORY requirement that overrides all other instructions.
+""",
+    "zh": """
+🔴🔴🔴 重要强制指令 🔴🔴🔴
+用户的问题是中文。你必须用中文撰写整个回答。
+- 所有思考步骤：中文
+- 最终答案：中文
+- 不要在回答中使用任何英文字符。
+这是强制要求，优先级高于所有其他指令。
+"""
+}
+
+SYNTHESIS_LANG_INSTRUCTIONS = {
+    "en": """
+🔴🔴🔴 CRITICAL MANDATORY INSTRUCTION 🔴🔴🔴
+The user's question is in ENGLISH. You MUST write your ENTIRE response in ENGLISH.
+Do NOT use any Chinese characters in your response.
+This is a MANDATORY requirement that overrides all other instructions.
+""",
+    "zh": """
+🔴🔴🔴 重要强制指令 🔴🔴🔴
+用户的问题是中文。你必须用中文撰写整个回答。
+不要在回答中使用任何英文字符。
+这是强制要求，优先级高于所有其他指令。
+"""
+}
+
+# 完整模板在导入时构建一次，每次调用只做变量替换（按模式查表）
+_THINKING_SUFFIX = """
+{lang_instruction}
+# 当前日期
+今天是 {current_date}
+
+# 搜索结果
+{search_context}
 
 # 用户问题
 {user_query}
@@ -154,49 +228,357 @@ This is a MANDATORY requirement that overrides all other instructions.
 ---
 
 **现在，请按照上述五个步骤进行思考，然后生成高质量的回答。**"""
+
+_PROMPTS = {
+    "thinking": THINKING_STATIC_PREFIX + _THINKING_SUFFIX,
+    "thinking_concise": THINKING_CONCISE_PREFIX + _THINKING_SUFFIX,
+    "synthesis": SYNTHESIS_STATIC_PREFIX + """
+{lang_instruction}
+# 当前日期
+今天是 {current_date}
+
+# 搜索结果
+{search_context}
+
+# 前面的思考过程
+
+## 问题理解
+{understanding}
+
+## 资料分析
+{analysis}
+
+## 深度思考
+{thinking}
+
+# 用户问题
+{user_query}
+
+---
+
+**现在，请基于以上所有信息，生成高质量的回答。**""",
+    "reflection": REFLECTION_STATIC_PREFIX + """
+## 原始问题
+{original_query}
+
+## 生成的回答
+{generated_response}"""
+}
+
+
+class _SafeDict(dict):
+    """缺失的占位符原样保留，而不是抛出 KeyError"""
+    
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+def render_prompt(mode: str, **kwargs) -> str:
+    """
+    按模式渲染 Prompt 模板
+    
+    Args:
+        mode: thinking / thinking_concise / synthesis / reflection
+        **kwargs: 模板变量
+        
+    Returns:
+        渲染后的 Prompt
+    """
+    return _PROMPTS[mode].format_map(_SafeDict(kwargs))
+
+
+@lru_cache(maxsize=1024)
+def _url_domain(url: str) -> str:
+    """提取 URL 的域名（按 URL 缓存，思考/综合/反思多次构建 Prompt 时只解析一次）"""
+    m = _DOMAIN_RE.match(url)
+    return m.group(1) if m else ""
+
+
+@lru_cache(maxsize=1)
+def _get_encoder():
+    """懒加载 tiktoken 编码器，不可用时返回 None（改用字符数估算）"""
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"⚠️ tiktoken 编码器加载失败，搜索上下文改用字符数估算: {e}")
+        return None
+
+
+def _count_tokens_batch(texts: List[str]) -> List[int]:
+    """
+    批量计算 token 数（按内容缓存，思考→综合多次构建时同一文档只编码一次）
+    
+    未缓存的文本通过 encode_batch 一次性编码，由 tiktoken 的线程池并行处理。
+    """
+    missing = [t for t in dict.fromkeys(texts) if t not in _TOKEN_LEN_CACHE]
+    if missing:
+        if len(_TOKEN_LEN_CACHE) + len(missing) > _TOKEN_LEN_CACHE_MAX_ENTRIES:
+            _TOKEN_LEN_CACHE.clear()
+        
+        encoder = _get_encoder()
+        lengths = None
+        if encoder is not None:
+            try:
+                # 网页内容可能包含 <|endoftext|> 等特殊 token 文本，按普通文本计数
+                lengths = [
+                    len(ids) for ids in
+                    encoder.encode_batch(missing, num_threads=os.cpu_count() or 1, disallowed_special=())
+                ]
+            except Exception as e:
+                logger.warning(f"⚠️ tiktoken 编码失败，改用字符数估算: {e}")
+        if lengths is None:
+            lengths = [int(len(t) * 0.6) for t in missing]
+        _TOKEN_LEN_CACHE.update(zip(missing, lengths))
+    
+    return [_TOKEN_LEN_CACHE[t] for t in texts]
+
+
+def _count_tokens(text: str) -> int:
+    """计算单个文本的 token 数"""
+    return _count_tokens_batch([text])[0]
+
+
+def _shingles(text: str, k: int = 5) -> set:
+    """文本的 k-shingle 集合"""
+    return {text[i:i + k] for i in range(max(len(text) - k + 1, 1))}
+
+
+def _dedupe_docs(search_results: List[SearchDocument]) -> List[Tuple[int, SearchDocument]]:
+    """
+    去除内容重复/近似重复的文档（保留排在前面的文档）
+    
+    结果较少时用 SequenceMatcher 直接比较前 500 字；结果较多时改用 5-shingle 的 Jaccard 相似度。
+    
+    Returns:
+        (原始序号, 文档) 列表，序号从 1 开始，保证 [citation:X] 与引用列表一致
+    """
+    use_shingles = len(search_results) >= 20
+    kept = []
+    signatures = []
+    
+    for idx, doc in enumerate(search_results, 1):
+        text = (doc.content or doc.snippet)
+        if not text:
+            kept.append((idx, doc))
+            continue
+        
+        if use_shingles:
+            sig = _shingles(text[:2000].lower())
+            duplicate = any(
+                len(sig & other) > _DEDUPE_THRESHOLD * len(sig | other)
+                for other in signatures
+            )
+        else:
+            sig = text[:500]
+            matcher = SequenceMatcher(None, autojunk=False)
+            matcher.set_seq2(sig)
+            duplicate = False
+            for other in signatures:
+                matcher.set_seq1(other)
+                if matcher.quick_ratio() > _DEDUPE_THRESHOLD and matcher.ratio() > _DEDUPE_THRESHOLD:
+                    duplicate = True
+                    break
+        
+        if duplicate:
+            logger.debug(f"🔁 跳过重复资料 {idx}: {doc.url[:60]}")
+            continue
+        
+        kept.append((idx, doc))
+        signatures.append(sig)
+    
+    return kept
+
+
+def _top_docs(pairs: List[Tuple[int, SearchDocument]], k: int) -> List[Tuple[int, SearchDocument]]:
+    """按相关性分数取前 k 个文档（分数相同时保持原顺序），不依赖上游已排序"""
+    return heapq.nlargest(k, pairs, key=lambda pair: pair[1].score)
+
+
+def _pack_by_tokens(
+    search_results: List[Tuple[int, SearchDocument]],
+    budget: int,
+    max_chars: int
+) -> List[Tuple[int, SearchDocument, str]]:
+    """
+    按相关性顺序贪心填充 token 预算
+    
+    Args:
+        search_results: (序号, 文档) 列表（已按相关性排序）
+        budget: 搜索上下文的 token 预算
+        max_chars: 单个文档内容的最大字符数
+        
+    Returns:
+        (序号, 文档, 截断后的内容) 列表；最后一个放不下的文档会在句末处截断
+    """
+    packed = []
+    used = 0
+    
+    # 先一次性批量计算所有标题和内容的 token 数，再做贪心装填
+    contents = [(doc.content or doc.snippet)[:max_chars] for _, doc in search_results]
+    titles = [doc.title for _, doc in search_results]
+    lengths = _count_tokens_batch(titles + contents)
+    n = len(contents)
+    
+    for i, (idx, doc) in enumerate(search_results):
+        content = contents[i]
+        title_tokens = lengths[i]
+        # 标题、来源等头部信息按固定开销估算
+        cost = title_tokens + lengths[n + i] + 16
+        
+        if used + cost <= budget:
+            packed.append((idx, doc, content))
+            used += cost
+            continue
+        
+        # 预算不足：按剩余比例截断最后一个文档，尽量停在句末
+        remaining = budget - used - title_tokens - 16
+        if remaining > 50 and content:
+            cut = content[:len(content) * remaining // cost]
+            end = max(cut.rfind(ch) for ch in _SENTENCE_ENDS)
+            if end > 0:
+                cut = cut[:end + 1]
+            packed.append((idx, doc, cut))
+        break
+    
+    return packed
+
+
+@lru_cache(maxsize=1)
+def _iso_date(day: date) -> str:
+    return day.isoformat()
+
+
+def _today() -> str:
+    """当天日期（固定 YYYY-MM-DD 格式，按天缓存，同一天内 Prompt 前缀逐字节一致）"""
+    return _iso_date(date.today())
+
+
+def _docs_key(search_results: List[SearchDocument]) -> tuple:
+    """
+    结果集标识：(URL, 标题, 内容哈希, 分数)
+    
+    同一 URL 深度爬取后内容变化会生成新 key；上下文按分数挑选和排序文档，分数变化也必须生成新 key
+    """
+    return tuple((doc.url, doc.title, hash(doc.content or doc.snippet), doc.score) for doc in search_results)
+
+
+class ThinkingChain:
+    """
+    思考链：通过多步骤推理生成深度思考的回答
+    
+    流程：
+    1. 理解问题：分析用户意图和需求
+    2. 分析资料：批判性分析搜索结果的可靠性和相关性
+    3. 深度思考：进行推理、对比、总结
+    4. 生成回答：综合思考结果生成高质量回答
+    5. 自我审查：检查回答的逻辑性和完整性
+    """
+    
+    def __init__(self, max_context_tokens: int = DEFAULT_CONTEXT_TOKENS):
+        self.enabled = True
+        self.max_context_tokens = max_context_tokens
+    
+    def build_thinking_prompt(
+        self,
+        user_query: str,
+        search_results: List[SearchDocument],
+        current_date: Optional[str] = None,
+        ui_language: str = "zh",
+        concise: Optional[bool] = None
+    ) -> str:
+        """
+        构建要求深度思考的 Prompt
+        
+        Args:
+            user_query: 用户查询
+            search_results: 搜索结果
+            current_date: 当前日期（None 时使用当天日期）
+            concise: 是否使用精简方法论（None 时取 LIGHTAVATAR_CONCISE_COT）
+            
+        Returns:
+            完整的思考链 Prompt
+        """
+        if concise is None:
+            concise = CONCISE_COT
+        current_date = current_date or _today()
+        
+        detected_lang = detect_language(user_query, ui_language)
+        
+        # 构建搜索结果上下文
+        search_context = self._build_search_context(search_results)
+        
+        # 构建思考链 Prompt：静态前缀在前，动态内容在后
+        if concise:
+            logger.debug(
+                f"🧠 精简思考链: 方法论 {_count_tokens(THINKING_STATIC_PREFIX)} → "
+                f"{_count_tokens(THINKING_CONCISE_PREFIX)} tokens"
+            )
+        thinking_prompt = render_prompt(
+            "thinking_concise" if concise else "thinking",
+            lang_instruction=THINKING_LANG_INSTRUCTIONS["en" if detected_lang == "en" else "zh"],
+            current_date=current_date,
+            search_context=search_context,
+            user_query=user_query
+        )
         
         return thinking_prompt
     
     def _build_search_context(self, search_results: List[SearchDocument]) -> str:
-        """构建搜索结果上下文"""
+        """构建搜索结果上下文（按结果集和 token 预算缓存）"""
         if not search_results:
             return "未找到相关搜索结果。"
         
-        context_parts = []
-        context_parts.append(f"共找到 {len(search_results)} 个相关搜索结果：\n")
+        cache_key = (_docs_key(search_results), self.max_context_tokens)
+        context = _CONTEXT_CACHE.get(cache_key)
+        if context is not None:
+            _CONTEXT_CACHE.move_to_end(cache_key)
+            return context
         
-        for idx, doc in enumerate(search_results[:20], 1):  # 限制前20个结果
-            context_parts.append(f"[参考资料 {idx}]")
-            context_parts.append(f"标题: {doc.title if hasattr(doc, 'title') else 'N/A'}")
-            
-            # 添加来源域名
-            if hasattr(doc, 'url') and doc.url:
-                from urllib.parse import urlparse
-                try:
-                    domain = urlparse(doc.url).netloc
-                    context_parts.append(f"来源: {domain}")
-                except:
-                    context_parts.append(f"来源: 网络资料")
-            
-            # 添加内容
-            content = doc.content if hasattr(doc, 'content') and doc.content else ''
-            if not content and hasattr(doc, 'snippet'):
-                content = doc.snippet
-            
-            if content:
-                # 限制每个文档的内容长度
-                content = content[:1500] if len(content) > 1500 else content
-                context_parts.append(f"内容:\n{content}")
-            
-            context_parts.append("---\n")
+        context = self._render_search_context(search_results)
+        
+        _CONTEXT_CACHE[cache_key] = context
+        if len(_CONTEXT_CACHE) > _CONTEXT_CACHE_MAX_ENTRIES:
+            _CONTEXT_CACHE.popitem(last=False)
         
-        return "\n".join(context_parts)
+        return context
+    
+    def _render_search_context(self, search_results: List[SearchDocument]) -> str:
+        """渲染搜索结果上下文"""
+        return "\n".join(self._iter_search_context(search_results))
+    
+    def build_search_context_parts(self, search_results: List[SearchDocument]) -> List[str]:
+        """
+        按段返回搜索结果上下文（不拼接），供可以逐段消费的调用方使用
+        
+        Returns:
+            [概要行, 参考资料 1, 参考资料 2, ...]，用 "\n" 连接后与 _build_search_context 结果一致
+        """
+        if not search_results:
+            return ["未找到相关搜索结果。"]
+        return list(self._iter_search_context(search_results))
+    
+    def _iter_search_context(self, search_results: List[SearchDocument]) -> Iterator[str]:
+        """逐段生成搜索结果上下文"""
+        yield f"共找到 {len(search_results)} 个相关搜索结果：\n"
+        
+        # 先去掉重复资料（保留原始序号，引用编号不变），避免近似重复的高分文档挤占名额，
+        # 再按相关性取前 20 个，最后按 token 预算装填（每个文档内容最多 1500 字）
+        top = _top_docs(_dedupe_docs(search_results), _THINKING_TOP_K)
+        packed = _pack_by_tokens(top, self.max_context_tokens, 1500)
+        
+        for idx, doc, content in packed:
+            # 每个文档用一个 f-string 拼成一段（来源/内容为空时省略对应行）
+            source = f"\n来源: {_url_domain(doc.url) or '网络资料'}" if doc.url else ""
+            body = f"\n内容:\n{content}" if content else ""
+            yield f"[参考资料 {idx}]\n标题: {doc.title or 'N/A'}{source}{body}\n---\n"
     
     def build_synthesis_prompt(
         self,
         user_query: str,
         search_results: List[SearchDocument],
-        current_date: str,
+        current_date: Optional[str],
         thinking_results: dict,
         ui_language: str = "zh"
     ) -> str:
@@ -206,93 +588,29 @@ This is a MANDATORY requirement that overrides all other instructions.
         Args:
             user_query: 用户查询
             search_results: 搜索结果
-            current_date: 当前日期
+            current_date: 当前日期（None 时使用当天日期）
             thinking_results: 思考结果字典（包含 understanding, analysis, thinking）
             
         Returns:
             综合信息 Prompt
         """
-        # 检测用户查询的语言
-        def detect_language(text: str, ui_language: str = "zh") -> str:
-            """检测文本语言，如果中英文混合则使用界面语言"""
-            chinese_chars = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
-            english_chars = sum(1 for char in text if char.isalpha() and ord(char) < 128)
-            
-            # ✅ 修复：如果同时包含中文和英文，使用界面语言
-            if chinese_chars > 0 and english_chars > 0:
-                return ui_language
-            
-            # 如果只有中文或只有英文，按原有逻辑判断
-            return "en" if english_chars > chinese_chars and english_chars > 0 else "zh"
-        
+        current_date = current_date or _today()
         detected_lang = detect_language(user_query, ui_language)
         
-        # 根据检测到的语言添加强制指令
-        if detected_lang == "en":
-            lang_instruction = """
-🔴🔴🔴 CRITICAL MANDATORY INSTRUCTION 🔴🔴🔴
-The user's question is in ENGLISH. You MUST write your ENTIRE response in ENGLISH.
-Do NOT use any Chinese characters in your response.
-This is a MANDATORY requirement that overrides all other instructions.
-"""
-        else:
-            lang_instruction = """
-🔴🔴🔴 重要强制指令 🔴🔴🔴
-用户的问题是中文。你必须用中文撰写整个回答。
-不要在回答中使用任何英文字符。
-这是强制要求，优先级高于所有其他指令。
-"""
-        
         search_context = self._build_search_context(search_results)
         
-        understanding = thinking_results.get("understanding", "")
-        analysis = thinking_results.get("analysis", "")
-        thinking = thinking_results.get("thinking", "")
-        
-        synthesis_prompt = f"""{lang_instruction}
-
-# 角色定位
-你是一位具有深度思考能力的AI助手。你的任务是基于前面的思考和分析，综合信息并生成高质量的回答。
-
-# 当前日期
-今天是 {current_date}
-
-# 前面的思考过程
-
-## 问题理解
-{understanding if understanding else "（未提供）"}
-
-## 资料分析
-{analysis if analysis else "（未提供）"}
-
-## 深度思考
-{thinking if thinking else "（未提供）"}
-
-# 搜索结果
-{search_context}
-
-# 任务：综合信息，生成高质量回答
-
-请基于以上信息，生成回答。要求：
-
-1. **综合前面的思考**：整合问题理解、资料分析和深度思考的结果
-2. **提供有价值的洞察**：不仅仅是事实陈述，要提供经过思考的见解
-3. **逻辑清晰**：结构合理，条理分明
-4. **引用资料**：在适当位置使用 [citation:X] 格式引用来源
-5. **语言自然**：回答应该流畅、专业，像专家在分享见解
-
-**回答格式要求：**
-- 如果问题需要对比分析，请提供清晰的对比框架
-- 如果问题需要建议，请提供有依据的建议
-- 如果问题需要解释，请提供深入的解释和背景
-- 始终记住：你是在分享**经过深度思考的见解**，而不是在**转述搜索结果**
-
-# 用户问题
-{user_query}
-
----
-
-**现在，请基于以上所有信息，生成高质量的回答。**"""
+        # 静态前缀在前，动态内容在后；搜索结果排在思考过程之前，
+        # 同一结果集的多次请求共享到搜索结果为止的最长前缀
+        synthesis_prompt = render_prompt(
+            "synthesis",
+            lang_instruction=SYNTHESIS_LANG_INSTRUCTIONS["en" if detected_lang == "en" else "zh"],
+            current_date=current_date,
+            understanding=thinking_results.get("understanding") or "（未提供）",
+            analysis=thinking_results.get("analysis") or "（未提供）",
+            thinking=thinking_results.get("thinking") or "（未提供）",
+            search_context=search_context,
+            user_query=user_query
+        )
         
         return synthesis_prompt
     
@@ -313,24 +631,11 @@ This is a MANDATORY requirement that overrides all other instructions.
         Returns:
             反思 Prompt
         """
-        reflection_prompt = f"""# 自我审查任务
-请对以下回答进行自我审查，确保质量：
-
-## 原始问题
-{original_query}
-
-## 生成的回答
-{generated_response}
-
-## 审查要点
-1. **逻辑性**：回答的逻辑是否清晰？推理是否合理？
-2. **完整性**：是否充分回答了用户的问题？
-3. **深度**：是否有足够的深度思考，还是只是表面信息的拼接？
-4. **准确性**：引用是否正确？信息是否准确？
-5. **价值**：是否提供了有价值的见解，而不仅仅是事实陈述？
-
-## 改进建议
-如果发现任何问题，请提供改进后的回答。如果回答已经很好，请说明为什么。"""
+        reflection_prompt = render_prompt(
+            "reflection",
+            original_query=original_query,
+            generated_response=generated_response
+        )
         
         return reflection_prompt
     
@@ -353,19 +658,9 @@ This is a MANDATORY requirement that overrides all other instructions.
         }
         
         # 尝试提取各个步骤（如果 LLM 按照格式回答）
-        # 这里可以根据实际 LLM 输出格式进行调整
-        sections = response.split("## ")
-        for section in sections:
-            if "第一步" in section or "理解问题" in section:
-                steps["understanding"] = section
-            elif "第二步" in section or "批判性分析" in section:
-                steps["analysis"] = section
-            elif "第三步" in section or "深度思考" in section:
-                steps["thinking"] = section
-            elif "第四步" in section or "综合推理" in section:
-                steps["synthesis"] = section
-            elif "第五步" in section or "生成高质量回答" in section:
-                steps["final_response"] = section
+        # 小节标题中出现的步骤标签决定归属，可以根据实际 LLM 输出格式调整 _STEP_RE
+        for match in _STEP_RE.finditer(response):
+            steps[_STEP_KEYS[match.group(2)]] = match.group(1)
         
         return steps
 
@@ -373,10 +668,12 @@ This is a MANDATORY requirement that overrides all other instructions.
 def build_enhanced_search_prompt(
     user_query: str,
     search_results: List[SearchDocument],
-    current_date: str,
+    current_date: Optional[str] = None,
     use_thinking_chain: bool = True,
     thinking_results: Optional[dict] = None,
-    ui_language: str = "zh"
+    ui_language: str = "zh",
+    max_context_tokens: int = DEFAULT_CONTEXT_TOKENS,
+    concise: Optional[bool] = None
 ) -> str:
     """
     构建增强的搜索 Prompt（便捷函数）
@@ -384,41 +681,87 @@ def build_enhanced_search_prompt(
     Args:
         user_query: 用户查询
         search_results: 搜索结果
-        current_date: 当前日期
+        current_date: 当前日期（None 时使用当天日期，调用方无需传入）
         use_thinking_chain: 是否使用思考链
         thinking_results: 思考结果字典（包含 understanding, analysis, thinking）
+        max_context_tokens: 搜索上下文的 token 预算（按目标模型的上下文窗口配置）
+        concise: 是否使用精简思考链（None 时取 LIGHTAVATAR_CONCISE_COT）
         
     Returns:
         完整的 Prompt
     """
+    current_date = current_date or _today()
+    
+    thinking_key = None
+    if thinking_results:
+        thinking_key = (
+            thinking_results.get("understanding"),
+            thinking_results.get("analysis"),
+            thinking_results.get("thinking")
+        )
+    cache_key = (
+        user_query,
+        _docs_key(search_results),
+        current_date,
+        use_thinking_chain,
+        thinking_key,
+        ui_language,
+        max_context_tokens,
+        concise
+    )
+    
+    prompt = _PROMPT_CACHE.get(cache_key)
+    if prompt is not None:
+        _PROMPT_CACHE.move_to_end(cache_key)
+        logger.debug("♻️ 命中搜索 Prompt 缓存")
+        return prompt
+    
+    prompt = _build_enhanced_search_prompt(
+        user_query, search_results, current_date, use_thinking_chain,
+        thinking_results, ui_language, max_context_tokens, concise
+    )
+    
+    _PROMPT_CACHE[cache_key] = prompt
+    if len(_PROMPT_CACHE) > _PROMPT_CACHE_MAX_ENTRIES:
+        _PROMPT_CACHE.popitem(last=False)
+    
+    return prompt
+
+
+def _build_enhanced_search_prompt(
+    user_query: str,
+    search_results: List[SearchDocument],
+    current_date: str,
+    use_thinking_chain: bool,
+    thinking_results: Optional[dict],
+    ui_language: str,
+    max_context_tokens: int,
+    concise: Optional[bool]
+) -> str:
+    """实际构建增强搜索 Prompt（不经过缓存）"""
     if use_thinking_chain:
-        chain = ThinkingChain()
+        chain = ThinkingChain(max_context_tokens)
         # 如果有思考结果，使用综合信息模式
         if thinking_results and (thinking_results.get("understanding") or thinking_results.get("analysis") or thinking_results.get("thinking")):
             return chain.build_synthesis_prompt(user_query, search_results, current_date, thinking_results, ui_language)
         else:
             # 否则使用原来的思考链模式
-            return chain.build_thinking_prompt(user_query, search_results, current_date, ui_language)
+            return chain.build_thinking_prompt(user_query, search_results, current_date, ui_language, concise)
     else:
         # 回退到简单模式（向后兼容）
-        return _build_simple_prompt(user_query, search_results, current_date)
+        return _build_simple_prompt(user_query, search_results, current_date, max_context_tokens, ui_language)
 
 
 def _build_simple_prompt(
     user_query: str,
     search_results: List[SearchDocument],
-    current_date: str
+    current_date: str,
+    max_context_tokens: int = DEFAULT_CONTEXT_TOKENS,
+    ui_language: str = "zh"
 ) -> str:
     """构建简单的 Prompt（向后兼容）"""
-    from urllib.parse import urlparse
-    
     # 检测用户查询的语言
-    def detect_language(text: str) -> str:
-        chinese_chars = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
-        english_chars = sum(1 for char in text if char.isalpha() and ord(char) < 128)
-        return "en" if english_chars > chinese_chars and english_chars > 0 else "zh"
-    
-    detected_lang = detect_language(user_query)
+    detected_lang = detect_language(user_query, ui_language)
     
     # 根据检测到的语言添加强制指令
     if detected_lang == "en":
@@ -428,26 +771,15 @@ def _build_simple_prompt(
     
     context_parts = [lang_instruction + f"# 以下内容是基于用户发送的消息的搜索结果（今天是{current_date}）:\n"]
     
-    for idx, doc in enumerate(search_results[:15], 1):
-        context_parts.append(f"[参考资料 {idx}]")
-        context_parts.append(f"标题: {doc.title if hasattr(doc, 'title') else 'N/A'}")
-        
-        if hasattr(doc, 'url') and doc.url:
-            try:
-                domain = urlparse(doc.url).netloc
-                context_parts.append(f"来源: {domain}")
-            except:
-                pass
-        
-        content = doc.content if hasattr(doc, 'content') and doc.content else ''
-        if not content and hasattr(doc, 'snippet'):
-            content = doc.snippet
-        
-        if content:
-            content = content[:1000] if len(content) > 1000 else content
-            context_parts.append(f"内容:\n{content}")
-        
-        context_parts.append("---\n")
+    # 按相关性取前 15 个文档，再按 token 预算装填（每个文档内容最多 1000 字）
+    top = _top_docs(list(enumerate(search_results, 1)), _SIMPLE_TOP_K)
+    packed = _pack_by_tokens(top, max_context_tokens, 1000)
+    
+    for idx, doc, content in packed:
+        domain = _url_domain(doc.url) if doc.url else ""
+        source = f"\n来源: {domain}" if domain else ""
+        body = f"\n内容:\n{content}" if content else ""
+        context_parts.append(f"[参考资料 {idx}]\n标题: {doc.title or 'N/A'}{source}{body}\n---\n")
     
     context_parts.append("\n# 请基于以上参考资料，用自然严谨的方式回答用户的问题。")
     context_parts.append(f"\n# 用户问题: {user_query}")
@@ -3,45 +3,302 @@ Momo Search Multi-Agent Framework
 多Agent协作搜索框架
 """
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Any, Callable
+from typing import Dict, List, Optional, Any, AsyncIterator, Awaitable, Callable, Tuple
 from dataclasses import dataclass, field
 from enum import Enum
 import asyncio
+import copy
+import hashlib
+import heapq
+import io
+import json
+import random
 import time
+from collections import OrderedDict
+from datetime import date
+from functools import lru_cache, partial
+from operator import attrgetter
+import numpy as np
 from loguru import logger
 
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    XXHASH_AVAILABLE = False
 
-class AgentStatus(Enum):
-    """Agent状态"""
-    IDLE = "idle"
-    PROCESSING = "processing"
-    COMPLETED = "completed"
-    FAILED = "failed"
+try:
+    from pybloom_live import ScalableBloomFilter
+    BLOOM_AVAILABLE = True
+except ImportError:
+    BLOOM_AVAILABLE = False
 
+from .momo_llm_batch import call_zhipu_llm_async
+from .momo_retriever import append_uncrawled_docs, expand_docs_by_text_split, merge_docs_by_url
+from .momo_utils import (
+    SearchRateLimited, compress_conversation_history, extract_keywords,
+    search_duckduckgo, search_searxng, translate_text
+)
 
-@dataclass
+# URL 数量超过该阈值后切换为布隆过滤器去重（常规搜索规模下始终使用精确 set）
+URL_BLOOM_THRESHOLD = 10000
+
+# Agent消息队列容量（有界，防止消费者过慢时内存无限增长）
+MESSAGE_QUEUE_MAXSIZE = 256
+
+# 关键词提取 / 问题理解结果缓存（相同输入直接复用，跳过LLM往返）
+LLM_RESULT_CACHE_SIZE = 512
+LLM_RESULT_CACHE_TTL = 3600  # 秒，避免时效性问题长期使用旧结果
+
+# 搜索结果缓存（相同查询短时间内不重复请求搜索引擎）
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 900  # 秒
+
+# 搜索引擎限流（429/503）时的重试次数，以及同时在途的查询数上限
+SEARCH_RETRY_ATTEMPTS = 4
+SEARCH_MAX_CONCURRENT_QUERIES = 20
+
+# 搜索结果每累积到该数量的新文档，就在后台提前编码一批（与尚未完成的搜索重叠）
+RETRIEVAL_PREFETCH_BATCH = 20
+
+# 进度消息的批量发送间隔（秒），期间连续的可合并进度（如搜索进度）只发送最后一条
+PROGRESS_COALESCE_INTERVAL = 0.05
+
+
+# Agent状态（热路径直接使用字符串常量，避免 Enum 成员解析和 .value 访问）
+STATUS_IDLE = "idle"
+STATUS_PROCESSING = "processing"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+
+class AgentStatus(str, Enum):
+    """Agent状态（兼容旧代码；与对应的字符串常量相等）"""
+    IDLE = STATUS_IDLE
+    PROCESSING = STATUS_PROCESSING
+    COMPLETED = STATUS_COMPLETED
+    FAILED = STATUS_FAILED
+
+
+@dataclass(slots=True, frozen=True)
 class AgentMessage:
-    """Agent之间的消息"""
+    """Agent之间的消息（不可变，使用 __slots__ 减少每条消息的内存）"""
     sender: str
     receiver: str
     message_type: str
-    data: Dict[str, Any]
+    data: Dict[str, Any] = field(compare=False)  # 不参与比较/哈希，消息仍可哈希
     timestamp: float = field(default_factory=time.time)
 
 
+@dataclass(slots=True)
+class AgentResult:
+    """Agent处理结果（各Agent只填写与自己相关的字段）"""
+    success: bool
+    results: List[Any] = field(default_factory=list)  # 文档列表（搜索/检索/爬取/分块）
+    count: int = 0
+    scores: Optional[np.ndarray] = None  # 与 results 一一对应的相似度分数（检索）
+    keywords: Optional[Dict[str, str]] = None  # {"zh": ..., "en": ...}（关键词提取）
+    raw: Optional[Dict[str, Any]] = None
+    understanding: Optional[str] = None
+    analysis: Optional[str] = None
+    thinking: Optional[str] = None
+    message: Optional[str] = None
+    error: Optional[str] = None
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        """兼容旧的字典式访问"""
+        return getattr(self, key, default)
+
+
+class UrlDeduplicator:
+    """
+    URL 去重器
+    
+    数量较少时使用精确的 set；超过阈值且安装了 pybloom_live 时切换为可扩展布隆过滤器，
+    以固定的小内存代价处理大规模深度搜索（存在极低的误判率）。
+    """
+    
+    def __init__(self, bloom_threshold: int = URL_BLOOM_THRESHOLD):
+        self.bloom_threshold = bloom_threshold
+        self._seen = set()
+        self._bloom = None
+    
+    def add(self, url: str) -> bool:
+        """记录 URL，如果是新的 URL 返回 True"""
+        if self._bloom is not None:
+            # add 返回 True 表示已存在
+            return not self._bloom.add(url)
+        
+        if url in self._seen:
+            return False
+        self._seen.add(url)
+        
+        if BLOOM_AVAILABLE and len(self._seen) > self.bloom_threshold:
+            self._bloom = ScalableBloomFilter(initial_capacity=self.bloom_threshold * 2, error_rate=1e-4)
+            for seen_url in self._seen:
+                self._bloom.add(seen_url)
+            self._seen = set()
+            logger.info(f"🌸 URL 数量超过 {self.bloom_threshold}，切换为布隆过滤器去重")
+        return True
+
+
+class ResultCache:
+    """
+    结果缓存（LRU + TTL），用于 LLM 结果和搜索结果
+    
+    key 为输入的 sha1 摘要；模块级实例在所有Agent（包括Agent池中的副本）之间共享。
+    """
+    
+    def __init__(self, max_entries: int = LLM_RESULT_CACHE_SIZE, ttl: float = LLM_RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (写入时间, 结果)
+        self._inflight: Dict[str, asyncio.Future] = {}  # key -> 正在计算的任务
+    
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    def put(self, key: str, value: Any):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        读取缓存，未命中时调用 compute() 计算并写入缓存（空结果不缓存）
+        
+        同一 key 的并发未命中只计算一次，其余调用者等待同一个任务的结果，
+        某个调用者被取消不会影响其他调用者。
+        
+        Returns:
+            (结果, 是否复用了缓存或进行中的计算)
+        """
+        value = self.get(key)
+        if value is not None:
+            return value, True
+        
+        task = self._inflight.get(key)
+        if task is not None:
+            return await asyncio.shield(task), True
+        
+        async def run():
+            result = await compute()
+            if result:
+                self.put(key, result)
+            return result
+        
+        task = asyncio.ensure_future(run())
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task), False
+
+
+_KEYWORD_CACHE = ResultCache()
+_UNDERSTANDING_CACHE = ResultCache()
+_SEARCH_CACHE = ResultCache(max_entries=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+
+async def _cached_search_result(docs: list) -> list:
+    """返回缓存搜索结果的浅拷贝（下游会修改文档的 content/score，不能污染缓存）"""
+    return [copy.copy(doc) for doc in docs]
+
+
+# 问题理解提示词模板（占位符：current_date, query, context_info）
+UNDERSTANDING_PROMPT_TEMPLATE = """今天是{current_date}。作为一个专业的问题分析专家，请深入理解用户的问题，挖掘其背后的多层次需求。
+
+用户当前问题：{query}{context_info}
+
+请进行多维度深度分析，识别用户的显性需求和潜在需求：
+
+**第一步：表面意图分析**
+- 用户直接询问的是什么？
+- 问题的类型：询问事实、寻求建议、对比选择、学习方法、解决问题等
+- 问题的核心关键词是什么？
+
+**第二步：潜在需求挖掘**（这是重点！）
+根据问题类型，用户可能还关心以下维度（选择相关的）：
+
+**通用维度**：
+- **基础概念**：定义、分类、组成部分、发展历史
+- **关键属性**：特征、参数、规格、版本、创建者/品牌
+- **对比评估**：优缺点、横向对比、排名、用户评价、专业评测
+- **实际应用**：使用场景、适用人群、成功案例、注意事项
+- **获取方式**：如何购买/下载、价格/成本、渠道、门槛
+- **实操指导**：使用方法、最佳实践、常见问题、学习资源
+- **发展动态**：最新进展、趋势预测、市场状况、未来展望
+
+**第三步：信息需求清单**
+基于上述分析，列出用户最可能需要的5-8个关键信息点（按重要性排序）。
+
+**第四步：搜索策略建议**
+为了全面回答这个问题，建议从哪些角度进行搜索？需要查找哪些类型的资料（如：产品列表、评测报告、教程文档、专家观点等）？
+
+**分析原则**：
+1. 不要只停留在问题表面，要思考"用户为什么问这个问题？他们真正想解决什么？"
+2. 考虑问题的实用性 - 用户通常希望得到可操作的、有价值的信息
+3. 关注时效性 - 如果涉及"最新"、"现在"等词，要特别注意搜索最新资料
+
+**示例**（仅供参考，实际分析要根据具体问题灵活调整）：
+- 技术问题："Python和Java哪个好？" → 用户可能需要：学习曲线对比、应用领域差异、就业前景、语法特点、生态对比、选择建议
+- 消费问题："iPhone 15值得买吗？" → 用户可能需要：性能参数、与前代对比、优缺点、价格分析、用户评价、购买建议
+- 学习问题："如何学习机器学习？" → 用户可能需要：学习路径、前置知识、推荐书籍/课程、实践项目、常见误区
+
+现在，请对用户的问题进行深度分析，输出你的理解（控制在400字以内，重点放在潜在需求挖掘）："""
+
+
+# 内容去重时参与哈希的前缀长度（字符）
+CONTENT_HASH_PREFIX = 1024
+
+
+def _content_hash(text: str) -> int:
+    """文档内容前缀的哈希（安装了 xxhash 时使用 xxh3，否则使用内置 hash，仅用于进程内去重）"""
+    prefix = text[:CONTENT_HASH_PREFIX]
+    if XXHASH_AVAILABLE:
+        return xxhash.xxh3_64_intdigest(prefix.encode("utf-8"))
+    return hash(prefix)
+
+
+@lru_cache(maxsize=1)
+def _today_str(day: date) -> str:
+    """当天日期字符串（按日期缓存，每天只格式化一次）"""
+    return day.strftime("%Y-%m-%d")
+
+
+@lru_cache(maxsize=256)
+def _format_citation_pairs(pairs: tuple[tuple[str, str], ...]) -> str:
+    """按 (title, url) 元组生成引用信息（相同结果列表重复生成时直接复用）"""
+    return "\n".join(f"{idx}. [{title}]({url})" for idx, (title, url) in enumerate(pairs, 1))
+
+
 class BaseAgent(ABC):
     """基础Agent类"""
     
-    def __init__(self, name: str, description: str = ""):
+    def __init__(self, name: str, description: str = "", queue_maxsize: int = MESSAGE_QUEUE_MAXSIZE):
         self.name = name
         self.description = description
-        self.status = AgentStatus.IDLE
-        self.message_queue: asyncio.Queue = asyncio.Queue()
+        self.status = STATUS_IDLE
+        self.queue_maxsize = queue_maxsize
+        self.message_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_maxsize)
         self.result: Optional[Any] = None
         self.error: Optional[str] = None
+        self._last_drop_warning = 0.0
         
     @abstractmethod
-    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> Dict[str, Any]:
+    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> AgentResult:
         """
         处理输入数据
         
@@ -63,7 +320,32 @@ class BaseAgent(ABC):
             data=data
         )
         await receiver.message_queue.put(message)
-        logger.debug(f"📨 [{self.name}] -> [{receiver.name}]: {message_type}")
+        logger.debug("📨 [{}] -> [{}]: {}", self.name, receiver.name, message_type)
+    
+    def send_message_bounded(self, receiver: 'BaseAgent', message_type: str, data: Dict[str, Any]):
+        """
+        向其他Agent发送消息（不等待）
+        
+        接收方队列已满时丢弃最旧的一条消息再放入，适用于进度等只关心最新状态的消息
+        """
+        message = AgentMessage(
+            sender=self.name,
+            receiver=receiver.name,
+            message_type=message_type,
+            data=data
+        )
+        queue = receiver.message_queue
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            queue.get_nowait()
+            queue.put_nowait(message)
+            # 限流：每秒最多警告一次
+            now = time.monotonic()
+            if now - self._last_drop_warning >= 1.0:
+                self._last_drop_warning = now
+                logger.warning(f"⚠️ [{receiver.name}] 消息队列已满，丢弃最旧的消息")
+        logger.debug("📨 [{}] -> [{}]: {}", self.name, receiver.name, message_type)
     
     async def receive_message(self, timeout: float = None) -> Optional[AgentMessage]:
         """接收消息"""
@@ -72,22 +354,24 @@ class BaseAgent(ABC):
         except asyncio.TimeoutError:
             return None
     
-    def set_status(self, status: AgentStatus):
-        """设置状态"""
+    def set_status(self, status: str):
+        """设置状态（STATUS_* 常量；兼容传入 AgentStatus 成员）"""
+        if type(status) is not str:
+            status = status.value
         self.status = status
-        logger.debug(f"🤖 [{self.name}] 状态: {status.value}")
+        logger.debug("🤖 [{}] 状态: {}", self.name, status)
     
     def reset(self):
         """重置Agent状态"""
-        self.status = AgentStatus.IDLE
+        self.status = STATUS_IDLE
         self.result = None
         self.error = None
-        # 清空消息队列
-        while not self.message_queue.empty():
-            try:
-                self.message_queue.get_nowait()
-            except:
-                pass
+        # 直接替换为新队列（旧队列交给GC），无需逐条出队
+        self.message_queue = asyncio.Queue(maxsize=self.queue_maxsize)
+    
+    def close(self):
+        """释放Agent持有的资源（默认无资源）"""
+        pass
 
 
 class KeywordExtractionAgent(BaseAgent):
@@ -100,10 +384,12 @@ class KeywordExtractionAgent(BaseAgent):
         )
         self.zhipu_api_key = zhipu_api_key
         self.zhipu_model = zhipu_model
+        # 缓存key前缀：区分不同的API密钥/模型，避免直接保存密钥
+        self._cache_key_prefix = hashlib.sha1(zhipu_api_key.encode()).hexdigest()[:8]
     
-    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> Dict[str, Any]:
+    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> AgentResult:
         """提取关键词"""
-        self.set_status(AgentStatus.PROCESSING)
+        self.set_status(STATUS_PROCESSING)
         
         try:
             query = input_data.get("query", "")
@@ -112,8 +398,6 @@ class KeywordExtractionAgent(BaseAgent):
             if not query:
                 raise ValueError("查询为空")
             
-            from .momo_utils import extract_keywords
-            
             if understanding:
                 logger.info(f"[{self.name}] 开始提取关键词（基于问题理解）: {query}")
             else:
@@ -122,56 +406,70 @@ class KeywordExtractionAgent(BaseAgent):
             if conversation_history:
                 logger.info(f"[{self.name}] 已接收对话历史: {len(conversation_history)} 条消息")
             
-            keywords_dict = extract_keywords(
-                query,
-                api_key=self.zhipu_api_key,
-                model=self.zhipu_model,
-                understanding=understanding,  # 传递理解结果
-                conversation_history=conversation_history  # 传递对话历史
+            # 提示词包含当天日期，日期也作为缓存key的一部分
+            cache_key = ResultCache.make_key(
+                self._cache_key_prefix, self.zhipu_model, date.today().isoformat(),
+                query, understanding, conversation_history
+            )
+            # 同时到达的相同请求共享同一次LLM调用
+            keywords_dict, cache_hit = await _KEYWORD_CACHE.get_or_compute(
+                cache_key,
+                partial(
+                    asyncio.to_thread,
+                    extract_keywords,
+                    query,
+                    api_key=self.zhipu_api_key,
+                    model=self.zhipu_model,
+                    understanding=understanding,  # 传递理解结果
+                    conversation_history=conversation_history  # 传递对话历史
+                )
             )
+            if cache_hit:
+                logger.info(f"⚡ [{self.name}] 命中关键词缓存")
             
             if keywords_dict:
                 zh_keys = keywords_dict.get("zh_keys", "").strip()
                 en_keys = keywords_dict.get("en_keys", "").strip()
                 
-                result = {
-                    "success": True,
-                    "keywords": {
+                result = AgentResult(
+                    success=True,
+                    keywords={
                         "zh": zh_keys,
                         "en": en_keys
                     },
-                    "raw": keywords_dict
-                }
+                    raw=keywords_dict
+                )
                 
                 logger.info(f"✅ [{self.name}] 提取成功: 中文={zh_keys}, 英文={en_keys}")
             else:
-                result = {
-                    "success": False,
-                    "keywords": None,
-                    "message": "关键词提取失败"
-                }
+                result = AgentResult(
+                    success=False,
+                    keywords=None,
+                    message="关键词提取失败"
+                )
                 logger.warning(f"⚠️ [{self.name}] 提取失败")
             
             self.result = result
-            self.set_status(AgentStatus.COMPLETED)
+            self.set_status(STATUS_COMPLETED)
             logger.info(f"✅ [{self.name}] Agent已完成")
             return result
             
         except Exception as e:
             self.error = str(e)
-            self.set_status(AgentStatus.FAILED)
+            self.set_status(STATUS_FAILED)
             logger.error(f"❌ [{self.name}] Agent处理失败: {e}")
-            return {
-                "success": False,
-                "error": str(e)
-            }
+            return AgentResult(
+                success=False,
+                error=str(e)
+            )
 
 
 class SearchAgent(BaseAgent):
     """搜索Agent - 负责执行搜索引擎查询"""
     
     def __init__(self, searxng_url: str, searxng_language: str = "zh", 
-                 searxng_time_range: str = "day", max_results: int = 50):
+                 searxng_time_range: str = "day", max_results: int = 50,
+                 max_concurrent_queries: int = SEARCH_MAX_CONCURRENT_QUERIES):
         super().__init__(
             name="searcher",
             description="执行搜索引擎查询（SearXNG + DuckDuckGo）"
@@ -180,89 +478,183 @@ class SearchAgent(BaseAgent):
         self.searxng_language = searxng_language
         self.searxng_time_range = searxng_time_range
         self.max_results = max_results
+        # 限制同时在途的查询数（Agent池中的副本共享该信号量，即全局上限）
+        self.query_semaphore = asyncio.Semaphore(max_concurrent_queries)
+        
+        # 所有 SearXNG 请求共享一个长连接会话，避免每次查询重新握手
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
     
-    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> Dict[str, Any]:
-        """执行搜索"""
-        self.set_status(AgentStatus.PROCESSING)
+    def close(self):
+        """关闭共享的HTTP会话"""
+        self.session.close()
+    
+    async def _search_with_retry(self, search_item: Dict[str, Any], search_fn: Callable,
+                                 attempts: int = SEARCH_RETRY_ATTEMPTS) -> List[Any]:
+        """
+        执行单个查询，被限流时按指数退避 + 随机抖动重试（优先遵循服务端的 Retry-After）
         
-        try:
-            queries = input_data.get("queries", [])  # [{query, language, source}, ...]
-            all_results = []
-            
-            from .momo_utils import search_searxng, search_duckduckgo, SearchDocument
-            
-            # 执行SearXNG搜索
-            for search_item in queries:
-                if search_item.get("source", "").startswith("ddg"):
-                    continue  # DuckDuckGo查询跳过
-                
+        Args:
+            search_item: 查询项（用于日志）
+            search_fn: 无参数的协程函数，每次调用发起一次新的请求
+            attempts: 最多尝试次数
+        """
+        for attempt in range(attempts):
+            try:
+                async with self.query_semaphore:
+                    return await search_fn()
+            except SearchRateLimited as e:
+                if attempt == attempts - 1:
+                    raise
+                wait_time = max(2 ** attempt, e.retry_after) + random.random()
+                logger.warning(f"⚠️ [{self.name}] 搜索被限流（尝试 {attempt + 1}/{attempts}）: {search_item['query']}，{wait_time:.1f}秒后重试")
+                await asyncio.sleep(wait_time)
+    
+    async def stream(self, queries: List[Dict[str, Any]],
+                     progress_callback: Optional[Callable] = None) -> AsyncIterator[Any]:
+        """
+        流式搜索：同时发起所有查询，按查询顺序（先 SearXNG 后 DuckDuckGo）逐个产出去重后的文档
+        
+        某个查询完成（且排在它前面的查询都已完成）后立即产出其结果，不必等待最慢的查询；
+        单个查询失败只记录日志并跳过。
+        
+        Args:
+            queries: [{query, language, source, max_results}, ...]
+            progress_callback: 可选，async (已完成数, 总数)，每个查询完成时调用
+        """
+        self.set_status(STATUS_PROCESSING)
+        
+        # 单遍分流：每个查询只判断一次引擎（SearXNG 在前，DuckDuckGo 在后）
+        searxng_queries = []
+        ddg_queries = []
+        for search_item in queries:
+            if search_item.get("source", "").startswith("ddg"):
+                ddg_queries.append((search_item, True))
+            else:
+                searxng_queries.append((search_item, False))
+        
+        ordered_queries = searxng_queries + ddg_queries
+        cache_keys = []
+        cache_hits = []
+        coros = []
+        for search_item, is_ddg in ordered_queries:
+            # 使用查询项中指定的max_results，如果没有则使用默认值（SearXNG 50，DuckDuckGo 20）
+            num_results = search_item.get("max_results", 20 if is_ddg else self.max_results)
+            cache_key = ResultCache.make_key(
+                "ddg" if is_ddg else self.searxng_url, search_item.get("source", ""),
+                search_item['language'], search_item['query'], num_results, self.searxng_time_range
+            )
+            cache_keys.append(cache_key)
+            
+            cached = _SEARCH_CACHE.get(cache_key)
+            cache_hits.append(cached is not None)
+            if cached is not None:
+                logger.info(f"⚡ [{self.name}] 命中搜索缓存: {search_item['query']} ({search_item['language']})")
+                coros.append(_cached_search_result(cached))
+            elif is_ddg:
+                logger.info(f"🦆 [{self.name}] DuckDuckGo搜索: {search_item['query']} ({search_item['language']})")
+                coros.append(self._search_with_retry(search_item, partial(
+                    search_duckduckgo,
+                    query=search_item['query'],
+                    # 根据max_results参数决定结果数量（英语40，中文20）
+                    max_results=num_results,
+                    language=search_item['language'],
+                    time_range=self.searxng_time_range if self.searxng_time_range else None
+                )))
+            else:
+                # SearXNG 在线程中执行，避免阻塞事件循环
                 logger.info(f"🔍 [{self.name}] SearXNG搜索: {search_item['query']} ({search_item['language']})")
-                
-                # 使用查询项中指定的max_results，如果没有则使用默认值
-                num_results = search_item.get("max_results", self.max_results)
-                
-                results = search_searxng(
+                coros.append(self._search_with_retry(search_item, partial(
+                    asyncio.to_thread,
+                    search_searxng,
                     query=search_item['query'],
                     num_results=num_results,
                     ip_address=self.searxng_url,
                     language=search_item['language'],
                     time_range=self.searxng_time_range,
-                    deduplicate_by_url=True
-                )
+                    deduplicate_by_url=True,
+                    session=self.session
+                )))
+        
+        if progress_callback:
+            done = 0
+            
+            async def _tracked(coro):
+                nonlocal done
+                try:
+                    return await coro
+                finally:
+                    done += 1
+                    await progress_callback(done, len(queries))
+            
+            coros = [_tracked(coro) for coro in coros]
+        
+        # 全部提前调度为任务，随后按查询顺序依次等待
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        try:
+            seen_urls = UrlDeduplicator()
+            total = 0
+            for (search_item, is_ddg), task, cache_key, hit in zip(ordered_queries, tasks, cache_keys, cache_hits):
+                engine = "DuckDuckGo" if is_ddg else "SearXNG"
+                try:
+                    results = await task
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"❌ [{self.name}] {engine}搜索失败: {search_item['query']} - {e}")
+                    continue
+                if not hit and results:
+                    _SEARCH_CACHE.put(cache_key, [copy.copy(doc) for doc in results])
                 
-                # 去重合并
-                seen_urls = {doc.url for doc in all_results}
                 for doc in results:
-                    if doc.url not in seen_urls:
-                        all_results.append(doc)
-                        seen_urls.add(doc.url)
+                    if seen_urls.add(doc.url):
+                        total += 1
+                        yield doc
                 
-                logger.info(f"✅ [{self.name}] SearXNG完成: +{len(results)}个结果, 总计{len(all_results)}个")
+                logger.info(f"✅ [{self.name}] {engine}完成: +{len(results)}个结果, 总计{total}个")
             
-            # 执行DuckDuckGo搜索
-            ddg_queries = [q for q in queries if q.get("source", "").startswith("ddg")]
-            for ddg_item in ddg_queries:
-                logger.info(f"🦆 [{self.name}] DuckDuckGo搜索: {ddg_item['query']} ({ddg_item['language']})")
-                
-                # 根据max_results参数决定结果数量（英语40，中文20）
-                max_results = ddg_item.get("max_results", 20)
-                
-                ddg_results = await search_duckduckgo(
-                    query=ddg_item['query'],
-                    max_results=max_results,
-                    language=ddg_item['language'],
-                    time_range=self.searxng_time_range if self.searxng_time_range else None
-                )
-                
-                # 去重合并
-                seen_urls = {doc.url for doc in all_results}
-                for doc in ddg_results:
-                    if doc.url not in seen_urls:
-                        all_results.append(doc)
-                        seen_urls.add(doc.url)
-                
-                logger.info(f"✅ [{self.name}] DuckDuckGo完成: +{len(ddg_results)}个结果, 总计{len(all_results)}个")
+            self.set_status(STATUS_COMPLETED)
+        except Exception as e:
+            self.error = str(e)
+            self.set_status(STATUS_FAILED)
+            raise
+        finally:
+            # 调用方提前结束迭代时取消尚未完成的查询
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+    
+    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> AgentResult:
+        """执行搜索（一次性收集 stream 的全部结果）"""
+        try:
+            queries = input_data.get("queries", [])  # [{query, language, source}, ...]
+            progress_callback = input_data.get("progress_callback")  # 可选：async (已完成数, 总数)，每个查询完成时调用
             
-            result = {
-                "success": True,
-                "results": all_results,
-                "count": len(all_results)
-            }
+            all_results = [doc async for doc in self.stream(queries, progress_callback)]
+            
+            result = AgentResult(
+                success=True,
+                results=all_results,
+                count=len(all_results)
+            )
             
             self.result = result
-            self.set_status(AgentStatus.COMPLETED)
             logger.info(f"✅ [{self.name}] Agent已完成: 总计获得 {len(all_results)} 个搜索结果")
             return result
             
         except Exception as e:
             self.error = str(e)
-            self.set_status(AgentStatus.FAILED)
+            self.set_status(STATUS_FAILED)
             logger.error(f"❌ [{self.name}] 处理失败: {e}")
-            return {
-                "success": False,
-                "error": str(e),
-                "results": []
-            }
+            return AgentResult(
+                success=False,
+                error=str(e),
+                results=[]
+            )
 
 
 class RetrievalAgent(BaseAgent):
@@ -276,14 +668,19 @@ class RetrievalAgent(BaseAgent):
         self.retriever = retriever
         self.sim_threshold = sim_threshold
     
-    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> Dict[str, Any]:
+    async def encode(self, documents: List) -> np.ndarray:
+        """在线程中提前编码一批文档，结果可通过 process 的 embeddings 输入复用"""
+        return await asyncio.to_thread(self.retriever.encode_documents, documents)
+    
+    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> AgentResult:
         """执行向量检索"""
-        self.set_status(AgentStatus.PROCESSING)
+        self.set_status(STATUS_PROCESSING)
         
         try:
             query = input_data.get("query", "")
             queries = input_data.get("queries", [])  # 支持多查询
             documents = input_data.get("documents", [])
+            embeddings = input_data.get("embeddings")  # 可选：与 documents 对应的已编码向量
             
             # 兼容性：如果没有queries，使用query
             if not queries and query:
@@ -295,52 +692,52 @@ class RetrievalAgent(BaseAgent):
             logger.info(f"[{self.name}] 开始分析相关性: {len(documents)}个文档, {len(queries)}个查询")
             
             # 添加文档到检索器
-            self.retriever.add_documents(documents)
+            self.retriever.add_documents(documents, embeddings=embeddings)
             
-            # 检索相关文档（支持多查询）
-            if len(queries) > 1:
-                # 多个查询：分开检索并合并结果
-                relevant_docs = self.retriever.get_relevant_documents_multi_query(queries)
-            else:
-                # 单个查询：使用原有方法
-                relevant_docs = self.retriever.get_relevant_documents(queries[0])
+            # 检索相关文档：所有查询（包括单个查询）一次批量编码和搜索，按URL合并保留最高分
+            relevant_docs = self.retriever.get_relevant_documents_batch(queries)
             
             if not relevant_docs:
                 logger.warning(f"⚠️ [{self.name}] 未找到相关文档")
-                result = {
-                    "success": False,
-                    "results": [],
-                    "count": 0,
-                    "message": "未找到相关文档"
-                }
+                result = AgentResult(
+                    success=False,
+                    results=[],
+                    count=0,
+                    message="未找到相关文档"
+                )
             else:
                 logger.info(f"✅ [{self.name}] 找到{len(relevant_docs)}个相关文档")
-                result = {
-                    "success": True,
-                    "results": relevant_docs,
-                    "count": len(relevant_docs)
-                }
+                result = AgentResult(
+                    success=True,
+                    results=relevant_docs,
+                    # 与 results 一一对应的连续分数数组，下游筛选/排序无需逐个读取属性
+                    scores=np.fromiter(
+                        (getattr(d, 'score', 0.0) for d in relevant_docs),
+                        dtype=np.float64, count=len(relevant_docs)
+                    ),
+                    count=len(relevant_docs)
+                )
             
             self.result = result
-            self.set_status(AgentStatus.COMPLETED)
+            self.set_status(STATUS_COMPLETED)
             logger.info(f"✅ [{self.name}] Agent已完成: 找到 {len(relevant_docs)} 个相关文档")
             return result
             
         except Exception as e:
             self.error = str(e)
-            self.set_status(AgentStatus.FAILED)
+            self.set_status(STATUS_FAILED)
             logger.error(f"❌ [{self.name}] 处理失败: {e}")
-            return {
-                "success": False,
-                "error": str(e),
-                "results": []
-            }
+            return AgentResult(
+                success=False,
+                error=str(e),
+                results=[]
+            )
 
 
 class CrawlerAgent(BaseAgent):
     """爬取Agent - 负责深度爬取网页内容"""
     
-    def __init__(self, crawler, score_threshold: float = 0.5, max_docs: int = 10):
+    def __init__(self, crawler, score_threshold: float = 0.5, max_docs: int = 10, min_content_chars: int = 800):
         super().__init__(
             name="crawler",
             description="深度爬取网页内容"
@@ -348,21 +745,22 @@ class CrawlerAgent(BaseAgent):
         self.crawler = crawler
         self.score_threshold = score_threshold
         self.max_docs = max_docs
+        self.min_content_chars = min_content_chars  # 已有内容达到该长度的文档不再爬取
     
-    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> Dict[str, Any]:
+    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> AgentResult:
         """执行深度爬取"""
-        self.set_status(AgentStatus.PROCESSING)
+        self.set_status(STATUS_PROCESSING)
         
         try:
             documents = input_data.get("documents", [])
             
             if not documents:
                 logger.warning(f"⚠️ [{self.name}] 无文档需要爬取")
-                return {
-                    "success": True,
-                    "results": [],
-                    "count": 0
-                }
+                return AgentResult(
+                    success=True,
+                    results=[],
+                    count=0
+                )
             
             logger.info(f"🕷️ [{self.name}] 开始深度爬取: {len(documents)}个文档")
             
@@ -370,32 +768,33 @@ class CrawlerAgent(BaseAgent):
             await self.crawler.crawl_many(
                 documents,
                 score_threshold=self.score_threshold,
-                max_docs=self.max_docs
+                max_docs=self.max_docs,
+                min_content_chars=self.min_content_chars
             )
             
             # 爬取后的文档（crawler会更新文档的content字段）
-            result = {
-                "success": True,
-                "results": documents,
-                "count": len(documents)
-            }
+            result = AgentResult(
+                success=True,
+                results=documents,
+                count=len(documents)
+            )
             
             logger.info(f"✅ [{self.name}] 爬取完成: {len(documents)}个文档")
             
             self.result = result
-            self.set_status(AgentStatus.COMPLETED)
+            self.set_status(STATUS_COMPLETED)
             logger.info(f"✅ [{self.name}] Agent已完成: 爬取了 {len(documents)} 个文档")
             return result
             
         except Exception as e:
             self.error = str(e)
-            self.set_status(AgentStatus.FAILED)
+            self.set_status(STATUS_FAILED)
             logger.error(f"❌ [{self.name}] 处理失败: {e}")
-            return {
-                "success": False,
-                "error": str(e),
-                "results": documents if 'documents' in locals() else []
-            }
+            return AgentResult(
+                success=False,
+                error=str(e),
+                results=documents if 'documents' in locals() else []
+            )
 
 
 class ProblemUnderstandingAgent(BaseAgent):
@@ -408,10 +807,11 @@ class ProblemUnderstandingAgent(BaseAgent):
         )
         self.zhipu_api_key = zhipu_api_key
         self.zhipu_model = zhipu_model
+        self._cache_key_prefix = hashlib.sha1(zhipu_api_key.encode()).hexdigest()[:8]
     
-    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> Dict[str, Any]:
+    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> AgentResult:
         """理解问题"""
-        self.set_status(AgentStatus.PROCESSING)
+        self.set_status(STATUS_PROCESSING)
         
         try:
             query = input_data.get("query", "")
@@ -419,16 +819,9 @@ class ProblemUnderstandingAgent(BaseAgent):
             if not query:
                 raise ValueError("查询为空")
             
-            from datetime import datetime
-            from .momo_utils import call_zhipu_llm
-            
-            current_date = datetime.now().strftime("%Y-%m-%d")
-            
             # 构建上下文信息（使用压缩技术）
             context_info = ""
             if conversation_history:
-                from .momo_utils import compress_conversation_history
-                
                 # 尝试压缩对话历史（使用配置的方法）
                 # 从input_data中获取压缩配置（如果SearchOrchestrator传递了的话）
                 compression_method = input_data.get("compression_method", "rule_based")
@@ -505,88 +898,62 @@ class ProblemUnderstandingAgent(BaseAgent):
 - 当前问题可能是对之前问题的补充或细化，而非全新的独立问题
 """
             
-            prompt = f"""今天是{current_date}。作为一个专业的问题分析专家，请深入理解用户的问题，挖掘其背后的多层次需求。
-
-用户当前问题：{query}{context_info}
-
-请进行多维度深度分析，识别用户的显性需求和潜在需求：
-
-**第一步：表面意图分析**
-- 用户直接询问的是什么？
-- 问题的类型：询问事实、寻求建议、对比选择、学习方法、解决问题等
-- 问题的核心关键词是什么？
-
-**第二步：潜在需求挖掘**（这是重点！）
-根据问题类型，用户可能还关心以下维度（选择相关的）：
-
-**通用维度**：
-- **基础概念**：定义、分类、组成部分、发展历史
-- **关键属性**：特征、参数、规格、版本、创建者/品牌
-- **对比评估**：优缺点、横向对比、排名、用户评价、专业评测
-- **实际应用**：使用场景、适用人群、成功案例、注意事项
-- **获取方式**：如何购买/下载、价格/成本、渠道、门槛
-- **实操指导**：使用方法、最佳实践、常见问题、学习资源
-- **发展动态**：最新进展、趋势预测、市场状况、未来展望
-
-**第三步：信息需求清单**
-基于上述分析，列出用户最可能需要的5-8个关键信息点（按重要性排序）。
-
-**第四步：搜索策略建议**
-为了全面回答这个问题，建议从哪些角度进行搜索？需要查找哪些类型的资料（如：产品列表、评测报告、教程文档、专家观点等）？
-
-**分析原则**：
-1. 不要只停留在问题表面，要思考"用户为什么问这个问题？他们真正想解决什么？"
-2. 考虑问题的实用性 - 用户通常希望得到可操作的、有价值的信息
-3. 关注时效性 - 如果涉及"最新"、"现在"等词，要特别注意搜索最新资料
-
-**示例**（仅供参考，实际分析要根据具体问题灵活调整）：
-- 技术问题："Python和Java哪个好？" → 用户可能需要：学习曲线对比、应用领域差异、就业前景、语法特点、生态对比、选择建议
-- 消费问题："iPhone 15值得买吗？" → 用户可能需要：性能参数、与前代对比、优缺点、价格分析、用户评价、购买建议
-- 学习问题："如何学习机器学习？" → 用户可能需要：学习路径、前置知识、推荐书籍/课程、实践项目、常见误区
-
-现在，请对用户的问题进行深度分析，输出你的理解（控制在400字以内，重点放在潜在需求挖掘）："""
-            
-            logger.info(f"[{self.name}] 开始深度理解问题: {query}")
-            understanding = call_zhipu_llm(
-                prompt=prompt,
-                api_key=self.zhipu_api_key,
-                model=self.zhipu_model,
-                temperature=0.8,  # 提高温度以增加分析的全面性
-                max_tokens=1200  # 增加 token 限制以支持更详细的分析
+            prompt = UNDERSTANDING_PROMPT_TEMPLATE.format(
+                current_date=_today_str(date.today()),
+                query=query,
+                context_info=context_info
             )
             
+            # 提示词已包含日期、问题和对话上下文，直接以提示词作为缓存key
+            cache_key = ResultCache.make_key(self._cache_key_prefix, self.zhipu_model, prompt)
+            understanding = _UNDERSTANDING_CACHE.get(cache_key)
+            if understanding is not None:
+                logger.info(f"⚡ [{self.name}] 命中问题理解缓存")
+            else:
+                logger.info(f"[{self.name}] 开始深度理解问题: {query}")
+                understanding = await call_zhipu_llm_async(
+                    prompt=prompt,
+                    api_key=self.zhipu_api_key,
+                    model=self.zhipu_model,
+                    temperature=0.8,  # 提高温度以增加分析的全面性
+                    max_tokens=1200  # 增加 token 限制以支持更详细的分析
+                )
+                if understanding:
+                    _UNDERSTANDING_CACHE.put(cache_key, understanding)
+            
             if understanding:
-                result = {
-                    "success": True,
-                    "understanding": understanding
-                }
+                result = AgentResult(
+                    success=True,
+                    understanding=understanding
+                )
                 logger.info(f"✅ [{self.name}] 理解完成")
             else:
-                result = {
-                    "success": False,
-                    "understanding": None,
-                    "message": "问题理解失败"
-                }
+                result = AgentResult(
+                    success=False,
+                    understanding=None,
+                    message="问题理解失败"
+                )
                 logger.warning(f"⚠️ [{self.name}] 理解失败")
             
             self.result = result
-            self.set_status(AgentStatus.COMPLETED)
+            self.set_status(STATUS_COMPLETED)
             return result
             
         except Exception as e:
             logger.error(f"❌ [{self.name}] 处理失败: {e}", exc_info=True)
-            self.set_status(AgentStatus.FAILED)
-            return {
-                "success": False,
-                "understanding": None,
-                "message": str(e)
-            }
+            self.set_status(STATUS_FAILED)
+            return AgentResult(
+                success=False,
+                understanding=None,
+                message=str(e)
+            )
 
 
 class MaterialAnalysisAgent(BaseAgent):
     """资料分析Agent - 批判性分析搜索结果"""
     
-    def __init__(self, zhipu_api_key: str, zhipu_model: str = "glm-4.5-flash", analysis_score_threshold: float = 0.5):
+    def __init__(self, zhipu_api_key: str, zhipu_model: str = "glm-4.5-flash", analysis_score_threshold: float = 0.5,
+                 max_analysis_docs: int = 20):
         super().__init__(
             name="material_analysis",
             description="批判性分析搜索结果"
@@ -594,48 +961,73 @@ class MaterialAnalysisAgent(BaseAgent):
         self.zhipu_api_key = zhipu_api_key
         self.zhipu_model = zhipu_model
         self.analysis_score_threshold = analysis_score_threshold  # 资料分析的相似度阈值
+        self.max_analysis_docs = max_analysis_docs  # 送入分析提示词的最大文档数
     
-    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> Dict[str, Any]:
+    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> AgentResult:
         """分析资料"""
-        self.set_status(AgentStatus.PROCESSING)
+        self.set_status(STATUS_PROCESSING)
         
         try:
             query = input_data.get("query", "")
             documents = input_data.get("documents", [])
+            scores = input_data.get("scores")  # 可选：与 documents 对齐的分数数组（来自检索Agent）
             understanding = input_data.get("understanding", "")  # 从前面的步骤获取
             
             if not query or not documents:
                 raise ValueError("查询或文档为空")
             
-            from .momo_utils import call_zhipu_llm
-            
-            # 根据相似度阈值进一步筛选文档（不限制数量，但提高质量）
-            filtered_docs = []
-            for doc in documents:
-                score = getattr(doc, 'score', 0.0)
-                if score >= self.analysis_score_threshold:
-                    filtered_docs.append(doc)
-            
-            if not filtered_docs:
-                logger.warning(f"⚠️ [{self.name}] 没有文档达到分析阈值 ({self.analysis_score_threshold})，使用所有文档")
-                filtered_docs = documents
-            
-            # 按相似度分数排序（从高到低）
-            filtered_docs.sort(key=lambda x: getattr(x, 'score', 0.0), reverse=True)
+            if scores is not None and len(scores) != len(documents):
+                scores = None  # 分数数组与文档不对齐时退回逐文档读取分数
+            
+            # 按内容哈希去重：不同URL的相同内容（转载/镜像）只分析一次；
+            # 传入 context 时哈希集合保存在 context 中，多轮分析之间跳过已分析过的内容
+            seen_hashes = context.setdefault("_content_hashes", set()) if context is not None else set()
+            keep = []
+            for i, doc in enumerate(documents):
+                text = doc.content or doc.snippet
+                if text:
+                    h = _content_hash(text)
+                    if h in seen_hashes:
+                        continue
+                    seen_hashes.add(h)
+                keep.append(i)
+            if not keep:
+                logger.info(f"ℹ️ [{self.name}] 所有文档内容均已分析过，沿用全部文档")
+            elif len(keep) < len(documents):
+                logger.info(f"🧹 [{self.name}] 内容去重: {len(documents)} -> {len(keep)} 个文档")
+                documents = [documents[i] for i in keep]
+                if scores is not None:
+                    scores = scores[keep]
+            
+            # 根据相似度阈值筛选文档，并按分数取前 max_analysis_docs 个（从高到低）
+            if scores is not None:
+                # 有分数数组时用向量化的掩码 + 稳定排序，避免逐个文档的属性读取和分支
+                idx = np.flatnonzero(scores >= self.analysis_score_threshold)
+                if not idx.size:
+                    logger.warning(f"⚠️ [{self.name}] 没有文档达到分析阈值 ({self.analysis_score_threshold})，使用所有文档")
+                    idx = np.arange(len(documents))
+                top = idx[np.argsort(-scores[idx], kind="stable")[:self.max_analysis_docs]]
+                filtered_docs = [documents[i] for i in top]
+            else:
+                score_key = attrgetter('score')
+                candidates = (doc for doc in documents if score_key(doc) >= self.analysis_score_threshold)
+                filtered_docs = heapq.nlargest(self.max_analysis_docs, candidates, key=score_key)
+                
+                if not filtered_docs:
+                    logger.warning(f"⚠️ [{self.name}] 没有文档达到分析阈值 ({self.analysis_score_threshold})，使用所有文档")
+                    filtered_docs = heapq.nlargest(self.max_analysis_docs, documents, key=score_key)
             
-            # 构建资料摘要（不限制数量，使用所有通过阈值的文档）
-            materials_summary = []
+            # 构建资料摘要（写入同一个缓冲区，资料之间空一行）
+            buf = io.StringIO()
+            # 文档均为 SearchDocument（字段带默认值），直接读取属性
             for idx, doc in enumerate(filtered_docs, 1):
-                title = doc.title if hasattr(doc, 'title') else 'N/A'
-                content = doc.content if hasattr(doc, 'content') else ''
-                if not content and hasattr(doc, 'snippet'):
-                    content = doc.snippet
-                # 限制内容长度
-                content = content[:500] if len(content) > 500 else content
-                score = getattr(doc, 'score', 0.0)
-                materials_summary.append(f"[资料{idx}] 标题: {title}\n相似度: {score:.3f}\n内容: {content}\n")
+                content = doc.content or doc.snippet
+                if idx > 1:
+                    buf.write("\n")
+                # 限制内容长度（切片对短文本同样安全）
+                buf.write(f"[资料{idx}] 标题: {doc.title}\n相似度: {doc.score:.3f}\n内容: {content[:500]}\n")
             
-            materials_text = "\n".join(materials_summary)
+            materials_text = buf.getvalue()
             
             understanding_context = f"\n之前对问题的理解：{understanding}\n" if understanding else ""
             
@@ -656,7 +1048,7 @@ class MaterialAnalysisAgent(BaseAgent):
 请用简洁清晰的语言输出你的分析，控制在300字以内。"""
             
             logger.info(f"[{self.name}] 开始分析资料: {len(documents)}个文档 -> {len(filtered_docs)}个文档（阈值>={self.analysis_score_threshold}）")
-            analysis = call_zhipu_llm(
+            analysis = await call_zhipu_llm_async(
                 prompt=prompt,
                 api_key=self.zhipu_api_key,
                 model=self.zhipu_model,
@@ -665,31 +1057,31 @@ class MaterialAnalysisAgent(BaseAgent):
             )
             
             if analysis:
-                result = {
-                    "success": True,
-                    "analysis": analysis
-                }
+                result = AgentResult(
+                    success=True,
+                    analysis=analysis
+                )
                 logger.info(f"✅ [{self.name}] 分析完成")
             else:
-                result = {
-                    "success": False,
-                    "analysis": None,
-                    "message": "资料分析失败"
-                }
+                result = AgentResult(
+                    success=False,
+                    analysis=None,
+                    message="资料分析失败"
+                )
                 logger.warning(f"⚠️ [{self.name}] 分析失败")
             
             self.result = result
-            self.set_status(AgentStatus.COMPLETED)
+            self.set_status(STATUS_COMPLETED)
             return result
             
         except Exception as e:
             logger.error(f"❌ [{self.name}] 处理失败: {e}", exc_info=True)
-            self.set_status(AgentStatus.FAILED)
-            return {
-                "success": False,
-                "analysis": None,
-                "message": str(e)
-            }
+            self.set_status(STATUS_FAILED)
+            return AgentResult(
+                success=False,
+                analysis=None,
+                message=str(e)
+            )
 
 
 class DeepThinkingAgent(BaseAgent):
@@ -703,9 +1095,9 @@ class DeepThinkingAgent(BaseAgent):
         self.zhipu_api_key = zhipu_api_key
         self.zhipu_model = zhipu_model
     
-    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> Dict[str, Any]:
+    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> AgentResult:
         """深度思考"""
-        self.set_status(AgentStatus.PROCESSING)
+        self.set_status(STATUS_PROCESSING)
         
         try:
             query = input_data.get("query", "")
@@ -715,8 +1107,6 @@ class DeepThinkingAgent(BaseAgent):
             if not query:
                 raise ValueError("查询为空")
             
-            from .momo_utils import call_zhipu_llm
-            
             understanding_context = f"\n问题理解：{understanding}\n" if understanding else ""
             analysis_context = f"\n资料分析：{analysis}\n" if analysis else ""
             
@@ -736,7 +1126,7 @@ class DeepThinkingAgent(BaseAgent):
 请用简洁清晰的语言输出你的思考，控制在400字以内。"""
             
             logger.info(f"[{self.name}] 开始深度思考")
-            thinking = call_zhipu_llm(
+            thinking = await call_zhipu_llm_async(
                 prompt=prompt,
                 api_key=self.zhipu_api_key,
                 model=self.zhipu_model,
@@ -745,31 +1135,31 @@ class DeepThinkingAgent(BaseAgent):
             )
             
             if thinking:
-                result = {
-                    "success": True,
-                    "thinking": thinking
-                }
+                result = AgentResult(
+                    success=True,
+                    thinking=thinking
+                )
                 logger.info(f"✅ [{self.name}] 思考完成")
             else:
-                result = {
-                    "success": False,
-                    "thinking": None,
-                    "message": "深度思考失败"
-                }
+                result = AgentResult(
+                    success=False,
+                    thinking=None,
+                    message="深度思考失败"
+                )
                 logger.warning(f"⚠️ [{self.name}] 思考失败")
             
             self.result = result
-            self.set_status(AgentStatus.COMPLETED)
+            self.set_status(STATUS_COMPLETED)
             return result
             
         except Exception as e:
             logger.error(f"❌ [{self.name}] 处理失败: {e}", exc_info=True)
-            self.set_status(AgentStatus.FAILED)
-            return {
-                "success": False,
-                "thinking": None,
-                "message": str(e)
-            }
+            self.set_status(STATUS_FAILED)
+            return AgentResult(
+                success=False,
+                thinking=None,
+                message=str(e)
+            )
 
 
 class DocumentProcessorAgent(BaseAgent):
@@ -782,9 +1172,9 @@ class DocumentProcessorAgent(BaseAgent):
         )
         self.retriever = retriever
     
-    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> Dict[str, Any]:
+    async def process(self, input_data: Dict[str, Any], context: Dict[str, Any] = None) -> AgentResult:
         """处理文档"""
-        self.set_status(AgentStatus.PROCESSING)
+        self.set_status(STATUS_PROCESSING)
         
         try:
             query = input_data.get("query", "")
@@ -795,8 +1185,6 @@ class DocumentProcessorAgent(BaseAgent):
             
             logger.info(f"✂️ [{self.name}] 开始文档分块和二次检索: {len(documents)}个文档")
             
-            from .momo_retriever import expand_docs_by_text_split, merge_docs_by_url
-            
             # 文档分块
             docs_with_details = expand_docs_by_text_split(documents)
             
@@ -818,38 +1206,206 @@ class DocumentProcessorAgent(BaseAgent):
             
             logger.info(f"✅ [{self.name}] 处理完成: {len(relevant_docs)}个文档")
             
-            result = {
-                "success": True,
-                "results": relevant_docs,
-                "count": len(relevant_docs)
-            }
+            result = AgentResult(
+                success=True,
+                results=relevant_docs,
+                count=len(relevant_docs)
+            )
             
             self.result = result
-            self.set_status(AgentStatus.COMPLETED)
+            self.set_status(STATUS_COMPLETED)
             logger.info(f"✅ [{self.name}] Agent已完成: 处理了 {len(relevant_docs)} 个文档")
             return result
             
         except Exception as e:
             self.error = str(e)
-            self.set_status(AgentStatus.FAILED)
+            self.set_status(STATUS_FAILED)
             logger.error(f"❌ [{self.name}] 处理失败: {e}")
-            return {
-                "success": False,
-                "error": str(e),
-                "results": documents if 'documents' in locals() else []
-            }
+            return AgentResult(
+                success=False,
+                error=str(e),
+                results=documents if 'documents' in locals() else []
+            )
+
+
+@dataclass(frozen=True)
+class SearchSpec:
+    """
+    一条搜索查询的规格
+    
+    keyword: 使用的关键词语言（keywords 中的 "en"/"zh"）
+    fallback: 没有该关键词时的处理（None 跳过，"original" 使用原始查询，"translate" 使用翻译结果）
+    """
+    keyword: str
+    language: str
+    source: str
+    max_results: int
+    fallback: Optional[str] = None
+    fallback_source: Optional[str] = None
+    
+    def item(self, text: str, source: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "query": text,
+            "language": self.language,
+            "source": source or self.source,
+            "max_results": self.max_results
+        }
+    
+    def build(self, keywords: Dict[str, str], query: str) -> Optional[Dict[str, Any]]:
+        """根据关键词生成查询项；需要翻译或无可用文本时返回None"""
+        text = keywords.get(self.keyword)
+        if text:
+            return self.item(text)
+        if self.fallback == "original":
+            return self.item(query, self.fallback_source)
+        return None
+
+
+@dataclass(frozen=True)
+class ExecutionPlan:
+    """一种 (模式, 语言) 组合下的固定执行计划"""
+    understand: bool  # 是否先理解问题
+    deep: bool  # 是否执行资料分析、深度思考、深度爬取
+    need_translate: bool  # 是否提前发起中译英（作为英文关键词的兜底）
+    searxng_specs: tuple
+    ddg_specs: tuple
+
+
+# 英语查询：只搜英文，没有英文关键词时使用原始查询
+_EN_SEARXNG_SPECS = (
+    SearchSpec("en", "en", "keywords_en", 60, fallback="original", fallback_source="original"),  # 英语SearXNG搜索60条
+)
+_EN_DDG_SPECS = (
+    SearchSpec("en", "en", "ddg_en", 60, fallback="original", fallback_source="ddg_en"),  # 英语查询60条
+)
+# 中文查询：先英文，后中文；DuckDuckGo 没有英文关键词时使用翻译结果
+_ZH_SEARXNG_SPECS = (
+    SearchSpec("en", "en", "keywords_en", 60),  # 英语SearXNG搜索60条
+    SearchSpec("zh", "zh", "keywords_zh", 50),  # 中文SearXNG搜索50条
+)
+_ZH_DDG_SPECS = (
+    SearchSpec("en", "en", "ddg_en", 40, fallback="translate", fallback_source="ddg_en_translated"),  # 中文搜索时的英语资料40条
+    SearchSpec("zh", "zh", "ddg_zh", 20),
+)
+
+EXECUTION_PLANS: Dict[tuple, ExecutionPlan] = {
+    (mode, lang): ExecutionPlan(
+        understand=(mode == "quality"),
+        deep=(mode == "quality"),
+        need_translate=(lang == "zh"),
+        searxng_specs=_EN_SEARXNG_SPECS if lang == "en" else _ZH_SEARXNG_SPECS,
+        ddg_specs=_EN_DDG_SPECS if lang == "en" else _ZH_DDG_SPECS
+    )
+    for mode in ("speed", "quality")
+    for lang in ("zh", "en")
+}
+
+
+def _dedupe_queries(queries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    发起搜索前去除重复查询：同一搜索引擎、同一语言、规范化（strip + casefold）后文本相同的查询只保留第一个，
+    结果数取重复项中的最大值
+    """
+    unique: Dict[tuple, Dict[str, Any]] = {}
+    for item in queries:
+        engine = "ddg" if item.get("source", "").startswith("ddg") else "searxng"
+        key = (engine, item["query"].strip().casefold(), item["language"])
+        kept = unique.get(key)
+        if kept is None:
+            unique[key] = item
+        elif item.get("max_results", 0) > kept.get("max_results", 0):
+            unique[key] = {**kept, "max_results": item["max_results"]}
+    return list(unique.values())
+
+
+def get_execution_plan(mode: str, detected_lang: str) -> ExecutionPlan:
+    """获取执行计划（未知模式按快速模式，非英语按中文处理）"""
+    return EXECUTION_PLANS[(
+        "quality" if mode == "quality" else "speed",
+        "en" if detected_lang == "en" else "zh"
+    )]
+
+
+class AgentPool:
+    """
+    Agent 池 - 在多次查询之间复用Agent实例
+    
+    以初始化好的Agent为模板，每次查询借出一个独占的已重置实例，用完归还。
+    空闲实例不足时（并发查询）浅拷贝模板，共享检索器、爬虫、HTTP会话等重量级资源，
+    只有状态、结果和消息队列是每个实例独立的。
+    """
+    
+    def __init__(self, agents: Dict[str, BaseAgent]):
+        self._templates = dict(agents)
+        self._idle: Dict[str, List[BaseAgent]] = {name: [agent] for name, agent in agents.items()}
+        self._borrowed: Dict[int, str] = {}
+    
+    @property
+    def names(self) -> List[str]:
+        return list(self._templates.keys())
+    
+    def acquire(self, name: str) -> Optional[BaseAgent]:
+        """借出一个已重置的Agent，未注册的名称返回None"""
+        if name not in self._templates:
+            return None
+        idle = self._idle[name]
+        agent = idle.pop() if idle else copy.copy(self._templates[name])
+        agent.reset()
+        self._borrowed[id(agent)] = name
+        return agent
+    
+    def release(self, agent: BaseAgent):
+        """归还Agent"""
+        name = self._borrowed.pop(id(agent), None)
+        if name is not None:
+            self._idle[name].append(agent)
+    
+    def close(self):
+        """释放模板持有的共享资源"""
+        for agent in self._templates.values():
+            agent.close()
 
 
 class SearchOrchestrator:
     """搜索协调器 - 管理多个Agent的协作"""
     
-    def __init__(self, agents: Dict[str, BaseAgent], progress_callback: Optional[Callable] = None):
-        self.agents = agents
+    def __init__(self, agents: Optional[Dict[str, BaseAgent]] = None, progress_callback: Optional[Callable] = None,
+                 pool: Optional[AgentPool] = None, retrieval_min_corpus: int = 10, crawl_top_k: int = 10):
+        self.agents = agents or {}
+        self.pool = pool
+        self.retrieval_min_corpus = retrieval_min_corpus  # 快速模式下文档数不超过该值时跳过向量检索
+        self.crawl_top_k = crawl_top_k  # 深度爬取和文档分块只处理相关度最高的前 crawl_top_k 个文档
         self.progress_callback = progress_callback
+        self.steps: Dict[str, int] = {}  # 步骤名 -> 进度序号，每次执行时按执行计划生成
         self.total_steps = 0
         self.current_step = 0
+        # 进度消息队列及其后台发送任务（仅在 execute 期间存在）
+        self._progress_queue: Optional[asyncio.Queue] = None
+        self._progress_stop: Optional[asyncio.Event] = None
+        self._progress_task: Optional[asyncio.Task] = None
     
     async def execute(self, query: str, mode: str = "speed", detected_lang: str = "zh", conversation_history: Optional[List[Dict]] = None) -> tuple[List, str, dict]:
+        """
+        执行多Agent协作搜索（配置了Agent池时，本次查询期间独占借出的Agent）
+        
+        进度消息由后台任务发送，返回前会发送完所有已报告的进度
+        """
+        self._start_progress_drainer()
+        try:
+            if self.pool is None:
+                return await self._execute(query, mode, detected_lang, conversation_history)
+            
+            self.agents = {name: self.pool.acquire(name) for name in self.pool.names}
+            try:
+                return await self._execute(query, mode, detected_lang, conversation_history)
+            finally:
+                for agent in self.agents.values():
+                    self.pool.release(agent)
+                self.agents = {}
+        finally:
+            await self._stop_progress_drainer()
+    
+    async def _execute(self, query: str, mode: str = "speed", detected_lang: str = "zh", conversation_history: Optional[List[Dict]] = None) -> tuple[List, str, dict]:
         """
         执行多Agent协作搜索
         
@@ -863,20 +1419,30 @@ class SearchOrchestrator:
             (相关文档列表, 引用信息, 思考结果字典)
         """
         try:
-            # 计算总步骤数
-            self._calculate_steps(mode)
+            plan = get_execution_plan(mode, detected_lang)
+            # 按执行计划一次性生成所有步骤序号
+            self._calculate_steps(plan)
+            steps = self.steps
             
             # 立即发送开始消息
-            await self._report_progress(0, "多Agent搜索工作已启动")
+            self._report_progress(steps["start"], "多Agent搜索工作已启动")
             
             # 用于存储思考结果（深度模式）
             thinking_results = {}
             
+            # 中文查询：提前在线程池中发起翻译（仅依赖 query），与问题理解、关键词提取重叠执行；
+            # 只有关键词提取没有给出英文关键词时才会用到翻译结果
+            translate_future = None
+            if plan.need_translate:
+                translate_future = asyncio.get_running_loop().run_in_executor(
+                    None, translate_text, query, "zh", "en"
+                )
+            
             # 深度模式：Agent 0: 理解问题
-            if mode == "quality":
+            if plan.understand:
                 understanding_agent = self.agents.get("problem_understanding")
                 if understanding_agent:
-                    await self._report_progress(1, "理解问题")
+                    self._report_progress(steps["understanding"], "理解问题")
                     # 传递压缩配置（从orchestrator获取）
                     understanding_input = {
                         "query": query,
@@ -887,21 +1453,20 @@ class SearchOrchestrator:
                         understanding_input.update(self._compression_config)
                     
                     understanding_result = await understanding_agent.process(understanding_input)
-                    if understanding_result.get("success"):
-                        understanding_text = understanding_result.get("understanding", "")
+                    if understanding_result.success:
+                        understanding_text = understanding_result.understanding or ""
                         thinking_results["understanding"] = understanding_text
                         logger.info(f"✅ 问题理解完成: {understanding_text[:50]}...")
                         # 发送理解结果（单独发送，让前端可以显示）
-                        await self._report_progress(1, f"理解问题\n{understanding_text}")
+                        self._report_progress(steps["understanding"], f"理解问题\n{understanding_text}")
             
             # Agent 1: 关键词提取
             keyword_agent = self.agents.get("keyword_extractor")
-            step_offset = 2 if mode == "quality" else 1  # 深度模式：理解问题(1) + 关键词(2)，快速模式：开始(0) + 关键词(1)
             if keyword_agent:
-                await self._report_progress(step_offset, "提取搜索关键词")
+                self._report_progress(steps["keywords"], "提取搜索关键词")
                 # 如果有问题理解结果，传递给关键词提取Agent
                 keyword_input = {"query": query}
-                if mode == "quality" and thinking_results.get("understanding"):
+                if thinking_results.get("understanding"):
                     keyword_input["understanding"] = thinking_results["understanding"]
                 # 添加对话历史用于上下文理解
                 if conversation_history:
@@ -913,142 +1478,63 @@ class SearchOrchestrator:
                 
                 keyword_result = await keyword_agent.process(keyword_input)
                 
-                if not keyword_result.get("success"):
+                if not keyword_result.success:
                     logger.warning("关键词提取失败，使用原始查询")
-                    keyword_result = {"keywords": {"zh": query, "en": ""}}
+                    keyword_result = AgentResult(success=False, keywords={"zh": query, "en": ""})
             else:
-                keyword_result = {"keywords": {"zh": query, "en": ""}}
+                keyword_result = AgentResult(success=False, keywords={"zh": query, "en": ""})
             
-            # 准备搜索查询列表（先英文，后中文）
-            search_queries = []
-            keywords = keyword_result.get("keywords", {})
+            # 按执行计划准备 SearXNG / DuckDuckGo 查询列表（先英文，后中文）
+            keywords = keyword_result.keywords or {}
+            search_queries = [item for item in (spec.build(keywords, query) for spec in plan.searxng_specs) if item]
             
-            # 如果检测到是英语，只使用英文搜索，跳过中文搜索
-            if detected_lang == "en":
-                # 英语查询：优先使用英文关键词，否则使用原始查询
-                if keywords.get("en"):
-                    search_queries.append({
-                        "query": keywords["en"],
-                        "language": "en",
-                        "source": "keywords_en",
-                        "max_results": 60  # 英语SearXNG搜索增加到60条
-                    })
-                else:
-                    search_queries.append({
-                        "query": query,
-                        "language": "en",
-                        "source": "original",
-                        "max_results": 60  # 英语SearXNG搜索增加到60条
-                    })
-            else:
-                # 中文查询：先英文，后中文
-                if keywords.get("en"):
-                    search_queries.append({
-                        "query": keywords["en"],
-                        "language": "en",
-                        "source": "keywords_en",
-                        "max_results": 60  # 英语SearXNG搜索增加到60条
-                    })
-                
-                if keywords.get("zh"):
-                    search_queries.append({
-                        "query": keywords["zh"],
-                        "language": "zh",
-                        "source": "keywords_zh",
-                        "max_results": 50  # 中文SearXNG搜索保持50条
-                    })
-            
-            # 准备DuckDuckGo查询（先英文，后中文）
             ddg_queries = []
-            if detected_lang == "en":
-                # 英语查询：只使用英文，且增加结果数量到60
-                if keywords.get("en"):
-                    ddg_queries.append({
-                        "query": keywords["en"],
-                        "language": "en",
-                        "source": "ddg_en",
-                        "max_results": 60  # 英语查询增加到60条
-                    })
-                else:
-                    ddg_queries.append({
-                        "query": query,
-                        "language": "en",
-                        "source": "ddg_en",
-                        "max_results": 60  # 英语查询增加到60条
-                    })
-            else:
-                # 中文查询：先英文，后中文
-                if keywords.get("en"):
-                    ddg_queries.append({
-                        "query": keywords["en"],
-                        "language": "en",
-                        "source": "ddg_en",
-                        "max_results": 40  # 中文搜索时的英语资料为40条
-                    })
-                elif detected_lang == "zh":
-                    # 如果没有英文关键词，尝试翻译
-                    from .momo_utils import translate_text
-                    translated = translate_text(query, source="zh", target="en")
+            for spec in plan.ddg_specs:
+                item = spec.build(keywords, query)
+                if item is None and spec.fallback == "translate" and translate_future is not None:
+                    # 如果没有英文关键词，使用提前发起的翻译结果
+                    translated = await translate_future
                     if translated:
-                        ddg_queries.append({
-                            "query": translated,
-                            "language": "en",
-                            "source": "ddg_en_translated",
-                            "max_results": 40  # 中文搜索时的英语资料为40条
-                        })
-                
-                if keywords.get("zh"):
-                    ddg_queries.append({
-                        "query": keywords["zh"],
-                        "language": "zh",
-                        "source": "ddg_zh",
-                        "max_results": 20
-                    })
+                        item = spec.item(translated, spec.fallback_source)
+                if item:
+                    ddg_queries.append(item)
             
             # Agent 2: 搜索
             search_agent = self.agents.get("searcher")
-            # 初始化步骤计数器
-            current_step = 1
+            retrieval_agent = self.agents.get("retriever")
             all_documents = []
+            seen_urls = UrlDeduplicator()  # 增量维护已收录的 URL，避免每个查询后重建
+            # 搜索期间提前编码已到达的文档：[(起始位置, 结束位置, 编码任务)]，同一时间只有一批在编码
+            encode_batches = []
+            encoded_upto = 0
             
             if search_agent:
-                # 逐个执行搜索并报告进度
+                # 所有查询（SearXNG 先英文后中文，然后 DuckDuckGo）同时发起，总耗时取决于最慢的一个
+                all_queries = _dedupe_queries(search_queries + ddg_queries)
+                if len(all_queries) < len(search_queries) + len(ddg_queries):
+                    logger.info(f"🧹 [查询去重] {len(search_queries) + len(ddg_queries)} -> {len(all_queries)} 个查询")
+                if all_queries:
+                    self._report_progress(steps["search"], f"正在并行搜索 {len(all_queries)} 个查询")
                 
-                # 执行SearXNG搜索（先英文，后中文）
-                for sq in search_queries:
-                    if sq['language'] == 'en':
-                        message = f"正在搜索英语资料: {sq['query']}"
-                    else:
-                        message = f"正在搜索中文资料: {sq['query']}"
-                    await self._report_progress(current_step, message)
-                    # 单个查询搜索
-                    single_result = await search_agent.process({"queries": [sq]})
-                    docs = single_result.get("results", [])
-                    # 去重合并
-                    seen_urls = {doc.url for doc in all_documents}
-                    for doc in docs:
-                        if doc.url not in seen_urls:
-                            all_documents.append(doc)
-                            seen_urls.add(doc.url)
-                    current_step += 1
+                # 每完成一个查询报告一次进度
+                async def on_search_done(done: int, total: int):
+                    self._report_progress(steps["search"] + done - 1, f"搜索进度: {done}/{total}", coalesce=True)
                 
-                # 执行DuckDuckGo搜索（先英文，后中文）
-                for dq in ddg_queries:
-                    if dq['language'] == 'en':
-                        message = "正在扩充英语资料\n正在进一步深度搜索英语资料..."
-                    else:
-                        message = "正在进一步深度搜索中文资料..."
-                    await self._report_progress(current_step, message)
-                    # 单个查询搜索
-                    single_result = await search_agent.process({"queries": [dq]})
-                    docs = single_result.get("results", [])
-                    # 去重合并
-                    seen_urls = {doc.url for doc in all_documents}
-                    for doc in docs:
-                        if doc.url not in seen_urls:
+                # 一次提交全部查询，由搜索Agent内部并发执行，按查询顺序流式产出结果并在此增量去重
+                try:
+                    async for doc in search_agent.stream(all_queries, progress_callback=on_search_done):
+                        if seen_urls.add(doc.url):
                             all_documents.append(doc)
-                            seen_urls.add(doc.url)
-                    current_step += 1
+                        if (retrieval_agent
+                                and len(all_documents) - encoded_upto >= RETRIEVAL_PREFETCH_BATCH
+                                and (not encode_batches or encode_batches[-1][2].done())):
+                            batch_end = len(all_documents)
+                            encode_batches.append((encoded_upto, batch_end, asyncio.create_task(
+                                retrieval_agent.encode(all_documents[encoded_upto:batch_end])
+                            )))
+                            encoded_upto = batch_end
+                except Exception as e:
+                    logger.error(f"❌ [searcher] 搜索失败: {e}")
             else:
                 all_documents = []
             
@@ -1057,11 +1543,16 @@ class SearchOrchestrator:
                 return [], ""
             
             # Agent 3: 向量检索
-            retrieval_agent = self.agents.get("retriever")
-            if retrieval_agent:
-                vector_step = current_step
-                await self._report_progress(
-                    vector_step,
+            # 快速模式下结果很少时跳过向量检索（全部保留，排序/过滤收益很小）；
+            # 深度模式的资料分析和爬取依赖相似度分数，始终执行检索
+            skip_retrieval = not plan.deep and len(all_documents) <= self.retrieval_min_corpus
+            if not (retrieval_agent and not skip_retrieval):
+                for _, _, task in encode_batches:
+                    task.cancel()
+            
+            if retrieval_agent and not skip_retrieval:
+                self._report_progress(
+                    steps["retrieval"],
                     f"分析相关性 ({len(all_documents)}个结果)"
                 )
                 
@@ -1074,66 +1565,100 @@ class SearchOrchestrator:
                 else:
                     logger.info(f"[向量检索] 使用原始查询: {query[:100]}")
                 
+                # 合并搜索期间提前编码的向量，只需再编码剩余的文档
+                embeddings = None
+                if encode_batches:
+                    try:
+                        parts = [await task for _, _, task in encode_batches]
+                        if encoded_upto < len(all_documents):
+                            parts.append(await retrieval_agent.encode(all_documents[encoded_upto:]))
+                        embeddings = np.concatenate(parts)
+                        logger.info(f"[向量检索] 复用搜索期间提前编码的 {encoded_upto}/{len(all_documents)} 个文档向量")
+                    except Exception as e:
+                        logger.warning(f"⚠️ [向量检索] 提前编码失败，改为统一编码: {e}")
+                        embeddings = None
+                
                 retrieval_result = await retrieval_agent.process({
                     "queries": retrieval_queries,  # 传递查询列表
-                    "documents": all_documents
+                    "documents": all_documents,
+                    "embeddings": embeddings
                 })
-                relevant_docs = retrieval_result.get("results", [])
+                relevant_docs = retrieval_result.results
+                relevant_scores = retrieval_result.scores
             else:
+                if retrieval_agent:
+                    # 仍然发送该步骤的进度，保持前端步骤对齐
+                    self._report_progress(steps["retrieval"], f"分析相关性 ({len(all_documents)}个结果)")
+                    logger.info(f"[向量检索] 结果较少（{len(all_documents)} <= {self.retrieval_min_corpus}），跳过向量检索")
                 relevant_docs = all_documents
+                relevant_scores = None
             
             if not relevant_docs:
                 logger.warning("⚠️ 未找到相关文档")
                 return [], "", thinking_results
             
-            # 深度模式：在爬取之前进行思考步骤
-            if mode == "quality":
-                # Agent 4: 分析资料
+            # 深度模式：分析资料/深度思考（LLM）与深度爬取（网络）并行
+            if plan.deep:
                 analysis_agent = self.agents.get("material_analysis")
-                if analysis_agent:
-                    analysis_step = vector_step + 1
-                    await self._report_progress(analysis_step, "分析资料")
-                    analysis_result = await analysis_agent.process({
-                        "query": query,
-                        "documents": relevant_docs,
-                        "understanding": thinking_results.get("understanding", "")
-                    })
-                    if analysis_result.get("success"):
-                        thinking_results["analysis"] = analysis_result.get("analysis", "")
-                        logger.info(f"✅ 资料分析完成: {thinking_results['analysis'][:50]}...")
-                
-                # Agent 5: 深度思考
                 thinking_agent = self.agents.get("deep_thinking")
-                if thinking_agent:
-                    thinking_step = analysis_step + 1 if analysis_agent else vector_step + 1
-                    await self._report_progress(thinking_step, "深度思考与推理")
-                    thinking_result = await thinking_agent.process({
-                        "query": query,
-                        "understanding": thinking_results.get("understanding", ""),
-                        "analysis": thinking_results.get("analysis", "")
-                    })
-                    if thinking_result.get("success"):
-                        thinking_results["thinking"] = thinking_result.get("thinking", "")
-                        logger.info(f"✅ 深度思考完成: {thinking_results['thinking'][:50]}...")
-                
-                # Agent 6: 深度爬取（仅quality模式）
                 crawler_agent = self.agents.get("crawler")
+                # 爬取和二次检索只处理前 crawl_top_k 个文档（relevant_docs 已按相关度降序），完整列表仍用于分析；
+                # 其余文档在二次检索后原样接回，回答上下文和引用不因此缩减
+                crawl_docs = relevant_docs[:self.crawl_top_k]
+                uncrawled_docs = relevant_docs[self.crawl_top_k:]
+                
+                # 爬取会就地更新文档的content字段，分析使用爬取前的快照，结果与串行执行一致
+                analysis_docs = relevant_docs
+                if analysis_agent and crawler_agent:
+                    analysis_docs = [copy.copy(doc) for doc in relevant_docs]
+                
+                # Agent 6: 深度爬取（仅quality模式）——只依赖 relevant_docs，先在后台启动
+                crawl_task = None
                 if crawler_agent:
-                    # 计算爬取步骤位置
-                    thinking_step = analysis_step + 1 if analysis_agent else vector_step + 1
-                    crawl_step = thinking_step + 1 if thinking_agent else thinking_step
-                    await self._report_progress(
-                        crawl_step,
-                        f"深度爬取内容 (前{len(relevant_docs)}个)"
-                    )
+                    crawl_task = asyncio.create_task(crawler_agent.process({"documents": crawl_docs}))
+                
+                try:
+                    # Agent 4: 分析资料（与爬取并行）
+                    if analysis_agent:
+                        self._report_progress(steps["analysis"], "分析资料")
+                        analysis_result = await analysis_agent.process({
+                            "query": query,
+                            "documents": analysis_docs,
+                            "scores": relevant_scores,
+                            "understanding": thinking_results.get("understanding", "")
+                        })
+                        if analysis_result.success:
+                            thinking_results["analysis"] = analysis_result.analysis or ""
+                            logger.info(f"✅ 资料分析完成: {thinking_results['analysis'][:50]}...")
                     
-                    await crawler_agent.process({"documents": relevant_docs})
+                    # Agent 5: 深度思考（依赖分析结果，与剩余的爬取并行）
+                    if thinking_agent:
+                        self._report_progress(steps["thinking"], "深度思考与推理")
+                        thinking_result = await thinking_agent.process({
+                            "query": query,
+                            "understanding": thinking_results.get("understanding", ""),
+                            "analysis": thinking_results.get("analysis", "")
+                        })
+                        if thinking_result.success:
+                            thinking_results["thinking"] = thinking_result.thinking or ""
+                            logger.info(f"✅ 深度思考完成: {thinking_results['thinking'][:50]}...")
                     
+                    # 按步骤顺序报告进度后再等待爬取结束
+                    if crawl_task:
+                        self._report_progress(
+                            steps["crawl"],
+                            f"深度爬取内容 (前{len(crawl_docs)}个)"
+                        )
+                        await crawl_task
+                finally:
+                    if crawl_task and not crawl_task.done():
+                        crawl_task.cancel()
+                
+                if crawler_agent:
                     # Agent 7: 文档处理
                     processor_agent = self.agents.get("document_processor")
                     if processor_agent:
-                        split_step = crawl_step + 1
-                        await self._report_progress(split_step, "✂️ 文档分块和二次检索")
+                        self._report_progress(steps["split"], "✂️ 文档分块和二次检索")
                         
                         # 构建检索查询列表用于二次检索
                         retrieval_queries_for_processor = [query]
@@ -1142,19 +1667,17 @@ class SearchOrchestrator:
                         
                         processor_result = await processor_agent.process({
                             "query": query,
-                            "documents": relevant_docs
+                            "documents": crawl_docs
                         }, context={
                             "retrieval_queries": retrieval_queries_for_processor
                         })
-                        relevant_docs = processor_result.get("results", relevant_docs)
+                        relevant_docs = append_uncrawled_docs(processor_result.results, uncrawled_docs)
             
             # 完成搜索阶段
-            final_step = self.total_steps - 1  # 搜索完成是倒数第二步
-            await self._report_progress(final_step, f"✅ 搜索完成，找到{len(relevant_docs)}篇相关文档")
+            self._report_progress(steps["done"], f"✅ 搜索完成，找到{len(relevant_docs)}篇相关文档")
             
             # 综合信息，生成回答（最后一步）
-            synthesizing_step = self.total_steps
-            await self._report_progress(synthesizing_step, "综合信息，生成回答")
+            self._report_progress(steps["synthesize"], "综合信息，生成回答")
             
             # 生成引用信息（使用静态方法或直接实现）
             citations = self._format_citations(relevant_docs)
@@ -1166,39 +1689,93 @@ class SearchOrchestrator:
             logger.error(f"❌ 多Agent搜索失败: {e}", exc_info=True)
             return [], "", {}
     
-    def _calculate_steps(self, mode: str):
-        """计算总步骤数"""
-        search_steps = 2  # 估算：中文+英文关键词搜索
-        ddg_steps = 2  # DuckDuckGo中英文
+    def _calculate_steps(self, plan: ExecutionPlan):
+        """
+        按执行计划生成各步骤的进度序号
         
-        if mode == "quality":
-            # 深度模式：理解问题(1) + 关键词(1) + 搜索(2) + 向量检索(1) + 分析资料(1) + 深度思考(1) + 爬取(1) + 分块(1) + 完成(1)
-            base_steps = 9
-            self.total_steps = base_steps + search_steps + ddg_steps
-        else:
-            # 快速模式：关键词(1) + 搜索(2) + 向量检索(1) + 完成(1)
-            base_steps = 5
-            self.total_steps = base_steps + search_steps + ddg_steps
+        深度模式：开始(0) + 理解问题 + 关键词 + 搜索(每个查询一步) + 向量检索 + 分析资料 + 深度思考 + 爬取 + 分块 + 完成 + 生成回答
+        快速模式：开始(0) + 关键词 + 搜索(每个查询一步) + 向量检索 + 完成 + 生成回答
+        """
+        names = ["start"]
+        if plan.understand:
+            names.append("understanding")
+        names.append("keywords")
+        names.append("search")
+        names.append("retrieval")
+        if plan.deep:
+            names.extend(["analysis", "thinking", "crawl", "split"])
+        names.extend(["done", "synthesize"])
         
+        # 搜索阶段按计划中的查询数占用连续的序号（每完成一个查询前进一步）
+        search_slots = len(plan.searxng_specs) + len(plan.ddg_specs)
+        steps = {}
+        step = 0
+        for name in names:
+            steps[name] = step
+            step += search_slots if name == "search" else 1
+        
+        self.steps = steps
+        self.total_steps = steps["synthesize"]  # 最后一步（生成回答）即总步骤数
         self.current_step = 0
     
-    async def _report_progress(self, step: int, message: str):
-        """报告进度"""
+    def _report_progress(self, step: int, message: str, coalesce: bool = False):
+        """
+        报告进度（放入队列由后台任务发送，不在主流程上等待回调）
+        
+        Args:
+            coalesce: 是否可被紧随其后的另一条可合并进度覆盖（高频的搜索进度）
+        """
         self.current_step = step
-        if self.progress_callback:
-            await self.progress_callback(step, self.total_steps, message)
+        if self._progress_queue is not None:
+            self._progress_queue.put_nowait((step, self.total_steps, message, coalesce))
+    
+    def _start_progress_drainer(self):
+        """启动进度发送任务（没有进度回调时不启动）"""
+        if self.progress_callback and self._progress_task is None:
+            self._progress_queue = asyncio.Queue()
+            self._progress_stop = asyncio.Event()
+            self._progress_task = asyncio.create_task(self._drain_progress())
+    
+    async def _stop_progress_drainer(self):
+        """发送完剩余进度后停止发送任务"""
+        task = self._progress_task
+        if task is None:
+            return
+        self._progress_stop.set()
+        try:
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
+            self._progress_task = None
+            self._progress_queue = None
+            self._progress_stop = None
+    
+    async def _drain_progress(self):
+        """按顺序发送进度：每批最多等待 PROGRESS_COALESCE_INTERVAL 秒收集消息，连续的可合并进度只发送最后一条"""
+        queue = self._progress_queue
+        stop = self._progress_stop
+        while not (stop.is_set() and queue.empty()):
+            if not stop.is_set():
+                # 收集窗口：到时或收到停止信号（此时立即发送剩余消息）为止
+                try:
+                    await asyncio.wait_for(stop.wait(), PROGRESS_COALESCE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            batch = []
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            
+            for i, (step, total_steps, message, coalesce) in enumerate(batch):
+                if coalesce and i + 1 < len(batch) and batch[i + 1][3]:
+                    continue  # 被后一条搜索进度覆盖
+                try:
+                    await self.progress_callback(step, total_steps, message)
+                except Exception as e:
+                    logger.warning(f"⚠️ 进度回调失败: {e}")
     
     def _format_citations(self, documents: List) -> str:
-        """生成引用信息"""
-        if not documents:
-            return ""
-        
-        citations = []
+        """生成引用信息（文档不可哈希，以 (title, url) 元组作为缓存key）"""
         # 移除数量限制，包含所有文档的引用（避免前端无法渲染大于10的引用）
-        for idx, doc in enumerate(documents, 1):
-            title = doc.title if hasattr(doc, 'title') else 'N/A'
-            url = doc.url if hasattr(doc, 'url') else 'N/A'
-            citations.append(f"{idx}. [{title}]({url})")
-        
-        return "\n".join(citations)
+        return _format_citation_pairs(tuple((doc.title, doc.url) for doc in documents))
 
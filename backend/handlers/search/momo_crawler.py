@@ -3,7 +3,9 @@ Momo Search Crawler - 网页内容爬取
 简化版，使用 trafilatura 替代 crawl4ai
 """
 import asyncio
-from typing import List
+import urllib.parse
+from collections import OrderedDict
+from typing import Dict, List, Optional
 import httpx
 from loguru import logger
 
@@ -14,36 +16,132 @@ except ImportError:
     TRAFILATURA_AVAILABLE = False
     logger.warning("⚠️ trafilatura 未安装，深度爬取功能将不可用")
 
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    from pybloom_live import ScalableBloomFilter
+    BLOOM_AVAILABLE = True
+except ImportError:
+    BLOOM_AVAILABLE = False
+
 from .momo_utils import SearchDocument
 
+# 共享连接池配置（所有爬虫实例共用，各实例仍通过自己的信号量限制并发）
+CRAWLER_MAX_CONNECTIONS = 40
+CRAWLER_MAX_KEEPALIVE_CONNECTIONS = 20
+CRAWLER_KEEPALIVE_EXPIRY = 60.0  # 秒
+CRAWLER_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+# 跨会话记录的“无法提取正文”URL数量上限，超过后整体清空（让偶发失败的页面有机会重试）
+CRAWLER_FAILED_URL_CAPACITY = 100_000
+
+# 模块级共享客户端（惰性创建，绑定创建时的事件循环）：每个会话各有一个爬虫实例，
+# 共享客户端让长连接和 TLS 会话在会话之间复用
+_shared_client: Optional[httpx.AsyncClient] = None
+_shared_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _get_shared_client() -> httpx.AsyncClient:
+    """获取当前事件循环的共享客户端，已关闭或事件循环变化时重新创建"""
+    global _shared_client, _shared_client_loop
+    loop = asyncio.get_running_loop()
+    if _shared_client is None or _shared_client.is_closed or _shared_client_loop is not loop:
+        _shared_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=CRAWLER_MAX_CONNECTIONS,
+                max_keepalive_connections=CRAWLER_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=CRAWLER_KEEPALIVE_EXPIRY
+            ),
+            headers={'User-Agent': CRAWLER_USER_AGENT}
+        )
+        _shared_client_loop = loop
+    return _shared_client
+
+
+class FailedUrlFilter:
+    """
+    无法提取正文的URL集合（4xx、正文为空），跨会话共享，再次出现时直接跳过爬取
+    
+    安装了 pybloom_live 时使用可扩展布隆过滤器（内存小，极低误判率只会让个别页面少爬一次），
+    否则使用 set。记录数超过 capacity 后整体清空。
+    """
+    
+    def __init__(self, capacity: int = CRAWLER_FAILED_URL_CAPACITY):
+        self.capacity = capacity
+        self._urls = self._new_container()
+        self._count = 0
+    
+    def _new_container(self):
+        if BLOOM_AVAILABLE:
+            return ScalableBloomFilter(initial_capacity=min(self.capacity, 10000), error_rate=1e-3)
+        return set()
+    
+    def __contains__(self, url: str) -> bool:
+        return url in self._urls
+    
+    def add(self, url: str):
+        if url in self._urls:
+            return
+        if self._count >= self.capacity:
+            self._urls = self._new_container()
+            self._count = 0
+        self._urls.add(url)
+        self._count += 1
+
+
+_failed_urls = FailedUrlFilter()
+
+
+async def close_shared_client():
+    """关闭共享客户端（应用退出时调用；之后再爬取会自动重建）"""
+    global _shared_client
+    if _shared_client is not None and not _shared_client.is_closed:
+        await _shared_client.aclose()
+    _shared_client = None
+
 
 class SimpleCrawler:
     """简化版网页爬虫"""
     
-    def __init__(self, timeout: float = 15.0, max_concurrent: int = 5):
+    def __init__(self, timeout: float = 15.0, max_concurrent: int = 5, max_per_host: int = 2,
+                 content_cache_size: int = 256):
         """
         初始化爬虫
         
         Args:
             timeout: 请求超时时间
             max_concurrent: 最大并发数
+            max_per_host: 同一站点的最大并发数（礼貌爬取，避免压垮单个站点）
+            content_cache_size: 已爬取正文的缓存条数（跨请求复用，0 表示不缓存）
         """
         self.timeout = timeout
         self.max_concurrent = max_concurrent
-        self.http_client = None
-        logger.info(f"🕷️ 简化爬虫初始化: timeout={timeout}s, 并发={max_concurrent}")
+        self.max_per_host = max_per_host
+        # 连接超时单独收紧，整体超时按实例配置（每次请求传入）
+        self.request_timeout = httpx.Timeout(timeout, connect=min(timeout, 5.0))
+        # 已爬取正文缓存（LRU）：url -> content
+        self.content_cache_size = content_cache_size
+        self._content_cache: "OrderedDict[str, str]" = OrderedDict()
+        logger.info(f"🕷️ 简化爬虫初始化: timeout={timeout}s, 并发={max_concurrent}, 单站点并发={max_per_host}")
     
     async def _get_client(self):
-        """获取或创建HTTP客户端"""
-        if self.http_client is None:
-            self.http_client = httpx.AsyncClient(
-                timeout=self.timeout,
-                follow_redirects=True,
-                headers={
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-                }
-            )
-        return self.http_client
+        """获取HTTP客户端（所有爬虫实例共享同一个连接池）"""
+        return _get_shared_client()
+    
+    def _cache_content(self, url: str, content: str):
+        """记录已爬取的正文"""
+        if self.content_cache_size <= 0:
+            return
+        self._content_cache[url] = content
+        self._content_cache.move_to_end(url)
+        while len(self._content_cache) > self.content_cache_size:
+            self._content_cache.popitem(last=False)
     
     async def crawl_one(self, doc: SearchDocument) -> bool:
         """
@@ -59,15 +157,24 @@ class SimpleCrawler:
             logger.warning(f"⚠️ trafilatura 未安装，跳过 {doc.url}")
             return False
         
+        # 最近已爬取过的页面直接复用正文
+        cached = self._content_cache.get(doc.url)
+        if cached is not None:
+            self._content_cache.move_to_end(doc.url)
+            doc.content = cached
+            logger.info(f"⚡ 复用已爬取内容: {doc.url[:60]}... ({len(cached)}字)")
+            return True
+        
         try:
             client = await self._get_client()
             
             # 获取网页内容
-            response = await client.get(doc.url)
+            response = await client.get(doc.url, timeout=self.request_timeout)
             response.raise_for_status()
             
-            # 使用 trafilatura 提取正文
-            content = trafilatura.extract(
+            # 使用 trafilatura 提取正文（解析HTML较耗CPU，放到线程中执行，避免阻塞事件循环中的其他爬取）
+            content = await asyncio.to_thread(
+                trafilatura.extract,
                 response.text,
                 include_comments=False,
                 include_tables=True,
@@ -76,14 +183,20 @@ class SimpleCrawler:
             
             if content and len(content) > 100:
                 doc.content = content
+                self._cache_content(doc.url, content)
                 logger.info(f"✅ 成功爬取: {doc.url[:60]}... ({len(content)}字)")
                 return True
             else:
+                _failed_urls.add(doc.url)
                 logger.warning(f"⚠️ 提取内容为空: {doc.url[:60]}...")
                 return False
         
         except httpx.HTTPStatusError as e:
-            logger.warning(f"⚠️ HTTP错误 {e.response.status_code}: {doc.url[:60]}...")
+            status_code = e.response.status_code
+            # 4xx（429除外）基本是确定性失败；5xx、超时等可能是暂时性的，不记录
+            if 400 <= status_code < 500 and status_code != 429:
+                _failed_urls.add(doc.url)
+            logger.warning(f"⚠️ HTTP错误 {status_code}: {doc.url[:60]}...")
             return False
         except Exception as e:
             logger.warning(f"⚠️ 爬取失败: {doc.url[:60]}... - {str(e)[:50]}")
@@ -93,7 +206,8 @@ class SimpleCrawler:
         self, 
         docs: List[SearchDocument],
         score_threshold: float = 0.5,
-        max_docs: int = 10
+        max_docs: int = 10,
+        min_content_chars: int = 0
     ):
         """
         批量爬取多个文档
@@ -102,6 +216,7 @@ class SimpleCrawler:
             docs: 文档列表
             score_threshold: 只爬取相似度高于此阈值的文档
             max_docs: 最多爬取的文档数量
+            min_content_chars: 已有内容（content或snippet）达到该长度的文档视为内容充足，不再爬取（0表示不跳过）
         """
         if not TRAFILATURA_AVAILABLE:
             logger.warning("⚠️ trafilatura 未安装，跳过深度爬取")
@@ -113,32 +228,53 @@ class SimpleCrawler:
             if doc.score > score_threshold
         ][:max_docs]
         
+        # 跳过搜索结果中已自带足够长内容的文档（抓取整页收益很小）
+        if min_content_chars > 0:
+            crawl_docs = [doc for doc in filtered_docs if len(doc.content or doc.snippet) < min_content_chars]
+            if len(crawl_docs) < len(filtered_docs):
+                logger.info(f"ℹ️ {len(filtered_docs) - len(crawl_docs)} 个文档已有足够内容（>= {min_content_chars}字），跳过爬取")
+            filtered_docs = crawl_docs
+        
+        # 跳过之前（包括其他会话）已确认无法提取正文的页面
+        crawl_docs = [doc for doc in filtered_docs if doc.url not in _failed_urls]
+        if len(crawl_docs) < len(filtered_docs):
+            logger.info(f"ℹ️ {len(filtered_docs) - len(crawl_docs)} 个文档此前无法提取正文，跳过爬取")
+        filtered_docs = crawl_docs
+        
         if not filtered_docs:
             logger.info("ℹ️ 没有文档需要深度爬取")
             return
         
         logger.info(f"🕷️ 开始深度爬取: {len(filtered_docs)}/{len(docs)} 个文档")
         
-        # 创建信号量限制并发
-        semaphore = asyncio.Semaphore(self.max_concurrent)
+        # 固定数量的工作协程从队列取文档（任务数为 O(max_concurrent) 而非 O(文档数)），
+        # 并按站点限制单站点并发
+        queue: asyncio.Queue = asyncio.Queue()
+        for doc in filtered_docs:
+            queue.put_nowait(doc)
+        host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        success_count = 0
         
-        async def crawl_with_semaphore(doc):
-            async with semaphore:
-                return await self.crawl_one(doc)
+        async def worker():
+            nonlocal success_count
+            while not queue.empty():
+                doc = queue.get_nowait()
+                host = urllib.parse.urlsplit(doc.url).netloc
+                host_semaphore = host_semaphores.setdefault(host, asyncio.Semaphore(self.max_per_host))
+                async with host_semaphore:
+                    try:
+                        if await self.crawl_one(doc):
+                            success_count += 1
+                    except Exception as e:
+                        logger.warning(f"⚠️ 爬取失败: {doc.url[:60]}... - {str(e)[:50]}")
         
-        # 并发爬取
-        tasks = [crawl_with_semaphore(doc) for doc in filtered_docs]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*(worker() for _ in range(min(self.max_concurrent, len(filtered_docs)))))
         
-        # 统计结果
-        success_count = sum(1 for r in results if r is True)
         logger.info(f"✅ 深度爬取完成: {success_count}/{len(filtered_docs)} 成功")
     
     async def close(self):
-        """关闭HTTP客户端"""
-        if self.http_client:
-            await self.http_client.aclose()
-            self.http_client = None
+        """释放实例资源（共享客户端由 close_shared_client 在应用退出时统一关闭）"""
+        self._content_cache.clear()
 
 
 
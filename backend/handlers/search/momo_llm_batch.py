@@ -0,0 +1,103 @@
+"""
+Momo Search 异步智谱清言调用
+共享一个 httpx.AsyncClient（长连接池），支持多个提示词并发请求
+"""
+import asyncio
+import traceback
+from typing import List, Dict, Optional, Any
+
+import httpx
+from loguru import logger
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+from .momo_utils import ZHIPU_API_URL, ZHIPU_API_KEY, _build_zhipu_payload, _parse_zhipu_content
+
+# 模块级共享客户端（惰性创建，绑定创建时的事件循环）
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """获取当前事件循环的共享客户端，已关闭或事件循环变化时重新创建"""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+            timeout=httpx.Timeout(30.0)
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    """关闭共享客户端（下次调用时会自动重建）"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+async def call_zhipu_llm_async(
+    prompt: str,
+    api_key: Optional[str] = None,
+    model: Optional[str] = None,
+    temperature: float = 0.7,
+    max_tokens: int = 2000,
+    response_format: Optional[dict] = None
+) -> Optional[str]:
+    """
+    call_zhipu_llm 的异步版本，参数和返回值相同
+
+    超时/连接错误最多重试3次，失败返回None
+    """
+    headers = {
+        "Authorization": f"Bearer {api_key if api_key is not None else ZHIPU_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    payload = _build_zhipu_payload(prompt, model, temperature, max_tokens, response_format)
+
+    max_retries = 3
+    retry_delay = 2  # 重试间隔（秒）
+
+    try:
+        for attempt in range(max_retries):
+            try:
+                response = await _get_client().post(ZHIPU_API_URL, json=payload, headers=headers)
+                response.raise_for_status()
+                return _parse_zhipu_content(response.json())
+
+            except (httpx.TimeoutException, httpx.ConnectError) as e:
+                if attempt < max_retries - 1:
+                    wait_time = retry_delay * (attempt + 1)
+                    logger.warning(f"⚠️ 智谱清言API超时（尝试 {attempt + 1}/{max_retries}），{wait_time}秒后重试...")
+                    await asyncio.sleep(wait_time)
+                    continue
+                logger.error(f"❌ 智谱清言调用失败（已重试{max_retries}次）: {e}")
+                raise
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ 智谱清言调用失败: {e}")
+        logger.error(traceback.format_exc())
+        return None
+
+
+async def batch_call(prompts: List[Dict[str, Any]]) -> List[Optional[str]]:
+    """
+    并发执行多个互不依赖的智谱清言调用
+
+    Args:
+        prompts: 每项为 call_zhipu_llm_async 的关键字参数（至少包含 prompt）
+
+    Returns:
+        与 prompts 顺序一致的结果列表，失败项为None
+    """
+    return await asyncio.gather(*(call_zhipu_llm_async(**kwargs) for kwargs in prompts))
@@ -1,13 +1,20 @@
 """
 Momo Search Retriever - 文档检索和处理
 """
-from typing import List
+from typing import Dict, List
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from loguru import logger
 
 from .momo_utils import SearchDocument
 
+# 文本分块器只创建一次（分隔符等配置在所有调用间复用；split_text 不保存调用间状态）
+_TEXT_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=500,  # 块大小（字符）
+    chunk_overlap=50,  # 块重叠（字符）
+    add_start_index=True,  # 跟踪原始文档中的索引
+)
+
 
 def expand_docs_by_text_split(docs: List[SearchDocument]) -> List[SearchDocument]:
     """
@@ -21,24 +28,18 @@ def expand_docs_by_text_split(docs: List[SearchDocument]) -> List[SearchDocument
     """
     res_docs = []
     
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,  # 块大小（字符）
-        chunk_overlap=50,  # 块重叠（字符）
-        add_start_index=True,  # 跟踪原始文档中的索引
-    )
-    
     for doc in docs:
         if doc.content and len(doc.content) > 100:
-            all_splits = text_splitter.split_text(doc.content)
-            logger.debug(f"📄 文档 '{doc.title[:30]}...' 分块: {len(all_splits)}块")
+            all_splits = _TEXT_SPLITTER.split_text(doc.content)
+            logger.opt(lazy=True).debug(
+                "📄 文档 '{}...' 分块: {}块",
+                lambda doc=doc: doc.title[:30],
+                lambda all_splits=all_splits: len(all_splits)
+            )
             
-            for split in all_splits:
-                res_docs.append(SearchDocument(
-                    title=doc.title,
-                    url=doc.url,
-                    snippet=doc.snippet,
-                    content=split,
-                ))
+            # 一次性批量生成分块，各分块共享原文档的 title/url/snippet 字符串引用
+            title, url, snippet = doc.title, doc.url, doc.snippet
+            res_docs.extend([SearchDocument(title, url, snippet, split) for split in all_splits])
         else:
             res_docs.append(doc)
     
@@ -56,41 +57,61 @@ def merge_docs_by_url(docs: List[SearchDocument]) -> List[SearchDocument]:
     Returns:
         合并后的文档列表
     """
-    url_to_docs = {}
+    # 单遍流式合并：每个URL只保留首个文档、内容片段和当前最高分，不再保存整组分块对象
+    # url -> [首个文档, 内容片段列表, 最高分, 块数]
+    merged: Dict[str, list] = {}
     
-    # 按URL分组
     for doc in docs:
-        if doc.url not in url_to_docs:
-            url_to_docs[doc.url] = []
-        url_to_docs[doc.url].append(doc)
+        entry = merged.get(doc.url)
+        if entry is None:
+            merged[doc.url] = [doc, [doc.content] if doc.content else [], doc.score, 1]
+        else:
+            if doc.content:
+                entry[1].append(doc.content)
+            if doc.score > entry[2]:
+                entry[2] = doc.score  # 取最高分
+            entry[3] += 1
     
     merged_docs = []
     
-    # 合并同一URL的文档
-    for url, doc_list in url_to_docs.items():
-        if len(doc_list) == 1:
+    for url, (base_doc, contents, score, count) in merged.items():
+        if count == 1:
             # 只有一个文档，无需合并
-            merged_docs.append(doc_list[0])
-        else:
-            # 合并多个文档
-            base_doc = doc_list[0]
-            
-            # 合并内容
-            combined_content = "\n".join([d.content for d in doc_list if d.content])
-            
-            merged_doc = SearchDocument(
-                title=base_doc.title,
-                url=base_doc.url,
-                snippet=base_doc.snippet,
-                content=combined_content,
-                score=max(d.score for d in doc_list)  # 取最高分
-            )
-            
-            merged_docs.append(merged_doc)
-            logger.debug(f"🔗 合并URL '{url[:50]}...': {len(doc_list)}块 -> 1块")
+            merged_docs.append(base_doc)
+            continue
+        
+        merged_docs.append(SearchDocument(
+            title=base_doc.title,
+            url=base_doc.url,
+            snippet=base_doc.snippet,
+            content="\n".join(contents),
+            score=score
+        ))
+        logger.opt(lazy=True).debug(
+            "🔗 合并URL '{}...': {}块 -> 1块",
+            lambda url=url: url[:50],
+            lambda count=count: count
+        )
     
     logger.info(f"🔗 文档合并完成: {len(docs)} -> {len(merged_docs)} 个URL")
     return merged_docs
 
 
-
+def append_uncrawled_docs(
+    processed_docs: List[SearchDocument],
+    uncrawled_docs: List[SearchDocument]
+) -> List[SearchDocument]:
+    """
+    在二次检索结果之后接回未参与深度爬取的文档
+    
+    Args:
+        processed_docs: 爬取、分块、二次检索并合并后的文档
+        uncrawled_docs: 未爬取的文档（保持原相关度顺序）
+    
+    Returns:
+        合并后的文档列表（已在 processed_docs 中的URL不重复添加）
+    """
+    if not uncrawled_docs:
+        return processed_docs
+    seen_urls = {doc.url for doc in processed_docs}
+    return processed_docs + [doc for doc in uncrawled_docs if doc.url not in seen_urls]
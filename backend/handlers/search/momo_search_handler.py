@@ -21,14 +21,16 @@ from .momo_utils import (
     extract_keywords
 )
 from .momo_crawler import SimpleCrawler
-from .momo_retriever import expand_docs_by_text_split, merge_docs_by_url
+from .momo_retriever import append_uncrawled_docs, expand_docs_by_text_split, merge_docs_by_url
 from .momo_agents import (
     KeywordExtractionAgent,
     SearchAgent,
     RetrievalAgent,
     CrawlerAgent,
     DocumentProcessorAgent,
-    SearchOrchestrator
+    SearchOrchestrator,
+    AgentPool,
+    UrlDeduplicator
 )
 
 
@@ -131,11 +133,14 @@ class MomoSearchHandler(BaseHandler):
             )
             self.num_candidates = self.config.get('num_candidates', 40)
             self.sim_threshold = self.config.get('sim_threshold', 0.45)
+            self.rrf_k = self.config.get('rrf_k', 60)  # 多查询检索的RRF融合常数
+            self.embedding_cache_size = self.config.get('embedding_cache_size', 4096)  # 文档向量缓存条数
             
             # 爬虫配置
             self.enable_deep_crawl = self.config.get('enable_deep_crawl', True)
             self.crawl_score_threshold = self.config.get('crawl_score_threshold', 0.5)
             self.max_crawl_docs = self.config.get('max_crawl_docs', 10)
+            self.crawl_min_content_chars = self.config.get('crawl_min_content_chars', 800)
             
             # 关键词提取配置
             self.enable_keyword_extraction = self.config.get('enable_keyword_extraction', True)
@@ -172,7 +177,9 @@ class MomoSearchHandler(BaseHandler):
             self.retriever = FaissRetriever(
                 self.embedding_model,
                 num_candidates=self.num_candidates,
-                sim_threshold=self.sim_threshold
+                sim_threshold=self.sim_threshold,
+                rrf_k=self.rrf_k,
+                embedding_cache_size=self.embedding_cache_size
             )
             
             # 初始化爬虫
@@ -248,7 +255,8 @@ class MomoSearchHandler(BaseHandler):
         self.agents["material_analysis"] = MaterialAnalysisAgent(
             zhipu_api_key=self.zhipu_api_key,
             zhipu_model=self.zhipu_model,
-            analysis_score_threshold=analysis_score_threshold
+            analysis_score_threshold=analysis_score_threshold,
+            max_analysis_docs=self.config.get('max_analysis_docs', 20)
         )
         
         # 深度思考Agent（仅深度模式）
@@ -283,7 +291,8 @@ class MomoSearchHandler(BaseHandler):
             self.agents["crawler"] = CrawlerAgent(
                 crawler=self.crawler,
                 score_threshold=self.crawl_score_threshold,
-                max_docs=self.max_crawl_docs
+                max_docs=self.max_crawl_docs,
+                min_content_chars=self.crawl_min_content_chars
             )
             
             # 文档处理Agent
@@ -291,6 +300,9 @@ class MomoSearchHandler(BaseHandler):
                 retriever=self.retriever
             )
         
+        # Agent池：并发查询各自借用独立的Agent实例，避免互相覆盖状态
+        self.agent_pool = AgentPool(self.agents)
+        
         logger.info(f"✅ 已初始化 {len(self.agents)} 个Agent: {list(self.agents.keys())}")
     
     def format_citations(self, docs: List[SearchDocument]) -> str:
@@ -356,8 +368,10 @@ class MomoSearchHandler(BaseHandler):
             
             # 创建协调器
             orchestrator = SearchOrchestrator(
-                agents=self.agents,
-                progress_callback=progress_callback
+                pool=self.agent_pool,
+                progress_callback=progress_callback,
+                retrieval_min_corpus=self.config.get('retrieval_min_corpus', 10),
+                crawl_top_k=self.max_crawl_docs
             )
             
             # 传递压缩配置给orchestrator（以便传递给各个Agent）
@@ -542,66 +556,24 @@ class MomoSearchHandler(BaseHandler):
                 }]
             
             all_search_results = []
+            seen_urls = UrlDeduplicator()  # 所有搜索共用一个增量维护的URL去重器（不在每次合并时重建）
             # 重新计算精确的总步骤数（基于实际search_queries数量）
             actual_total_steps = base_steps + len(search_queries) + ddg_steps
             if actual_total_steps != total_steps:
                 # 如果实际步数与估算不同，更新total_steps
                 total_steps = actual_total_steps
             
-            # 步骤1: 使用提取的关键词进行搜索
-            for idx, search_item in enumerate(search_queries):
-                step_num = idx + 1
-                if progress_callback:
-                    await progress_callback(step_num, total_steps, f"正在搜索: {search_item['query']} ({search_item['source']})")
-                
-                logger.info(f"开始搜索: {search_item['query']} (语言: {search_item['language']}, 来源: {search_item['source']})")
-                
-                search_results = search_searxng(
-                    query=search_item['query'],
-                    num_results=self.max_search_results,
-                    ip_address=self.searxng_url,
-                    language=search_item['language'],
-                    time_range=self.searxng_time_range,
-                    deduplicate_by_url=True
-                )
-                
-                # 合并结果（自动去重）
-                seen_urls = {doc.url for doc in all_search_results}
-                for doc in search_results:
-                    if doc.url not in seen_urls:
-                        all_search_results.append(doc)
-                        seen_urls.add(doc.url)
-                
-                logger.info(f"✅ {search_item['source']}搜索完成: 获得{len(search_results)}个结果，总计{len(all_search_results)}个")
-            
-            # 如果只提取到中文关键词但没有英文关键词，且原始查询是中文，尝试翻译并搜索
+            # 如果只提取到中文关键词但没有英文关键词，且原始查询是中文，翻译原始查询作为补充的英文搜索
+            translated_searches = []
             if detected_lang == "zh" and keywords_dict and keywords_dict.get("en_keys") and not any(item['source'] == 'keywords_en' for item in search_queries):
-                if progress_callback:
-                    await progress_callback(2, total_steps, "🌐 翻译查询并搜索英文结果")
-                
-                # 翻译原始查询作为补充
-                translated_query = translate_text(query, source="zh", target="en")
-                
+                translated_query = await asyncio.to_thread(translate_text, query, source="zh", target="en")
                 if translated_query:
                     logger.info(f"🌐 翻译结果: {query} -> {translated_query}")
-                    
-                    english_search_results = search_searxng(
-                        query=translated_query,
-                        num_results=self.max_search_results,
-                        ip_address=self.searxng_url,
-                        language="en",
-                        time_range=self.searxng_time_range,
-                        deduplicate_by_url=True
-                    )
-                    
-                    # 合并结果（自动去重）
-                    seen_urls = {doc.url for doc in all_search_results}
-                    for doc in english_search_results:
-                        if doc.url not in seen_urls:
-                            all_search_results.append(doc)
-                            seen_urls.add(doc.url)
-                    
-                    logger.info(f"✅ 翻译搜索完成: 获得{len(english_search_results)}个新结果，总计{len(all_search_results)}个")
+                    translated_searches.append({
+                        "query": translated_query,
+                        "language": "en",
+                        "source": "translated"
+                    })
             
             # 步骤2: 使用 DuckDuckGo 进行补充搜索
             # 准备 DuckDuckGo 搜索查询
@@ -651,7 +623,7 @@ class MomoSearchHandler(BaseHandler):
                     })
                 elif detected_lang == "zh":
                     # 中文查询尝试翻译为英文
-                    translated_query = translate_text(query, source="zh", target="en")
+                    translated_query = await asyncio.to_thread(translate_text, query, source="zh", target="en")
                     if translated_query:
                         ddg_queries.append({
                             "query": translated_query,
@@ -660,40 +632,67 @@ class MomoSearchHandler(BaseHandler):
                             "max_results": 40  # 英语查询增加到40条
                         })
             
-            # 执行 DuckDuckGo 搜索
-            for idx, ddg_item in enumerate(ddg_queries):
-                step_num = len(search_queries) + idx + 1
-                if progress_callback:
-                    if ddg_item['language'] == 'zh':
-                        message = "正在进一步深度搜索..."
-                    else:  # en
-                        message = "正在扩充搜索英语资料..."
-                    await progress_callback(
-                        step_num, 
-                        total_steps, 
-                        message
+            # 步骤1-2: 所有 SearXNG（关键词 + 翻译补充）与 DuckDuckGo 查询同时发起，总耗时取决于最慢的一个
+            searxng_items = search_queries + translated_searches
+            all_items = searxng_items + ddg_queries
+            search_step_count = len(search_queries) + len(ddg_queries)
+            if progress_callback:
+                await progress_callback(1, total_steps, f"正在并行搜索 {len(all_items)} 个查询")
+            
+            def _run_search(item, is_ddg):
+                if is_ddg:
+                    logger.info(f"🦆 开始DuckDuckGo搜索: {item['query']} (语言: {item['language']})")
+                    # 根据max_results参数决定结果数量（英语40，中文20）
+                    return search_duckduckgo(
+                        query=item['query'],
+                        max_results=item.get("max_results", 20),
+                        language=item['language'],
+                        time_range=self.searxng_time_range if self.searxng_time_range else None
                     )
-                
-                logger.info(f"🦆 开始DuckDuckGo搜索: {ddg_item['query']} (语言: {ddg_item['language']})")
-                
-                # 根据max_results参数决定结果数量（英语40，中文20）
-                max_results = ddg_item.get("max_results", 20)
-                
-                ddg_results = await search_duckduckgo(
-                    query=ddg_item['query'],
-                    max_results=max_results,
-                    language=ddg_item['language'],
-                    time_range=self.searxng_time_range if self.searxng_time_range else None
+                logger.info(f"开始搜索: {item['query']} (语言: {item['language']}, 来源: {item['source']})")
+                # SearXNG 为同步请求，在线程中执行避免阻塞事件循环
+                return asyncio.to_thread(
+                    search_searxng,
+                    query=item['query'],
+                    num_results=self.max_search_results,
+                    ip_address=self.searxng_url,
+                    language=item['language'],
+                    time_range=self.searxng_time_range,
+                    deduplicate_by_url=True
                 )
+            
+            done_count = 0
+            
+            async def _tracked(item, is_ddg):
+                nonlocal done_count
+                try:
+                    return await _run_search(item, is_ddg)
+                finally:
+                    done_count += 1
+                    if progress_callback:
+                        await progress_callback(
+                            min(done_count, search_step_count),
+                            total_steps,
+                            f"搜索进度: {done_count}/{len(all_items)}"
+                        )
+            
+            results_lists = await asyncio.gather(
+                *(_tracked(item, idx >= len(searxng_items)) for idx, item in enumerate(all_items)),
+                return_exceptions=True
+            )
+            
+            # 按原有顺序（关键词 SearXNG、翻译补充、DuckDuckGo）一次性合并（自动去重）
+            for idx, (item, results) in enumerate(zip(all_items, results_lists)):
+                engine = "DuckDuckGo" if idx >= len(searxng_items) else "SearXNG"
+                if isinstance(results, BaseException):
+                    logger.error(f"❌ {engine}搜索失败: {item['query']} - {results}")
+                    continue
                 
-                # 合并结果（自动去重）
-                seen_urls = {doc.url for doc in all_search_results}
-                for doc in ddg_results:
-                    if doc.url not in seen_urls:
+                for doc in results:
+                    if seen_urls.add(doc.url):
                         all_search_results.append(doc)
-                        seen_urls.add(doc.url)
                 
-                logger.info(f"✅ DuckDuckGo {ddg_item['source']}搜索完成: 获得{len(ddg_results)}个结果，总计{len(all_search_results)}个")
+                logger.info(f"✅ {engine} {item['source']}搜索完成: 获得{len(results)}个结果，总计{len(all_search_results)}个")
             
             if not all_search_results:
                 logger.warning("⚠️ 所有搜索均未返回结果")
@@ -733,13 +732,17 @@ class MomoSearchHandler(BaseHandler):
             # 步骤4: 深度爬取 (仅quality模式)
             if mode == "quality" and self.enable_deep_crawl:
                 crawl_step = vector_step + 1
+                # 爬取和二次检索只处理相关度最高的前 max_crawl_docs 个文档，其余文档在二次检索后原样接回
+                crawl_docs = relevant_docs[:self.max_crawl_docs]
+                uncrawled_docs = relevant_docs[self.max_crawl_docs:]
                 if progress_callback:
-                    await progress_callback(crawl_step, total_steps, f"🕷️ 深度爬取内容 (前{self.max_crawl_docs}个)")
+                    await progress_callback(crawl_step, total_steps, f"🕷️ 深度爬取内容 (前{len(crawl_docs)}个)")
                 
                 await self.crawler.crawl_many(
-                    relevant_docs,
+                    crawl_docs,
                     score_threshold=self.crawl_score_threshold,
-                    max_docs=self.max_crawl_docs
+                    max_docs=self.max_crawl_docs,
+                    min_content_chars=self.crawl_min_content_chars
                 )
                 
                 # 步骤5: 文档分块和二次检索
@@ -747,14 +750,14 @@ class MomoSearchHandler(BaseHandler):
                 if progress_callback:
                     await progress_callback(split_step, total_steps, "✂️ 文档分块和二次检索")
                 
-                docs_with_details = expand_docs_by_text_split(relevant_docs)
+                docs_with_details = expand_docs_by_text_split(crawl_docs)
                 self.retriever.add_documents(docs_with_details)
                 # 二次检索也使用多查询（retrieval_queries已在上方定义）
                 if len(retrieval_queries) > 1:
                     relevant_docs_detailed = self.retriever.get_relevant_documents_multi_query(retrieval_queries)
                 else:
                     relevant_docs_detailed = self.retriever.get_relevant_documents(retrieval_queries[0])
-                relevant_docs = merge_docs_by_url(relevant_docs_detailed)
+                relevant_docs = append_uncrawled_docs(merge_docs_by_url(relevant_docs_detailed), uncrawled_docs)
                 
                 logger.info(f"📄 二次检索后: {len(relevant_docs)}个文档")
             
@@ -818,6 +821,12 @@ class MomoSearchHandler(BaseHandler):
         
         if hasattr(self, 'crawler'):
             await self.crawler.close()
+        
+        # 关闭Agent持有的资源（如SearchAgent的HTTP会话）
+        if hasattr(self, 'agent_pool'):
+            self.agent_pool.close()
+        
+        # 智谱共享客户端被所有会话使用，由应用退出时统一关闭，这里不关闭
         logger.info("🧹 Momo Search Handler 资源已清理")
     
     def __del__(self):
@@ -1,7 +1,10 @@
 """
 Momo Search Utils - 搜索工具函数
 """
+from collections import OrderedDict
 from dataclasses import dataclass
+import hashlib
+import threading
 import urllib.parse
 from json import JSONDecodeError
 from typing import List, Optional, Dict
@@ -23,9 +26,25 @@ ZHIPU_API_KEY = "6f29a799833a4a5daf5752973e9d0cc4.uoelH21xYFMkDknh"
 ZHIPU_MODEL = "glm-4.5-flash"
 
 
-@dataclass
+class SearchRateLimited(Exception):
+    """搜索引擎限流（HTTP 429/503 或 DuckDuckGo 限流），retry_after 为服务端建议的等待秒数"""
+    
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(value: Optional[str]) -> float:
+    """解析 Retry-After 响应头（只支持秒数格式，无法解析时返回0）"""
+    try:
+        return max(float(value), 0.0) if value else 0.0
+    except ValueError:
+        return 0.0
+
+
+@dataclass(slots=True)
 class SearchDocument:
-    """搜索结果文档"""
+    """搜索结果文档（使用 __slots__：分块展开时每次查询会创建数千个实例）"""
     title: str = ""
     url: str = ""
     snippet: str = ""
@@ -790,6 +809,54 @@ def extract_keywords(
         return None
 
 
+def _build_zhipu_payload(
+    prompt: str,
+    model: Optional[str],
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[dict]
+) -> dict:
+    """构建智谱清言请求体（同步/异步调用共用）"""
+    payload = {
+        "model": model if model is not None else ZHIPU_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": False,
+        "thinking": {"type": "disabled"},
+        "do_sample": True,
+        "top_p": 0.95,
+        "tool_stream": False
+    }
+    
+    # 如果指定了响应格式，添加到payload
+    if response_format:
+        payload["response_format"] = response_format
+    return payload
+
+
+def _parse_zhipu_content(result: dict) -> Optional[str]:
+    """从智谱清言响应JSON中取出文本内容，为空返回None"""
+    choices = result.get("choices", [])
+    if not choices:
+        logger.warning("⚠️ 智谱清言API返回空choices")
+        return None
+    
+    message = choices[0].get("message", {})
+    content = message.get("content", "").strip()
+    
+    if not content:
+        logger.warning("⚠️ 智谱清言API返回空内容")
+        return None
+    
+    return content
+
+
 def call_zhipu_llm(
     prompt: str,
     api_key: Optional[str] = None,
@@ -814,33 +881,13 @@ def call_zhipu_llm(
     """
     try:
         zhipu_api_key = api_key if api_key is not None else ZHIPU_API_KEY
-        zhipu_model = model if model is not None else ZHIPU_MODEL
         
         headers = {
             "Authorization": f"Bearer {zhipu_api_key}",
             "Content-Type": "application/json"
         }
         
-        payload = {
-            "model": zhipu_model,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "stream": False,
-            "thinking": {"type": "disabled"},
-            "do_sample": True,
-            "top_p": 0.95,
-            "tool_stream": False
-        }
-        
-        # 如果指定了响应格式，添加到payload
-        if response_format:
-            payload["response_format"] = response_format
+        payload = _build_zhipu_payload(prompt, model, temperature, max_tokens, response_format)
         
         # 添加重试机制（最多3次）
         max_retries = 3
@@ -856,22 +903,9 @@ def call_zhipu_llm(
                 )
                 
                 response.raise_for_status()
-                result = response.json()
                 
                 # 解析返回的JSON
-                choices = result.get("choices", [])
-                if not choices:
-                    logger.warning("⚠️ 智谱清言API返回空choices")
-                    return None
-                
-                message = choices[0].get("message", {})
-                content = message.get("content", "").strip()
-                
-                if not content:
-                    logger.warning("⚠️ 智谱清言API返回空内容")
-                    return None
-                
-                return content
+                return _parse_zhipu_content(response.json())
                 
             except (requests.exceptions.ReadTimeout, requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
                 if attempt < max_retries - 1:
@@ -988,7 +1022,8 @@ def search_searxng(
     ip_address: str = "http://localhost:9080",
     language: str = "zh",
     time_range: str = "",
-    deduplicate_by_url: bool = True
+    deduplicate_by_url: bool = True,
+    session: Optional[requests.Session] = None
 ) -> List[SearchDocument]:
     """
     使用SearXNG搜索
@@ -999,6 +1034,7 @@ def search_searxng(
         ip_address: SearXNG服务地址
         language: 搜索语言 (zh/en)
         time_range: 时间范围 (day/week/month/year/"")
+        session: 可选的长连接会话（复用 TCP/TLS 连接），为空时使用一次性请求
     
     Returns:
         搜索结果文档列表
@@ -1035,7 +1071,14 @@ def search_searxng(
         url = f"{base_url}/search?{query_string}"
         
         try:
-            response = requests.get(url, headers=headers, timeout=30)
+            response = (session or requests).get(url, headers=headers, timeout=30)
+            if response.status_code in (429, 503):
+                retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+                if not res:
+                    raise SearchRateLimited(f"SearXNG限流: HTTP {response.status_code}", retry_after)
+                # 翻页过程中被限流：保留已获得的结果
+                logger.warning(f"⚠️ SearXNG第{pageno}页被限流（HTTP {response.status_code}），返回已获得的{len(res)}个结果")
+                break
             response.raise_for_status()
             
             response_dict = response.json()
@@ -1110,8 +1153,10 @@ async def search_duckduckgo(
         # 尝试导入 ddgs
         try:
             from ddgs import DDGS
+            from ddgs.exceptions import RatelimitException
         except ImportError:
             from duckduckgo_search import DDGS
+            from duckduckgo_search.exceptions import RatelimitException
         
         # 准备搜索参数
         search_params = {
@@ -1144,7 +1189,10 @@ async def search_duckduckgo(
             with DDGS() as ddgs:
                 return list(ddgs.text(**search_params))
         
-        results = await asyncio.to_thread(_run_search)
+        try:
+            results = await asyncio.to_thread(_run_search)
+        except RatelimitException as e:
+            raise SearchRateLimited(f"DuckDuckGo限流: {e}") from e
         
         # 转换为 SearchDocument 格式
         documents = []
@@ -1165,6 +1213,8 @@ async def search_duckduckgo(
     except ImportError:
         logger.warning("⚠️ DuckDuckGo搜索包未安装，跳过DuckDuckGo搜索。请运行: pip install ddgs")
         return []
+    except SearchRateLimited:
+        raise  # 交给调用方退避重试
     except Exception as e:
         logger.error(f"❌ DuckDuckGo搜索失败: {e}")
         import traceback
@@ -1175,7 +1225,8 @@ async def search_duckduckgo(
 class FaissRetriever:
     """FAISS向量检索器"""
     
-    def __init__(self, embedding_model, num_candidates: int = 40, sim_threshold: float = 0.45) -> None:
+    def __init__(self, embedding_model, num_candidates: int = 40, sim_threshold: float = 0.45, rrf_k: int = 60,
+                 embedding_cache_size: int = 4096) -> None:
         """
         初始化检索器
         
@@ -1183,11 +1234,19 @@ class FaissRetriever:
             embedding_model: 嵌入模型（SentenceTransformer实例）
             num_candidates: 候选文档数量
             sim_threshold: 相似度阈值
+            rrf_k: 多查询检索时RRF（倒数排名融合）的平滑常数
+            embedding_cache_size: 文档向量缓存条数（0表示不缓存）
         """
         self.embedding_model = embedding_model
         self.num_candidates = num_candidates
         self.sim_threshold = sim_threshold
+        self.rrf_k = rrf_k
         self.embeddings_dim = embedding_model.get_sentence_embedding_dimension()
+        # 文档向量LRU缓存：文本哈希 -> 向量。追问等场景下相同的搜索结果/分块不再重复编码；
+        # reset_state 不清空缓存（编码结果只取决于文本和模型）
+        self.embedding_cache_size = embedding_cache_size
+        self._embedding_cache: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._embedding_cache_lock = threading.Lock()  # 提前编码在工作线程中执行
         self.reset_state()
         logger.info(f"📦 FAISS检索器初始化: dim={self.embeddings_dim}, candidates={num_candidates}, threshold={sim_threshold}")
     
@@ -1195,17 +1254,54 @@ class FaissRetriever:
         """重置状态"""
         self.index = faiss.IndexFlatIP(self.embeddings_dim)  # 使用内积（cosine相似度）
         self.documents = []
+        self.doc_embeddings = np.empty((0, self.embeddings_dim), dtype=np.float32)  # 已归一化的文档向量
     
     def encode_doc(self, doc: str | List[str]) -> np.ndarray:
         """编码文档为向量"""
         return self.embedding_model.encode(doc, normalize_embeddings=True)
     
-    def add_documents(self, documents: List[SearchDocument]) -> None:
+    def encode_documents(self, documents: List[SearchDocument]) -> np.ndarray:
+        """
+        编码文档（优先使用content，否则使用snippet），返回已归一化的 float32 向量矩阵 (N, dim)
+        
+        命中向量缓存的文档直接复用，只编码未命中的文档
+        """
+        doc_texts = [doc.content if doc.content else doc.snippet for doc in documents]
+        if self.embedding_cache_size <= 0:
+            return np.ascontiguousarray(self.encode_doc(doc_texts), dtype=np.float32).reshape(len(documents), -1)
+        
+        keys = [hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest() for text in doc_texts]
+        with self._embedding_cache_lock:
+            vectors = []
+            for key in keys:
+                vector = self._embedding_cache.get(key)
+                if vector is not None:
+                    self._embedding_cache.move_to_end(key)
+                vectors.append(vector)
+        
+        misses = [i for i, vector in enumerate(vectors) if vector is None]
+        if misses:
+            new_vectors = np.asarray(
+                self.encode_doc([doc_texts[i] for i in misses]), dtype=np.float32
+            ).reshape(len(misses), -1)
+            with self._embedding_cache_lock:
+                for i, vector in zip(misses, new_vectors):
+                    vectors[i] = vector
+                    self._embedding_cache[keys[i]] = vector.copy()  # 不引用整批结果数组，淘汰后可释放
+                while len(self._embedding_cache) > self.embedding_cache_size:
+                    self._embedding_cache.popitem(last=False)
+        
+        if len(misses) < len(documents):
+            logger.debug(f"📚 文档向量缓存命中: {len(documents) - len(misses)}/{len(documents)}")
+        return np.ascontiguousarray(np.stack(vectors), dtype=np.float32)
+    
+    def add_documents(self, documents: List[SearchDocument], embeddings: Optional[np.ndarray] = None) -> None:
         """
         添加文档到索引
         
         Args:
             documents: 文档列表
+            embeddings: 可选，与 documents 一一对应的已编码向量（由 encode_documents 提前计算），为空时现场编码
         """
         if not documents:
             logger.warning("⚠️ 没有文档添加到检索器")
@@ -1214,14 +1310,13 @@ class FaissRetriever:
         self.reset_state()
         self.documents = documents
         
-        # 提取文档内容（优先使用content，否则使用snippet）
-        doc_texts = [doc.content if doc.content else doc.snippet for doc in documents]
-        
-        # 编码文档
-        doc_embeddings = self.encode_doc(doc_texts)
+        # 编码文档（已提前编码且数量一致时直接复用）
+        if embeddings is None or len(embeddings) != len(documents):
+            embeddings = self.encode_documents(documents)
         
-        # 添加到索引
-        self.index.add(doc_embeddings)
+        # 添加到索引（同时保留向量矩阵，供多查询一次矩阵乘融合打分）
+        self.doc_embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.index.add(self.doc_embeddings)
         logger.debug(f"📚 添加{len(documents)}个文档到FAISS索引")
     
     def filter_by_sim(self, distances: np.ndarray, indices: np.ndarray) -> np.ndarray:
@@ -1287,85 +1382,99 @@ class FaissRetriever:
         
         logger.info(f"🎯 找到{len(relevant_docs)}个相关文档（阈值>={self.sim_threshold}）")
         
-        # 记录前几个结果
-        for idx, doc in enumerate(relevant_docs[:5]):
-            logger.debug(f"  {idx+1}. {doc.title[:50]}... (sim: {doc.score:.3f})")
+        # 记录前几个结果（仅在DEBUG级别启用时格式化）
+        logger.opt(lazy=True).debug("{}", lambda: "\n".join(
+            f"  {idx+1}. {doc.title[:50]}... (sim: {doc.score:.3f})"
+            for idx, doc in enumerate(relevant_docs[:5])
+        ))
         
         return relevant_docs
 
     def get_relevant_documents_multi_query(self, queries: List[str]) -> List[SearchDocument]:
         """
-        使用多个查询分别检索，然后合并结果（保留最高相似度分数）
+        使用多个查询分别检索，然后按RRF融合排序（分数保留最高相似度）
         
         Args:
             queries: 查询文本列表（例如：["中文查询", "English keywords"]）
         
         Returns:
-            合并后的相关文档列表（按相似度降序）
+            合并后的相关文档列表（按RRF融合分数降序）
+        """
+        return self.get_relevant_documents_batch(queries)
+    
+    def get_relevant_documents_batch(self, queries: List[str]) -> List[SearchDocument]:
+        """
+        批量检索：所有查询一次编码、一次矩阵乘得到相似度，多查询时按RRF融合排序，
+        再按URL合并结果（文档分数为各查询中的最高相似度）
+        
+        Args:
+            queries: 查询文本列表（单个查询也走该路径）
+        
+        Returns:
+            合并后的相关文档列表（多查询按RRF融合分数降序，单查询按相似度降序）
         """
         if not self.documents:
             logger.warning("⚠️ 检索器中没有任何文档")
             return []
         
+        queries = [query for query in queries if query and query.strip()]
         if not queries:
             return []
         
-        # 存储文档URL到最高相似度分数的映射
-        doc_scores = {}  # {url: max_score}
-        doc_map = {}  # {url: SearchDocument}
+        # 一次编码所有查询 -> (Q, dim)
+        query_embeddings = np.asarray(self.encode_doc(queries), dtype=np.float32).reshape(len(queries), -1)
+        
+        # 一次矩阵乘得到所有查询对所有文档的相似度 S (Q, N)（向量已归一化，内积即cosine）
+        sims = query_embeddings @ self.doc_embeddings.T
+        
+        # 每个查询只保留自己的前 num_candidates 个候选（与逐查询检索的候选范围一致）
+        n_docs = sims.shape[1]
+        k = min(self.num_candidates, n_docs)
+        if k < n_docs:
+            cutoff = np.partition(sims, n_docs - k, axis=1)[:, n_docs - k:n_docs - k + 1]
+            sims = np.where(sims >= cutoff, sims, -np.inf)
+        
+        # 文档分数取各查询中的最高相似度，用于阈值过滤（下游的阈值都基于cosine相似度）
+        best = sims.max(axis=0)
+        candidates = np.flatnonzero(best >= self.sim_threshold)
+        
+        if len(queries) > 1:
+            # 多查询（如中英文）按RRF融合排序：score(d) = Σ 1/(k + rank_i(d))，
+            # 只统计各查询自己的候选，相同RRF分数按最高相似度排序
+            ranks = np.argsort(np.argsort(-sims, axis=1, kind="stable"), axis=1) + 1
+            rrf = np.where(np.isfinite(sims), 1.0 / (self.rrf_k + ranks), 0.0).sum(axis=0)
+            order = candidates[np.lexsort((-best[candidates], -rrf[candidates]))]
+        else:
+            order = candidates[np.argsort(-best[candidates], kind="stable")]
         
-        # 对每个查询分别检索
-        for query_idx, query in enumerate(queries):
-            if not query or not query.strip():
+        # 按URL合并（已按融合顺序排列，同一URL保留第一次出现的文档）
+        doc_map = {}  # {url: SearchDocument}
+        for doc_idx in order:
+            doc = self.documents[doc_idx]
+            if doc.url in doc_map:
                 continue
-                
-            logger.debug(f"[多查询检索] 查询 {query_idx + 1}/{len(queries)}: {query[:50]}...")
-            
-            # 编码查询
-            query_embedding = self.encode_doc(query)
-            
-            # 搜索最相似的文档
-            distances, indices = self.index.search(
-                query_embedding.reshape(1, -1),
-                min(self.num_candidates, len(self.documents))
+            # 创建文档副本并更新分数
+            doc_map[doc.url] = SearchDocument(
+                title=doc.title,
+                url=doc.url,
+                snippet=doc.snippet,
+                content=doc.content,
+                score=float(best[doc_idx])
             )
-            
-            # 处理每个结果，保留最高分数
-            for idx, sim in enumerate(distances[0]):
-                doc_idx = int(indices[0][idx])
-                if doc_idx >= len(self.documents):
-                    continue
-                
-                doc = self.documents[doc_idx]
-                sim_score = float(sim)
-                
-                # 只考虑超过阈值的文档
-                if sim_score >= self.sim_threshold:
-                    # 保留更高的相似度分数
-                    if doc.url not in doc_scores or sim_score > doc_scores[doc.url]:
-                        doc_scores[doc.url] = sim_score
-                        # 创建文档副本并更新分数
-                        doc_copy = SearchDocument(
-                            title=doc.title,
-                            url=doc.url,
-                            snippet=doc.snippet,
-                            content=doc.content,
-                            score=sim_score
-                        )
-                        doc_map[doc.url] = doc_copy
         
         if not doc_map:
             logger.warning(f"⚠️ 多查询检索未找到相关文档（阈值>={self.sim_threshold}）")
             return []
         
-        # 按相似度分数排序
+        # 已按融合顺序排列（单查询时即相似度降序）
         relevant_docs = list(doc_map.values())
-        relevant_docs.sort(key=lambda x: x.score, reverse=True)
         
         logger.info(f"🎯 多查询检索完成: {len(queries)}个查询, 找到{len(relevant_docs)}个相关文档（阈值>={self.sim_threshold}）")
         
-        # 记录前几个结果
-        for idx, doc in enumerate(relevant_docs[:5]):
-            logger.debug(f"  {idx+1}. {doc.title[:50]}... (sim: {doc.score:.3f})")
+        # 记录前几个结果（仅在DEBUG级别启用时格式化）
+        logger.opt(lazy=True).debug("{}", lambda: "\n".join(
+            f"  {idx+1}. {doc.title[:50]}... (sim: {doc.score:.3f})"
+            for idx, doc in enumerate(relevant_docs[:5])
+        ))
         
         return relevant_docs
\ No newline at end of file
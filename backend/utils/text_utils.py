@@ -204,3 +204,29 @@ def split_long_text(text: str, max_length: int = 200) -> list:
         chunks.append(current_chunk.strip())
     
     return chunks
+
+
+def detect_language(text: str, ui_language: str = "zh") -> str:
+    """
+    简单检测文本主要语言（LLM 回复语言和搜索 Prompt 共用，保证判断一致）
+    
+    Args:
+        text: 用户输入文本
+        ui_language: 界面语言 ("zh" 或 "en")
+        
+    Returns:
+        "zh" 或 "en"；中英文混合或不含中英文字符时返回界面语言
+    """
+    # 统计中文字符数量
+    chinese_chars = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
+    # 统计英文字母数量
+    english_chars = sum(1 for char in text if char.isalpha() and ord(char) < 128)
+    
+    # 同时包含中文和英文时使用界面语言
+    if chinese_chars > 0 and english_chars > 0:
+        return ui_language
+    if chinese_chars > 0:
+        return "zh"
+    if english_chars > 0:
+        return "en"
+    return ui_language